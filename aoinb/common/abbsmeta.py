@@ -4,15 +4,24 @@
 import os
 import io
 import re
+import sys
 import time
 import stat
+import bisect
 import sqlite3
 import logging
 import argparse
+import itertools
 import posixpath
 import collections
+import collections.abc
+import concurrent.futures
+import multiprocessing.util
 
+import osutil
 import bashvar
+import vercomp
+import depgraph
 try:
     import fossil
     import reposync
@@ -44,6 +53,10 @@ def uniq(seq):  # Dave Kirby
     seen = set()
     return [x for x in seq if x not in seen and not seen.add(x)]
 
+def _empty_version():
+    # module-level default factory, so that packages can be pickled
+    return Version(None, None, None)
+
 class Package:
     def __init__(self, tree, secpath, directory, name=None):
         self.name = name
@@ -58,8 +71,7 @@ class Package:
         self.version = None
         self.release = None
         self.epoch = None
-        self.vermask_arch = collections.defaultdict(
-            lambda: Version(None, None, None))
+        self.vermask_arch = collections.defaultdict(_empty_version)
         self.description = None
         self.spec = collections.OrderedDict()
         self.dependencies = []
@@ -78,9 +90,11 @@ class Package:
                 (other.__class__.__name__, other.tree,
                 other.secpath, other.directory, self.name))
 
-    def load_spec(self, fp, filename=None, fileid=None):
+    def load_spec(self, fp, filename=None, fileid=None, cache=None,
+                  pool=None):
         self.fn_spec = filename
-        result, self.err_spec = bashvar.read_bashvar(fp, fileid, True)
+        result, self.err_spec = bashvar.read_bashvar(
+            fp, fileid, True, cache, pool)
         self.spec.update(result)
         for key in tuple(self.spec.keys()):
             if key == 'VER':
@@ -96,9 +110,11 @@ class Package:
                 self.vermask_arch[arch] = self.vermask_arch[arch]._replace(
                     release=self.spec.pop(key))
 
-    def load_defines(self, fp, filename=None, fileid=None):
+    def load_defines(self, fp, filename=None, fileid=None, cache=None,
+                     pool=None):
         self.fn_defines = filename
-        result, self.err_defines = bashvar.read_bashvar(fp, fileid, True)
+        result, self.err_defines = bashvar.read_bashvar(
+            fp, fileid, True, cache, pool)
         self.spec.update(result)
         name = self.spec.pop('PKGNAME', None)
         if not name:
@@ -150,8 +166,7 @@ class PackageGroup(Package):
             self.category, self.section = None, secpath
         self.version = None
         self.release = None
-        self.vermask_arch = collections.defaultdict(
-            lambda: Version(None, None, None))
+        self.vermask_arch = collections.defaultdict(_empty_version)
         self.directory = directory
         self.spec = collections.OrderedDict()
         self.fn_spec = None
@@ -167,7 +182,8 @@ class PackageGroup(Package):
                 (other.__class__.__name__, other.tree,
                 other.secpath, other.directory))
 
-    def package(self, defines_fp, defines_filename=None, defines_fileid=None):
+    def package(self, defines_fp, defines_filename=None, defines_fileid=None,
+                cache=None, pool=None):
         cls = Package(self.tree, self.secpath, self.directory, self.name)
         cls.spec = self.spec.copy()
         cls.version = self.version
@@ -175,7 +191,8 @@ class PackageGroup(Package):
         cls.vermask_arch = self.vermask_arch.copy()
         cls.fn_spec = self.fn_spec
         cls.err_spec = self.err_spec
-        cls.load_defines(defines_fp, defines_filename, defines_fileid)
+        cls.load_defines(
+            defines_fp, defines_filename, defines_fileid, cache, pool)
         return cls
 
 def parse_commit_msg(name, text):
@@ -192,10 +209,221 @@ def parse_commit_msg(name, text):
             return match.group(2)
     return text
 
+def parse_package_files(pkggroup, spec, defines, cache=None, pool=None):
+    """
+    Parse files of a package group, which are (filename, fileid, fp) of the
+    spec file and a list of those of defines files.
+    Returns the packages.
+    """
+    logger.debug('read %r', pkggroup)
+    filename, fileid, fp = spec
+    pkggroup.load_spec(fp, filename, fileid, cache, pool)
+    return [pkggroup.package(fp, filename, fileid, cache, pool)
+            for filename, fileid, fp in defines]
+
+def read_local_package_info(basepath, pkggroup, cache=None, pool=None):
+    results = []
+    repopath = os.path.join(pkggroup.secpath, pkggroup.directory)
+    logger.debug('read %r', pkggroup)
+    specfn = os.path.join(repopath, 'spec')
+    with open(os.path.join(basepath, specfn), 'r', encoding='utf-8') as f:
+        pkggroup.load_spec(f, specfn, cache=cache, pool=pool)
+    for root, dirs, files in os.walk(os.path.join(basepath, repopath)):
+        for filename in files:
+            if filename != 'defines':
+                continue
+            definesfn = os.path.join(root, 'defines')
+            definesfn_rel = os.path.relpath(definesfn, basepath)
+            with open(definesfn, 'r', encoding='utf-8') as f:
+                pkg = pkggroup.package(
+                    f, definesfn_rel, cache=cache, pool=pool)
+            results.append(pkg)
+    return results
+
+# parse cache and bash pool of a parser process, opened by _init_parser
+_parser_cache = None
+_parser_bashpool = None
+
+def _init_parser(cachefile):
+    global _parser_cache, _parser_bashpool
+    if cachefile:
+        _parser_cache = bashvar.ParseCache(cachefile)
+    _parser_bashpool = bashvar.BashPool()
+    multiprocessing.util.Finalize(
+        _parser_bashpool, _parser_bashpool.close, exitpriority=10)
+
+def _parse_local_group(basepath, pkggroup):
+    return read_local_package_info(
+        basepath, pkggroup, _parser_cache, _parser_bashpool)
+
+def _parse_source_group(pkggroup, spec, defines):
+    return pkggroup, parse_package_files(
+        pkggroup, spec, defines, _parser_cache, _parser_bashpool)
+
+class PackageWriter:
+    """
+    Batched writer of package metadata.
+
+    Packages are checked for duplicates and written with executemany in
+    flush(), giving the same results as writing them one by one in the order
+    they were added. fts_packages is synchronized once in update_fts(), which
+    also records the names in package_changes.
+    """
+    # number of names per SELECT ... IN query
+    query_size = 500
+
+    def __init__(self, db, tree, mainbranch):
+        self.db = db
+        self.tree = tree
+        self.mainbranch = mainbranch
+        # [(branches, pkg)]
+        self.packages = []
+        # (package, branch) -> commit_time
+        self.commit_times = {}
+        # packages to update in fts_packages
+        self.fts_names = set()
+
+    def __len__(self):
+        return len(self.packages)
+
+    def add(self, branches, pkg):
+        self.packages.append((tuple(branches), pkg))
+
+    def set_commit_time(self, name, branch, commit_time):
+        self.commit_times[name, branch] = commit_time
+
+    def fetch_existing(self, names):
+        cur = self.db.cursor()
+        existing = {}
+        for i in range(0, len(names), self.query_size):
+            chunk = names[i:i+self.query_size]
+            for row in cur.execute(
+                'SELECT name, tree, category, section, directory '
+                'FROM packages WHERE name IN (%s)' %
+                ','.join('?' * len(chunk)), chunk):
+                existing[row[0]] = tuple(row[1:])
+        return existing
+
+    def flush(self):
+        if not (self.packages or self.commit_times):
+            return
+        existing = self.fetch_existing(
+            uniq(pkg.name for branches, pkg in self.packages))
+        duplicates = []
+        packages = {}
+        versions = {}
+        specs = {}
+        dependencies = {}
+        for branches, pkg in self.packages:
+            row = existing.get(pkg.name)
+            if not row:
+                pass
+            elif row[0] != self.tree:
+                logger.warning(
+                    'duplicate package "%s" found in different trees '
+                    '%s/%s-%s/%s and %s/%s-%s/%s', pkg.name,
+                    row[0], row[1], row[2], row[3],
+                    self.tree, pkg.category, pkg.section, pkg.directory
+                )
+                duplicates.append((pkg.name, self.tree, pkg.category or '',
+                                   pkg.section, pkg.directory))
+                duplicates.append((pkg.name, row[0], row[1] or '',
+                                   row[2], row[3]))
+                # trees with lower priority will not override
+                continue
+            elif (pkg.category, pkg.section, pkg.directory) != row[1:]:
+                logger.warning(
+                    'duplicate package "%s" found in %s-%s/%s and %s-%s/%s',
+                    pkg.name, row[1], row[2], row[3],
+                    pkg.category, pkg.section, pkg.directory
+                )
+                duplicates.append((pkg.name, self.tree, pkg.category or '',
+                                   pkg.section, pkg.directory))
+                duplicates.append((pkg.name, row[0], row[1] or '',
+                                   row[2], row[3]))
+            existing[pkg.name] = (
+                self.tree, pkg.category, pkg.section, pkg.directory)
+            packages[pkg.name] = (
+                pkg.name, self.tree, pkg.category, pkg.section,
+                pkg.pkg_section, pkg.directory, pkg.description)
+            for branch in branches:
+                versions[pkg.name, branch, ''] = (
+                    pkg.name, branch, '', pkg.version, pkg.release,
+                    pkg.epoch, None, None, None, vercomp.package_sort_key(
+                        pkg.epoch, pkg.version, pkg.release))
+                for arch, mask in pkg.vermask_arch.items():
+                    version = mask.version or pkg.version
+                    release = mask.release or pkg.release
+                    epoch = mask.epoch or pkg.epoch
+                    versions[pkg.name, branch, arch] = (
+                        pkg.name, branch, arch, version, release, epoch,
+                        None, None, None,
+                        vercomp.package_sort_key(epoch, version, release))
+                if branch == self.mainbranch:
+                    specs[pkg.name] = [
+                        (pkg.name, k, v) for k, v in pkg.spec.items()]
+                    dependencies[pkg.name] = pkg.dependencies
+            logger.debug('add: ' + pkg.name)
+        cur = self.db.cursor()
+        cur.executemany(
+            'INSERT OR IGNORE INTO package_duplicate VALUES (?,?,?,?,?)',
+            duplicates)
+        cur.executemany(
+            'REPLACE INTO packages VALUES (?,?,?,?,?,?,?)', packages.values())
+        cur.executemany(
+            'REPLACE INTO package_versions VALUES (?,?,?,?,?,?,?,?,?,?)',
+            versions.values())
+        cur.executemany('DELETE FROM package_spec WHERE package = ?',
+                        ((name,) for name in specs))
+        cur.executemany('REPLACE INTO package_spec VALUES (?,?,?)',
+                        itertools.chain.from_iterable(specs.values()))
+        cur.executemany('DELETE FROM package_dependencies WHERE package = ?',
+                        ((name,) for name in dependencies))
+        cur.executemany(
+            'REPLACE INTO package_dependencies VALUES (?,?,?,?,?,?)',
+            itertools.chain.from_iterable(dependencies.values()))
+        cur.executemany(
+            'UPDATE package_versions SET commit_time=? '
+            'WHERE package=? AND branch=?',
+            ((commit_time, name, branch) for (name, branch), commit_time
+             in self.commit_times.items()))
+        self.fts_names.update(packages)
+        self.packages = []
+        self.commit_times = {}
+
+    def update_fts(self):
+        """
+        Copy names and descriptions of written packages to fts_packages.
+        """
+        self.flush()
+        if not self.fts_names:
+            return
+        cur = self.db.cursor()
+        cur.execute('CREATE TEMP TABLE t_fts_names (name TEXT PRIMARY KEY)')
+        cur.executemany('INSERT INTO t_fts_names VALUES (?)',
+                        ((name,) for name in self.fts_names))
+        # fts5 tables can't be looked up by column values with an index,
+        # so do it in one pass
+        cur.execute('DELETE FROM fts_packages WHERE rowid IN ('
+                    'SELECT f.rowid FROM fts_packages f '
+                    'INNER JOIN t_fts_names USING (name))')
+        cur.execute('INSERT INTO fts_packages '
+                    'SELECT p.name, p.description FROM packages p '
+                    'INNER JOIN t_fts_names USING (name)')
+        cur.execute('INSERT OR IGNORE INTO package_changes '
+                    'SELECT name FROM t_fts_names')
+        cur.execute('DROP TABLE t_fts_names')
+        self.fts_names.clear()
+
 
 class LocalRepo:
+    # package groups sent to a parser process at a time
+    parse_chunksize = 16
+    # packages written between commits
+    commit_interval = 1000
+
     def __init__(self, path, dbfile, name=None, branch='_local',
-                 category='base', priority=0):
+                 category='base', priority=0, jobs=1, cachefile=None):
         self.path = path
         self.dbfile = dbfile
         # tree name
@@ -207,6 +435,18 @@ class LocalRepo:
         self.mainbranch = branch
         self.category = category
         self.priority = priority
+        self.jobs = jobs
+        self.cachefile = cachefile
+        self.cache = bashvar.ParseCache(cachefile) if cachefile else None
+        # bashvar.BashPool, available during update
+        self.bashpool = None
+        # ignore the directory index and read every directory
+        self.rescan = False
+        # osutil.DirectoryWatcher, available during watch
+        self.watcher = None
+        # keep package_deps_all updated
+        self.deps_all = True
+        self.writer = PackageWriter(self.db, self.name, self.mainbranch)
         self.db.row_factory = sqlite3.Row
 
     def __repr__(self):
@@ -218,13 +458,40 @@ class LocalRepo:
         if reset:
             self.reset_progress()
         try:
-            self.repo_update()
+            with bashvar.BashPool() as self.bashpool:
+                self.repo_update()
         except KeyboardInterrupt:
             logger.error('Interrupted.')
         except:
             logger.exception('Error.')
         self.close()
 
+    def watch(self, reset=False, delay=1):
+        """
+        Update, then keep the database updated with changes in the tree
+        until interrupted.
+        """
+        self.init_db()
+        logger.info('Watch ' + self.name)
+        if reset:
+            self.reset_progress()
+        try:
+            with bashvar.BashPool() as self.bashpool, \
+                 osutil.DirectoryWatcher() as self.watcher:
+                dirty = ()
+                while True:
+                    self.scan_abbs_tree(dirty)
+                    self.update_deps_all()
+                    logger.info('Done.')
+                    dirty = set(
+                        self.relpath(path) for path in self.watcher.wait(delay))
+        except KeyboardInterrupt:
+            logger.info('Stopped.')
+        except:
+            logger.exception('Error.')
+        self.watcher = None
+        self.close()
+
     def init_db_schema(self):
         cur = self.db.cursor()
         cur.execute('PRAGMA journal_mode=WAL')
@@ -270,8 +537,11 @@ class LocalRepo:
                     'commit_time INTEGER,'
                     'committer TEXT,'
                     'githash TEXT,'
+                    'version_key BLOB,' # vercomp.sort_key of full version
                     'PRIMARY KEY (package, branch, architecture)'
                     ')')
+        vercomp.add_key_column(cur, 'package_versions',
+            ('epoch', 'version', 'release'), vercomp.package_sort_key)
         cur.execute('CREATE TABLE IF NOT EXISTS package_spec ('
                     'package TEXT,'
                     'key TEXT,'
@@ -314,6 +584,21 @@ class LocalRepo:
                     ' ON package_dependencies (dependency)')
         cur.execute('CREATE VIRTUAL TABLE IF NOT EXISTS fts_packages'
                     ' USING fts5(name, description, tokenize = porter)')
+        cur.execute('CREATE TABLE IF NOT EXISTS local_dirstat ('
+                    'tree TEXT,'
+                    'path TEXT,'     # relative to the tree, '' for the root
+                    'mtime INTEGER,' # in ns, NULL to read again
+                    'inode INTEGER,'
+                    'size INTEGER,'
+                    'subdirs TEXT,'  # names seperated by '/'
+                    'files_mtime INTEGER,' # of regular files in it
+                    'pkgpath TEXT,'  # section/directory
+                    'PRIMARY KEY (tree, path)'
+                    ')')
+        # changed packages, for repostats
+        cur.execute('CREATE TABLE IF NOT EXISTS package_changes ('
+                    'package TEXT PRIMARY KEY'
+                    ')')
         self.db.commit()
 
     def init_db(self):
@@ -326,126 +611,132 @@ class LocalRepo:
         self.db.commit()
 
     def update_package(self, branches, pkg):
-        cur = self.db.cursor()
-        existing = cur.execute(
-            'SELECT tree, category, section, directory '
-            'FROM packages WHERE name=?', (pkg.name,)).fetchone()
-        if not existing:
-            pass
-        elif existing[0] != self.name:
-            logger.warning(
-                'duplicate package "%s" found in different trees '
-                '%s/%s-%s/%s and %s/%s-%s/%s', pkg.name,
-                existing[0], existing[1], existing[2], existing[3],
-                self.name, pkg.category, pkg.section, pkg.directory
-            )
-            cur.execute(
-                'INSERT OR IGNORE INTO package_duplicate VALUES (?,?,?,?,?)',
-                (pkg.name, self.name, pkg.category or '', pkg.section, pkg.directory)
-            )
-            cur.execute(
-                'INSERT OR IGNORE INTO package_duplicate VALUES (?,?,?,?,?)',
-                (pkg.name, existing[0], existing[1] or '', existing[2], existing[3])
-            )
-            # trees with lower priority will not override
-            return
-        elif ((pkg.category, pkg.section, pkg.directory) !=
-              tuple(existing[1:])):
-            logger.warning(
-                'duplicate package "%s" found in %s-%s/%s and %s-%s/%s',
-                pkg.name, existing[1], existing[2], existing[3],
-                pkg.category, pkg.section, pkg.directory
-            )
-            cur.execute(
-                'INSERT OR IGNORE INTO package_duplicate VALUES (?,?,?,?,?)',
-                (pkg.name, self.name, pkg.category or '', pkg.section, pkg.directory)
-            )
-            cur.execute(
-                'INSERT OR IGNORE INTO package_duplicate VALUES (?,?,?,?,?)',
-                (pkg.name, existing[0], existing[1] or '', existing[2], existing[3])
-            )
-        cur.execute(
-            'REPLACE INTO packages VALUES (?,?,?,?,?,?,?)',
-            (pkg.name, self.name, pkg.category, pkg.section,
-            pkg.pkg_section, pkg.directory, pkg.description)
-        )
-        res = cur.execute(
-            'SELECT description FROM fts_packages WHERE name=?',
-            (pkg.name,)).fetchone()
-        if res is None:
-            cur.execute(
-                'INSERT INTO fts_packages VALUES (?, ?)',
-                (pkg.name, pkg.description)
-            )
-        elif res[0] != pkg.description:
-            cur.execute(
-                'UPDATE fts_packages SET description=? WHERE name=?',
-                (pkg.description, pkg.name)
-            )
-        for branch in branches:
-            cur.execute(
-                'REPLACE INTO package_versions VALUES (?,?,?,?,?,?,?,?,?)',
-                (pkg.name, branch, '', pkg.version, pkg.release,
-                pkg.epoch, None, None, None)
-            )
-            for arch, mask in pkg.vermask_arch.items():
-                cur.execute(
-                    'REPLACE INTO package_versions VALUES (?,?,?,?,?,?,?,?,?)', (
-                    pkg.name, branch, arch,
-                    mask.version or pkg.version, mask.release or pkg.release,
-                    mask.epoch or pkg.epoch, None, None, None
-                ))
-            if branch == self.mainbranch:
-                cur.execute('DELETE FROM package_spec WHERE package = ?', (pkg.name,))
-                for k, v in pkg.spec.items():
-                    cur.execute('REPLACE INTO package_spec VALUES (?,?,?)',
-                                (pkg.name, k, v))
-                cur.execute('DELETE FROM package_dependencies WHERE package = ?',
-                            (pkg.name,))
-                cur.executemany(
-                    'REPLACE INTO package_dependencies VALUES (?,?,?,?,?,?)',
-                    pkg.dependencies)
-        logger.debug('add: ' + pkg.name)
+        """
+        Queue the package to be written by self.writer.
+        """
+        self.writer.add(branches, pkg)
 
     def read_package_info(self, pkggroup):
-        results = []
-        repopath = os.path.join(pkggroup.secpath, pkggroup.directory)
-        logger.debug('read %r', pkggroup)
-        specfn = os.path.join(repopath, 'spec')
-        with open(os.path.join(self.path, specfn), 'r', encoding='utf-8') as f:
-            pkggroup.load_spec(f, specfn)
-        for root, dirs, files in os.walk(os.path.join(self.path, repopath)):
-            for filename in files:
-                if filename != 'defines':
+        return read_local_package_info(
+            self.path, pkggroup, self.cache, self.bashpool)
+
+    def iter_package_info(self, pkggroups):
+        """
+        Read package groups, yielding the packages of each group in order.
+        With more than one job, the files are parsed in a process pool.
+        """
+        if self.jobs <= 1 or len(pkggroups) <= 1:
+            for pkggroup in pkggroups:
+                yield self.read_package_info(pkggroup)
+            return
+        with concurrent.futures.ProcessPoolExecutor(
+            self.jobs, initializer=_init_parser,
+            initargs=(self.cachefile,)) as executor:
+            yield from executor.map(
+                _parse_local_group, itertools.repeat(self.path),
+                pkggroups, chunksize=self.parse_chunksize)
+
+    def relpath(self, path):
+        path = os.path.relpath(path, self.path)
+        return '' if path == '.' else path
+
+    def list_directory(self, path):
+        """
+        Returns names of subdirectories (not symlinks) and the latest mtime of
+        regular files in the directory, which is None for the tree root and
+        section directories.
+        """
+        subdirs = []
+        files_mtime = None
+        pathspl = path.split(os.sep)
+        count_files = (len(pathspl) >= 2)
+        with os.scandir(os.path.join(self.path, path)) as it:
+            for entry in it:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if is_dir:
+                    if not entry.is_symlink():
+                        subdirs.append(entry.name)
+                    continue
+                elif not count_files:
+                    continue
+                fstat = entry.stat(follow_symlinks=False)
+                if not stat.S_ISREG(fstat.st_mode):
                     continue
-                definesfn = os.path.join(root, 'defines')
-                definesfn_rel = os.path.relpath(definesfn, self.path)
-                with open(definesfn, 'r', encoding='utf-8') as f:
-                    pkg = pkggroup.package(f, definesfn_rel)
-                results.append(pkg)
-        return results
-
-    def scan_abbs_tree(self):
-        dir_mtime = {}
-        for root, dirs, files in os.walk(self.path):
-            pathspl = os.path.relpath(root, self.path).split(os.sep)
-            if not len(pathspl) >= 2:
+                files_mtime = max(files_mtime or 0, int(fstat.st_mtime))
+        return subdirs, files_mtime
+
+    def scan_dirstat(self, dirty=()):
+        """
+        Update the directory index in local_dirstat.
+        Directories with unchanged mtime, inode and size are not read again,
+        unless they are in dirty or self.rescan is set. Note that this misses
+        files modified in place: use rescan or watch mode for those.
+        """
+        cur = self.db.cursor()
+        index = {row[0]: row[1:] for row in cur.execute(
+            'SELECT path, mtime, inode, size, subdirs FROM local_dirstat '
+            'WHERE tree=?', (self.name,))}
+        # directories modified around now may be modified again within the
+        # timestamp granularity, so don't trust their mtime next time
+        racy_mtime = time.time_ns() - 1000000000
+        visited = set()
+        changed = []
+        stack = ['']
+        while stack:
+            path = stack.pop()
+            fullpath = os.path.join(self.path, path)
+            if self.watcher:
+                self.watcher.add(fullpath)
+            try:
+                dstat = os.stat(fullpath)
+            except FileNotFoundError:
                 continue
-            if pathspl[0] in repo_ignore:
+            if not stat.S_ISDIR(dstat.st_mode):
                 continue
-            pkgpath = '/'.join(pathspl[:2])
-            for filename in files:
-                fullname = os.path.join(root, filename)
-                fstat = os.lstat(fullname)
-                if not stat.S_ISREG(fstat.st_mode):
+            visited.add(path)
+            dirstat = (dstat.st_mtime_ns, dstat.st_ino, dstat.st_size)
+            row = index.get(path)
+            if (row and tuple(row[:3]) == dirstat and not self.rescan
+                and path not in dirty):
+                subdirs = row[3].split('/') if row[3] else ()
+            else:
+                try:
+                    subdirs, files_mtime = self.list_directory(path)
+                except FileNotFoundError:
+                    visited.discard(path)
                     continue
-                dir_mtime[pkgpath] = max(
-                    dir_mtime.get(pkgpath, 0), int(fstat.st_mtime))
+                pathspl = path.split(os.sep)
+                pkgpath = None
+                if len(pathspl) >= 2:
+                    pkgpath = '/'.join(pathspl[:2])
+                if dstat.st_mtime_ns > racy_mtime:
+                    dirstat = (None,) + dirstat[1:]
+                changed.append((self.name, path) + dirstat + (
+                    '/'.join(subdirs), files_mtime, pkgpath))
+            for name in subdirs:
+                if not path and name in repo_ignore:
+                    continue
+                stack.append(os.path.join(path, name))
+        removed = [(self.name, path) for path in index if path not in visited]
+        cur.executemany('DELETE FROM local_dirstat WHERE tree=? AND path=?',
+                        removed)
+        cur.executemany('REPLACE INTO local_dirstat VALUES (?,?,?,?,?,?,?,?)',
+                        changed)
+        logger.debug('directory index: %d read, %d removed',
+                     len(changed), len(removed))
+
+    def scan_abbs_tree(self, dirty=()):
+        self.scan_dirstat(dirty)
         cur = self.db.cursor()
         cur.execute("CREATE TEMP TABLE t_localdirs ("
             "fullpath TEXT PRIMARY KEY, mtime INTEGER)")
-        cur.executemany("INSERT INTO t_localdirs VALUES (?,?)",
-            dir_mtime.items())
+        cur.execute("INSERT INTO t_localdirs "
+            "SELECT pkgpath, max(files_mtime) FROM local_dirstat "
+            "WHERE tree=? AND files_mtime IS NOT NULL "
+            "GROUP BY pkgpath", (self.name,))
         self.db.commit()
         # one directory -> multiple packages
         cur.execute("""
@@ -489,52 +780,211 @@ class LocalRepo:
             "DELETE FROM packages WHERE name IN (SELECT name FROM t_pkgrm)")
         cur.execute(
             "DELETE FROM fts_packages WHERE name IN (SELECT name FROM t_pkgrm)")
+        cur.execute(
+            "INSERT OR IGNORE INTO package_changes SELECT name FROM t_pkgrm")
         self.db.commit()
         cur.execute("""
             SELECT b.fullpath, b.mtime
             FROM t_localdirs b
             LEFT JOIN t_lastdirs a USING (fullpath)
             WHERE a.fullpath IS NULL OR a.mtime IS NULL OR b.mtime > a.mtime
+            ORDER BY b.fullpath
         """)
-        for fullpath, mtime in cur.fetchall():
-            path, pkgpath = fullpath.split('/')
-            pkggroup = PackageGroup(self.name, path, pkgpath)
-            for pkg in self.read_package_info(pkggroup):
+        changed = cur.fetchall()
+        pkggroups = [PackageGroup(self.name, *fullpath.split('/'))
+                     for fullpath, mtime in changed]
+        written = 0
+        for (fullpath, mtime), pkgs in zip(
+            changed, self.iter_package_info(pkggroups)):
+            for pkg in pkgs:
                 self.update_package((self.branch,), pkg)
-                cur.execute(
-                    'UPDATE package_versions SET commit_time=? '
-                    'WHERE package=? AND branch=?',
-                    (mtime, pkg.name, self.branch)
-                )
+                self.writer.set_commit_time(pkg.name, self.branch, mtime)
+                written += 1
+                if written % self.commit_interval == 0:
+                    self.writer.flush()
+                    self.db.commit()
+        self.writer.update_fts()
         cur.execute(
             'DELETE FROM package_duplicate WHERE package IN '
             '(SELECT package FROM package_duplicate '
             ' GROUP BY package HAVING count(package) = 1)'
         )
+        cur.execute('DROP TABLE t_localdirs')
+        cur.execute('DROP TABLE t_lastdirs')
+        cur.execute('DROP TABLE t_pkgrm')
         self.db.commit()
 
     def repo_update(self):
         self.scan_abbs_tree()
+        self.update_deps_all()
         logger.info('Done.')
 
+    def update_deps_all(self):
+        if not self.deps_all:
+            return
+        logger.info('Updating dependency closure...')
+        depgraph.update_package_deps_all(self.db)
+        self.db.commit()
+
     def reset_progress(self):
         cur = self.db.cursor()
+        cur.execute('INSERT OR IGNORE INTO package_changes '
+                    'SELECT name FROM packages WHERE tree=?', (self.name,))
         cur.execute('DELETE FROM package_versions WHERE package IN '
                     '(SELECT name FROM packages WHERE tree=?)', (self.name,))
         cur.execute('DELETE FROM package_duplicate WHERE tree=?', (self.name,))
+        cur.execute('DELETE FROM local_dirstat WHERE tree=?', (self.name,))
         self.db.commit()
         cur.execute('VACUUM')
         self.db.commit()
 
     def close(self):
+        self.writer.update_fts()
         if self.db.in_transaction:
             logger.info('Committing...')
             self.db.commit()
         self.db.close()
+        if self.cache:
+            logger.debug('parse cache: %d hits, %d misses',
+                         self.cache.hits, self.cache.misses)
+            self.cache.prune()
+            self.cache.close()
+
+class LRUCache:
+    """
+    Least recently used cache, bounded by the estimated size of its values
+    in bytes, as given by sizeof(value).
+    """
+    # estimated size of a key and its hash table entry
+    entry_size = 100
+
+    def __init__(self, name, maxsize, sizeof=sys.getsizeof):
+        self.name = name
+        self.maxsize = maxsize
+        self.sizeof = sizeof
+        # key -> (value, size)
+        self.data = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key, default=None):
+        try:
+            value, size = self.data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self.data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        size = self.sizeof(value) + self.entry_size
+        if key in self.data:
+            self.size -= self.data.pop(key)[1]
+        self.data[key] = (value, size)
+        self.size += size
+        # keep at least the newest entry
+        while self.size > self.maxsize and len(self.data) > 1:
+            self.size -= self.data.popitem(last=False)[1][1]
+            self.evictions += 1
+
+    def log_stats(self):
+        logger.debug('%s cache: %d hits, %d misses, %d evictions, '
+                     '%d entries, %s', self.name, self.hits, self.misses,
+                     self.evictions, len(self.data),
+                     osutil.sizeof_fmt(self.size))
+
+
+class ManifestIndex(collections.abc.Mapping):
+    """
+    File list of a Fossil manifest, mapping path -> (uuid, permissions).
+
+    Paths, uuids and permissions are kept in sorted parallel tuples of
+    interned strings, so that manifests in the cache share the strings of
+    files they have in common. Directories are kept in a set.
+    """
+    def __init__(self, files):
+        files = sorted((sys.intern(path), sys.intern(uuid), sys.intern(perm))
+                       for path, uuid, perm in files)
+        self.paths = tuple(row[0] for row in files)
+        self.uuids = tuple(row[1] for row in files)
+        self.perms = tuple(row[2] for row in files)
+        dirs = set()
+        for path in self.paths:
+            pos = path.rfind('/')
+            while pos > 0:
+                dirname = path[:pos]
+                if dirname in dirs:
+                    # so are its parents
+                    break
+                dirs.add(sys.intern(dirname))
+                pos = path.rfind('/', 0, pos)
+        self.dirs = frozenset(dirs)
+
+    def sizeof(self):
+        """
+        Estimated size in bytes, counting strings as if not shared.
+        """
+        return (sys.getsizeof(self.paths) * 3 + sys.getsizeof(self.dirs) +
+                sum(map(sys.getsizeof, self.paths)) +
+                sum(map(sys.getsizeof, self.uuids)) +
+                sum(map(sys.getsizeof, self.dirs)))
+
+    def _index(self, path):
+        i = bisect.bisect_left(self.paths, path)
+        if i < len(self.paths) and self.paths[i] == path:
+            return i
+        return None
+
+    def __getitem__(self, path):
+        i = self._index(path)
+        if i is None:
+            raise KeyError(path)
+        return self.uuids[i], self.perms[i]
+
+    def __iter__(self):
+        return iter(self.paths)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def exists(self, path, isdir=False, ignorelink=False):
+        i = self._index(path)
+        if i is not None:
+            return not (ignorelink and 'l' in self.perms[i])
+        return isdir and path in self.dirs
+
+    def iter_prefix(self, prefix):
+        """
+        Iterate over (path, (uuid, permissions)) of paths starting with
+        prefix, in sorted order.
+        """
+        paths = self.paths
+        for i in range(bisect.bisect_left(paths, prefix), len(paths)):
+            path = paths[i]
+            if not path.startswith(prefix):
+                break
+            yield path, (self.uuids[i], self.perms[i])
+
 
 class SourceRepo(LocalRepo):
+    # commits to parse ahead of the one being written, with jobs > 1
+    lookahead = 16
+    # default cache sizes in bytes
+    manifest_cache_size = 256 << 20
+    branch_cache_size = 4 << 20
+
     def __init__(self, name, basepath, markpath, dbfile, mainbranch,
-                 branches=None, category='base', url=None, priority=0):
+                 branches=None, category='base', url=None, priority=0,
+                 cachefile=None, jobs=1):
         # tree name
         if '/' in name:
             raise ValueError("'/' not allowed in name. Use basepath to change directory")
@@ -550,6 +1000,14 @@ class SourceRepo(LocalRepo):
         self.category = category
         self.url = url
         self.priority = priority
+        self.jobs = jobs
+        self.cachefile = cachefile
+        self.cache = bashvar.ParseCache(cachefile) if cachefile else None
+        # bashvar.BashPool, available during update
+        self.bashpool = None
+        # keep package_deps_all updated
+        self.deps_all = True
+        self.writer = PackageWriter(self.db, self.name, self.mainbranch)
         self.gitpath = os.path.join(basepath, name + '.git')
         if not os.path.isdir(self.gitpath):
             gitpathwork = os.path.join(basepath, name)
@@ -565,8 +1023,9 @@ class SourceRepo(LocalRepo):
         if not os.path.isfile(self.fossilpath):
             self.sync()
         self.fossil = fossil.Repo(self.fossilpath)
-        self._cache_branch = fossil.LRUCache(16)
-        self._cache_flist = fossil.LRUCache(16)
+        self._cache_branch = LRUCache('branch', self.branch_cache_size)
+        self._cache_flist = LRUCache(
+            'manifest', self.manifest_cache_size, ManifestIndex.sizeof)
 
     def __repr__(self):
         return "<SourceRepo %s, basepath=%s>" % (self.name, self.basepath)
@@ -580,7 +1039,8 @@ class SourceRepo(LocalRepo):
         if reset:
             self.reset_progress()
         try:
-            self.repo_update()
+            with bashvar.BashPool() as self.bashpool:
+                self.repo_update()
         except KeyboardInterrupt:
             logger.error('Interrupted.')
         except:
@@ -619,14 +1079,13 @@ class SourceRepo(LocalRepo):
                       trackbranches=self.branches)
 
     def file_list(self, mid):
-        if mid in self._cache_flist:
-            return self._cache_flist[mid]
-        else:
-            self._cache_flist[mid] = flist = collections.OrderedDict((
-                (row[0], (row[1], row[2] if len(row) > 2 else ''))
+        flist = self._cache_flist.get(mid)
+        if flist is None:
+            self._cache_flist[mid] = flist = ManifestIndex(
+                (row[0], row[1], row[2] if len(row) > 2 else '')
                 for row in self.fossil.manifest(mid).F
-            ))
-            return flist
+            )
+        return flist
 
     def getfile(self, mid, path, text=False):
         uuid = self.file_list(mid)[path][0]
@@ -662,19 +1121,12 @@ class SourceRepo(LocalRepo):
         return ret
 
     def exists(self, mid, path, isdir=False, ignorelink=False):
-        for fn, v in self.file_list(mid).items():
-            if fn == path:
-                if ignorelink and 'l' in v[1]:
-                    return False
-                else:
-                    return True
-            elif isdir and fn.startswith(path + '/'):
-                return True
-        return False
+        return self.file_list(mid).exists(path, isdir, ignorelink)
 
     def branches_of_commit(self, mid):
-        if mid in self._cache_branch:
-            return self._cache_branch[mid]
+        branches = self._cache_branch.get(mid)
+        if branches is not None:
+            return branches
         mcur = self.marksdb.cursor()
         results = frozenset(x[0] for x in mcur.execute(
             "SELECT tagname FROM branches WHERE rid=?", (mid,)).fetchall())
@@ -705,26 +1157,73 @@ class SourceRepo(LocalRepo):
             yield PackageGroup(self.name, path, pkgpath), changestatus
             pkgs.add((path, pkgpath))
 
-    def read_package_info(self, mid, pkggroup):
-        results = []
+    def read_package_files(self, mid, pkggroup):
+        """
+        Read the spec and defines files of a package group for
+        parse_package_files.
+        """
         repopath = posixpath.join(pkggroup.secpath, pkggroup.directory)
-        logger.debug('read %r', pkggroup)
-        filelist = self.file_list(mid)
         specfn = posixpath.join(repopath, 'spec')
         uuid, specstr = self.getfile(mid, specfn, True)
-        pkggroup.load_spec(specstr, specfn, uuid[:16])
-        for path, fattr in filelist.items():
-            if path.startswith(repopath + '/'):
-                dirpath, filename = os.path.split(path)
-                if filename != 'defines':
-                    continue
-                definesfn = posixpath.join(dirpath, 'defines')
-                uuid, defines = self.getfile(mid, definesfn, True)
-                pkg = pkggroup.package(defines, definesfn, uuid[:16])
-                results.append(pkg)
-        return results
+        spec = (specfn, uuid[:16], specstr)
+        defines = []
+        for path, fattr in self.file_list(mid).iter_prefix(repopath + '/'):
+            dirpath, filename = os.path.split(path)
+            if filename != 'defines':
+                continue
+            definesfn = posixpath.join(dirpath, 'defines')
+            uuid, definesstr = self.getfile(mid, definesfn, True)
+            defines.append((definesfn, uuid[:16], definesstr))
+        return spec, defines
+
+    def read_package_info(self, mid, pkggroup):
+        return parse_package_files(
+            pkggroup, *self.read_package_files(mid, pkggroup),
+            self.cache, self.bashpool)
+
+    def prepare_commit(self, executor, mid):
+        """
+        List package groups changed in the commit, and submit the changed
+        ones to be parsed in the executor.
+        Returns [(pkggroup, change, future)] for scan_abbs_tree.
+        """
+        updates = []
+        for pkggroup, change in self.list_update(mid):
+            future = None
+            if change == '+':
+                future = executor.submit(
+                    _parse_source_group, pkggroup,
+                    *self.read_package_files(mid, pkggroup))
+            updates.append((pkggroup, change, future))
+        return updates
+
+    def iter_commit_updates(self, mids):
+        """
+        Yield the updates of each commit for scan_abbs_tree, in order.
+        With more than one job, package groups of the next `lookahead`
+        commits are parsed in a process pool while earlier ones are written.
+        Otherwise None is yielded, so they are read in scan_abbs_tree.
+        """
+        if self.jobs <= 1:
+            for mid in mids:
+                yield None
+            return
+        with concurrent.futures.ProcessPoolExecutor(
+            self.jobs, initializer=_init_parser,
+            initargs=(self.cachefile,)) as executor:
+            pending = collections.deque()
+            for mid in mids:
+                pending.append(self.prepare_commit(executor, mid))
+                if len(pending) > self.lookahead:
+                    yield pending.popleft()
+            while pending:
+                yield pending.popleft()
 
-    def scan_abbs_tree(self, mid):
+    def scan_abbs_tree(self, mid, updates=None):
+        """
+        Update packages changed in the commit.
+        updates is from prepare_commit, or None to read them here.
+        """
         cur = self.db.cursor()
         mcur = self.marksdb.cursor()
         githash, exist = mcur.execute(
@@ -737,7 +1236,11 @@ class SourceRepo(LocalRepo):
             'SELECT comment FROM event WHERE objid=?', (mid,)).fetchone()
         if commitmsg:
             commitmsg = commitmsg[0]
-        for pkggroup, change in self.list_update(mid):
+        if updates is None:
+            updates = ((pkggroup, change, None)
+                       for pkggroup, change in self.list_update(mid))
+        for pkggroup, change, parsed in updates:
+            self.writer.flush()
             removedpkgs = []
             for row in cur.execute(
                 'SELECT name FROM packages p '
@@ -761,8 +1264,8 @@ class SourceRepo(LocalRepo):
                     cur.execute('DELETE FROM package_dependencies WHERE package=?',
                                 (name,))
                     cur.execute('DELETE FROM packages WHERE name=?', (name,))
-                    cur.execute('DELETE FROM fts_packages WHERE name=?',
-                                (name,))
+                    # removed from fts_packages in update_fts
+                    self.writer.fts_names.add(name)
                     if change == '-':
                         logger.info('removed: ' + name)
                     else:
@@ -776,7 +1279,11 @@ class SourceRepo(LocalRepo):
                  pkggroup.directory, self.name)
             )
             if change == '+':
-                for pkg in self.read_package_info(mid, pkggroup):
+                if parsed is None:
+                    pkgs = self.read_package_info(mid, pkggroup)
+                else:
+                    pkggroup, pkgs = parsed.result()
+                for pkg in pkgs:
                     self.update_package(self.branches_of_commit(mid), pkg)
                     cmsg = parse_commit_msg(pkg.name, commitmsg)
                     if not cmsg:
@@ -806,6 +1313,7 @@ class SourceRepo(LocalRepo):
                         'REPLACE INTO package_rel VALUES (?,?,?,?,?,?)',
                         (mid, name, None, None, None, cmsg)
                     )
+        self.writer.flush()
         # make up for the deleted duplicate
         for secpath, directory in cur.execute(
             "SELECT "
@@ -820,6 +1328,7 @@ class SourceRepo(LocalRepo):
             pkggroup = PackageGroup(self.name, secpath, directory)
             for pkg in self.read_package_info(mid, pkggroup):
                 self.update_package(self.branches_of_commit(mid), pkg)
+        self.writer.flush()
         cur.execute(
             'DELETE FROM package_duplicate WHERE package IN '
             '(SELECT package FROM package_duplicate '
@@ -838,16 +1347,19 @@ class SourceRepo(LocalRepo):
         last_rid = mcur.execute(
             'SELECT rid FROM package_rel ORDER BY rid DESC LIMIT 1').fetchone()
         last_rid = last_rid[0] if last_rid else 0
-        for mtime, mid, uuid in self.fossil.execute(
+        commits = [row for row in self.fossil.execute(
             "SELECT round((mtime-2440587.5)*86400), objid, blob.uuid "
             "FROM event "
             "LEFT JOIN blob ON blob.rid=event.objid "
             "WHERE (mtime>=? OR objid>?) AND type='ci' ORDER BY mtime, objid",
-            (fossil.unix_to_julian(last_update), last_rid)).fetchall():
-            if not self.branches_of_commit(mid):
-                continue
+            (fossil.unix_to_julian(last_update), last_rid)).fetchall()
+            if self.branches_of_commit(row[1])]
+        for (mtime, mid, uuid), updates in zip(commits,
+            self.iter_commit_updates([row[1] for row in commits])):
             logger.info('%s: %d %s', time.strftime('%Y-%m-%d', time.gmtime(mtime)), mid, uuid[:16])
-            self.scan_abbs_tree(mid)
+            self.scan_abbs_tree(mid, updates)
+        self.writer.update_fts()
+        self.db.commit()
         mcur.execute('PRAGMA optimize')
         mcur.close()
         self.marksdb.commit()
@@ -862,7 +1374,8 @@ class SourceRepo(LocalRepo):
               COALESCE(v.architecture, '') architecture,
               pr.version, pr.release, pr.epoch,
               CAST(round((max(e.mtime)-2440587.5)*86400) AS INTEGER) commit_time,
-              c.name || ' <' || c.email || '>' committer, m.githash
+              c.name || ' <' || c.email || '>' committer, m.githash,
+              NULL version_key
             FROM marks.package_rel pr
             INNER JOIN marks.marks m USING (rid)
             INNER JOIN marks.branches b USING (rid)
@@ -876,8 +1389,22 @@ class SourceRepo(LocalRepo):
             ORDER BY commit_time, pr.package
         ''', (self.name,))
         cur.execute('DELETE FROM t_package_versions WHERE version IS NULL')
+        cur.executemany(
+            'UPDATE t_package_versions SET version_key=? WHERE rowid=?',
+            [(vercomp.package_sort_key(*row[1:]), row[0]) for row in
+             cur.execute('SELECT rowid, epoch, version, release '
+                         'FROM t_package_versions')])
         cur.execute('CREATE INDEX idx_t_package_versions '
             'ON t_package_versions (package)')
+        cur.execute('''
+            INSERT OR IGNORE INTO package_changes
+            SELECT t.package FROM t_package_versions t
+            LEFT JOIN package_versions v ON t.package=v.package
+            AND t.branch=v.branch AND t.version IS v.version
+            AND t.release IS v.release AND t.epoch IS v.epoch
+            AND t.commit_time IS v.commit_time AND t.githash IS v.githash
+            WHERE v.package IS NULL
+        ''')
         cur.execute('''
             REPLACE INTO package_versions
             SELECT t.* FROM t_package_versions t
@@ -890,8 +1417,14 @@ class SourceRepo(LocalRepo):
         cur.execute('DROP TABLE t_package_versions')
         self.db.execute('PRAGMA optimize')
         self.db.commit()
+        self.update_deps_all()
         logger.info('Done.')
 
+    def close(self):
+        super().close()
+        self._cache_flist.log_stats()
+        self._cache_branch.log_stats()
+
     def reset_progress(self):
         super().reset_progress()
         mcur = self.marksdb.cursor()
@@ -913,9 +1446,18 @@ def main():
     parser.add_argument("-c", "--category", help="Category, 'base' or 'bsp'", default="base")
     parser.add_argument("-u", "--url", help="Repo url")
     parser.add_argument("-P", "--priority", help="Priority to consider", type=int, default=0)
+    parser.add_argument("-j", "--jobs", help="Number of processes to parse package files with", type=int, default=1)
+    parser.add_argument("--lookahead", help="With -j, number of commits to parse ahead of the one being written", type=int, default=SourceRepo.lookahead, metavar='N')
     parser.add_argument("-v", "--verbose", help="Show debug logs", action='store_true')
+    parser.add_argument("--cache", help="Cache parse results of spec and defines files in FILE", metavar='FILE')
+    parser.add_argument("--cache-size", help="Maximum number of files in the parse cache", type=int, default=100000, metavar='N')
+    parser.add_argument("--manifest-cache", help="Memory for cached Fossil manifest file lists in MiB", type=int, default=SourceRepo.manifest_cache_size >> 20, metavar='MIB')
+    parser.add_argument("--branch-cache", help="Memory for cached branches of commits in MiB", type=int, default=SourceRepo.branch_cache_size >> 20, metavar='MIB')
     parser.add_argument("--no-sync", help="Don't sync Git and Fossil repos", action='store_true')
+    parser.add_argument("--no-deps-all", help="Don't update the transitive dependency table package_deps_all", action='store_true')
     parser.add_argument("--reset", help="Reset sync status", action='store_true')
+    parser.add_argument("--rescan", help="With -l, read all directories even if their mtime is unchanged", action='store_true')
+    parser.add_argument("--watch", help="With -l, keep updating the database on changes in the directory", action='store_true')
     parser.add_argument("name", help="Repository / abbs tree name", nargs='?')
     args = parser.parse_args()
 
@@ -926,15 +1468,29 @@ def main():
     if args.local:
         repo = LocalRepo(
             args.basepath, args.dbfile, args.name,
-            args.mainbranch or '_local', args.category, args.priority)
-        repo.update(args.reset)
+            args.mainbranch or '_local', args.category, args.priority,
+            args.jobs, args.cache)
+        if repo.cache:
+            repo.cache.max_entries = args.cache_size
+        repo.rescan = args.rescan
+        repo.deps_all = not args.no_deps_all
+        if args.watch:
+            repo.watch(args.reset)
+        else:
+            repo.update(args.reset)
     else:
         if not args.name:
             raise ValueError("repo name is not specified")
         repo = SourceRepo(
             args.name, args.basepath, args.markpath, args.dbfile,
             args.mainbranch or 'master', args.branches.split(','),
-            args.category, args.url, args.priority)
+            args.category, args.url, args.priority, args.cache, args.jobs)
+        if repo.cache:
+            repo.cache.max_entries = args.cache_size
+        repo.lookahead = args.lookahead
+        repo.deps_all = not args.no_deps_all
+        repo._cache_flist.maxsize = args.manifest_cache << 20
+        repo._cache_branch.maxsize = args.branch_cache << 20
         repo.update(not args.no_sync, args.reset)
 
 if __name__ == '__main__':
@@ -1,8 +1,17 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import os
 import re
+import json
+import time
+import queue
+import select
+import hashlib
+import secrets
+import threading
 import logging
+import sqlite3
 import tempfile
 import warnings
 import subprocess
@@ -99,6 +108,12 @@ class BashErrorWarning(UserWarning):
 class ParseError(Exception):
     pass
 
+class BashPoolError(RuntimeError):
+    """
+    A bash worker timed out or died, the script may work if run again.
+    """
+    pass
+
 def _compile_pattern(pattern, greedy=True, mode=None):
     regex = re.escape(pattern)
     if mode == 'end':
@@ -114,6 +129,39 @@ def _compile_pattern(pattern, greedy=True, mode=None):
             regex = '^' + regex
     return re.compile(regex)
 
+def expand_param(var, exptype=None, offset=None, length=None,
+                 pattern='', string=''):
+    if exptype is None:
+        pass
+    elif exptype == ':':
+        if offset is not None:
+            offset = int(offset.strip())
+            if length is not None:
+                length = int(length)
+                if length >= 0:
+                    var = var[offset:offset+length]
+                else:
+                    var = var[offset:length]
+            else:
+                var = var[offset:]
+    elif exptype[0] == '/':
+        regex = _compile_pattern(pattern)
+        if exptype == '/':
+            var = regex.sub(string, var, count=1)
+        elif exptype == '//':
+            var = regex.sub(string, var)
+    elif exptype[0] == '#':
+        regex = _compile_pattern(pattern, (exptype == '##'), 'start')
+        match = regex.match(var)
+        if match:
+            var = var[match.end():]
+    elif exptype[0] == '%':
+        regex = _compile_pattern(pattern, (exptype == '%%'), 'end')
+        match = regex.search(var)
+        if match:
+            var = var[:match.start(1)]
+    return var
+
 def combine_value(tokens, variables):
     val = ''
     if tokens.get('quote') == '"':
@@ -123,41 +171,14 @@ def combine_value(tokens, variables):
     elif tokens.get('expansion') == '$':
         varname = tokens['varname']
         if varname in variables:
-            var = variables[varname]
-            exptype = tokens.get('exptype')
-            if exptype is None:
-                pass
-            elif exptype == ':':
-                if 'offset' in tokens:
-                    offset = int(tokens['offset'][0].strip())
-                    if 'length' in tokens:
-                        length = int(tokens['length'])
-                        if length >= 0:
-                            var = var[offset:offset+length]
-                        else:
-                            var = var[offset:length]
-                    else:
-                        var = var[offset:]
-            elif exptype[0] == '/':
-                pattern = _compile_pattern(tokens.get('pattern', ''))
-                newstring = tokens.get('string', '')
-                if exptype == '/':
-                    var = pattern.sub(newstring, var, count=1)
-                elif exptype == '//':
-                    var = pattern.sub(newstring, var)
-            elif exptype[0] == '#':
-                pattern = _compile_pattern(
-                    tokens.get('pattern', ''), (exptype == '##'), 'start')
-                match = pattern.match(var)
-                if match:
-                    var = var[match.end():]
-            elif exptype[0] == '%':
-                pattern = _compile_pattern(
-                    tokens.get('pattern', ''), (exptype == '%%'), 'end')
-                match = pattern.search(var)
-                if match:
-                    var = var[:match.start(1)]
-            val += var
+            offset = length = None
+            if 'offset' in tokens:
+                offset = tokens['offset'][0]
+                if 'length' in tokens:
+                    length = tokens['length']
+            val += expand_param(
+                variables[varname], tokens.get('exptype'), offset, length,
+                tokens.get('pattern', ''), tokens.get('string', ''))
         else:
             warnings.warn('variable "%s" is undefined' % varname, VariableWarning)
     else:
@@ -168,7 +189,7 @@ def combine_value(tokens, variables):
                 val += combine_value(tok, variables)
     return ''.join(val)
 
-def eval_bashvar_literal(source):
+def _eval_pyparsing(source):
     parsed = bashvarfile.parseString(source, parseAll=True)
     variables = collections.OrderedDict()
     for line in parsed:
@@ -179,12 +200,348 @@ def eval_bashvar_literal(source):
         variables[line['varname']] = val
     return variables
 
+class BashVarLexer:
+    """
+    Single-pass tokenizer and evaluator for the subset of bash accepted by
+    the `bashvarfile` grammar, giving the same results.
+    Raises ParseError where the grammar raises ParseException.
+    """
+    re_spaces = re.compile(r'[ \t]*')
+    re_varname = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+    re_plain = re.compile(
+        r'''[^~{}()$'"`\\*?\[\] \t\n][^{}()$'"`\\*?\[\] \t\n]*''')
+    re_dqchars = re.compile(r'[^$`\\*"]+')
+    re_substsafe = re.compile(r'''[^/#%\[}'"`\\]+''')
+    re_offset = re.compile(r'[0-9]+|[ \t]+(-[0-9]+)')
+    re_integer = re.compile(r'-?[0-9]+')
+
+    def __init__(self, source):
+        # pyparsing expands tabs before parsing
+        self.text = source.expandtabs()
+        self.variables = collections.OrderedDict()
+        self.undefined = []
+
+    def parse(self):
+        text = self.text
+        pos = 0
+        while pos <= len(text):
+            undefined = []
+            result = self.parse_line(pos, undefined)
+            if result is None:
+                # trailing whitespace is allowed after the last valid line
+                if text[pos:].strip(' \t\r\n'):
+                    raise ParseError('unsupported syntax at line %d' % (
+                        text.count('\n', 0, pos) + 1))
+                break
+            pos, assignment = result
+            # only report undefined variables of lines that parse
+            self.undefined.extend(undefined)
+            if assignment:
+                self.variables[assignment[0]] = assignment[1]
+        for varname in self.undefined:
+            warnings.warn('variable "%s" is undefined' % varname,
+                          VariableWarning)
+        return self.variables
+
+    def parse_line(self, pos, undefined):
+        text = self.text
+        pos = self.re_spaces.match(text, pos).end()
+        assignment = None
+        match = self.re_varname.match(text, pos)
+        if match and text.startswith('=', match.end()):
+            value, pos = self.parse_value(match.end() + 1, undefined)
+            assignment = (match.group(), value)
+            pos = self.re_spaces.match(text, pos).end()
+        if text.startswith('#', pos):
+            pos = text.find('\n', pos)
+            if pos == -1:
+                pos = len(text)
+        if pos == len(text) or text[pos] == '\n':
+            return pos + 1, assignment
+        return None
+
+    def parse_value(self, pos, undefined):
+        text = self.text
+        parts = []
+        while pos < len(text):
+            char = text[pos]
+            if char == "'":
+                end = text.find("'", pos + 1)
+                if end == -1:
+                    break
+                parts.append(text[pos+1:end])
+                pos = end + 1
+                continue
+            elif char == '"':
+                result = self.parse_doublequote(pos, undefined)
+            elif char == '$':
+                result = self.parse_expansion(pos, undefined)
+            else:
+                match = self.re_plain.match(text, pos)
+                result = match and (match.group(), match.end())
+            if not result:
+                break
+            value, pos = result
+            parts.append(value)
+        return ''.join(parts), pos
+
+    def parse_doublequote(self, pos, undefined):
+        text = self.text
+        parts = []
+        pos += 1
+        while pos < len(text):
+            char = text[pos]
+            if char == '\\':
+                escaped = text[pos+1:pos+2]
+                if escaped and escaped in '$`"\\':
+                    parts.append(escaped)
+                elif escaped != '\n':
+                    break
+                pos += 2
+                continue
+            elif char == '$':
+                result = self.parse_expansion(pos, undefined)
+            else:
+                match = self.re_dqchars.match(text, pos)
+                result = match and (match.group(), match.end())
+            if not result:
+                break
+            value, pos = result
+            parts.append(value)
+        if not text.startswith('"', pos):
+            return None
+        return ''.join(parts), pos + 1
+
+    def parse_expansion(self, pos, undefined):
+        text = self.text
+        pos += 1
+        if not text.startswith('{', pos):
+            match = self.re_varname.match(text, pos)
+            if not match:
+                return None
+            return self.expand(match.group(), undefined), match.end()
+        match = self.re_varname.match(text, pos + 1)
+        if not match:
+            return None
+        varname = match.group()
+        pos = match.end()
+        params = None
+        char = text[pos:pos+1]
+        if char == ':':
+            match = self.re_offset.match(text, pos + 1)
+            if match:
+                offset = match.group(1) or match.group()
+                length = None
+                pos = match.end()
+                if text.startswith(':', pos):
+                    match = self.re_integer.match(text, pos + 1)
+                    if match:
+                        length = match.group()
+                        pos = match.end()
+                params = (':', offset, length)
+        elif char == '/':
+            exptype = '//' if text.startswith('//', pos) else '/'
+            pos += len(exptype)
+            pattern = string = ''
+            match = self.re_substsafe.match(text, pos)
+            if match:
+                pattern = match.group()
+                pos = match.end()
+                if text.startswith('/', pos):
+                    pos += 1
+                    match = self.re_substsafe.match(text, pos)
+                    if match:
+                        string = match.group()
+                        pos = match.end()
+            params = (exptype, None, None, pattern, string)
+        elif char in ('#', '%'):
+            exptype = char * 2 if text.startswith(char * 2, pos) else char
+            pos += len(exptype)
+            pattern = ''
+            match = self.re_substsafe.match(text, pos)
+            if match:
+                pattern = match.group()
+                pos = match.end()
+            params = (exptype, None, None, pattern)
+        if not text.startswith('}', pos):
+            return None
+        return self.expand(varname, undefined, params), pos + 1
+
+    def expand(self, varname, undefined, params=None):
+        if varname not in self.variables:
+            undefined.append(varname)
+            return ''
+        elif params is None:
+            return self.variables[varname]
+        return expand_param(self.variables[varname], *params)
+
+def _eval_lexer(source):
+    return BashVarLexer(source).parse()
+
+LITERAL_ENGINES = {
+    'lexer': _eval_lexer,
+    'pyparsing': _eval_pyparsing,
+}
+
+def eval_bashvar_literal(source, engine='lexer'):
+    """
+    Evaluate variable assignments without running bash.
+    engine is one of LITERAL_ENGINES.
+    Raises ParseError or ParseException on unsupported syntax.
+    """
+    return LITERAL_ENGINES[engine](source)
+
 def uniq(seq):  # Dave Kirby
     # Order preserving
     seen = set()
     return [x for x in seq if x not in seen and not seen.add(x)]
 
-def eval_bashvar_ext(source, filename=None):
+class BashWorker:
+    """
+    A bash coprocess passing scripts to a restricted bash on stdin, so that
+    they run like with `bash -r`: an error only stops the command it's in,
+    where a subshell would exit.
+
+    Request: "<length>\n<script>" on stdin.
+    Response: the stdout of the script, "\n<token>\n<length>\n" and the
+    stderr of the script on stdout.
+    """
+    # the stderr of the script goes to a file ($2) instead of a command
+    # substitution, to save a fork per request; the here-string adds back
+    # the last newline
+    driver = (
+        "__nl=$'\\n'; "
+        # so that the bash of the script has SHLVL=1, as with bash -r
+        'unset SHLVL; '
+        'while IFS= read -r __n; do '
+        'IFS= read -r -N "$__n" __src; '
+        '(exec -a bash "$BASH" -r) <<<"${__src%"$__nl"}" 2>"$2"; '
+        "IFS= read -r -d '' __err <\"$2\"; "
+        "printf '\\n%s\\n%d\\n%s' \"$1\" \"${#__err}\" \"$__err\"; "
+        'done')
+
+    def __init__(self, cwd):
+        self.token = secrets.token_hex(16).encode('ascii')
+        self.requests = 0
+        # not in cwd, where the script could see it
+        self.errfile = tempfile.NamedTemporaryFile(prefix='bashworker-')
+        # the environment is empty (C locale), so lengths are in bytes
+        self.proc = subprocess.Popen(
+            ('bash', '--norc', '--noprofile', '-c', self.driver, 'bash',
+             self.token, self.errfile.name), cwd=cwd, env={},
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL)
+
+    def run(self, script, timeout=None):
+        """
+        Run the script (bytes), returns (stdout, stderr).
+        Raises TimeoutError if it doesn't finish in time.
+        """
+        self.requests += 1
+        self.proc.stdin.write(b'%d\n' % len(script) + script)
+        self.proc.stdin.flush()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        marker = b'\n' + self.token + b'\n'
+        buf = b''
+        while True:
+            pos = buf.find(marker)
+            if pos != -1:
+                header = buf.find(b'\n', pos + len(marker))
+                if header != -1:
+                    errlen = int(buf[pos+len(marker):header])
+                    if len(buf) >= header + 1 + errlen:
+                        return buf[:pos], buf[header+1:header+1+errlen]
+            buf += self._read(deadline)
+
+    def _read(self, deadline):
+        fd = self.proc.stdout.fileno()
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select((fd,), (), (), remaining)[0]:
+                raise TimeoutError('bash timed out')
+        data = os.read(fd, 65536)
+        if not data:
+            raise BrokenPipeError('bash exited unexpectedly')
+        return data
+
+    def close(self):
+        if self.proc.poll() is None:
+            self.proc.kill()
+        self.proc.stdin.close()
+        self.proc.stdout.close()
+        self.proc.wait()
+        self.errfile.close()
+
+class BashPool:
+    """
+    A pool of persistent bash coprocesses for eval_bashvar_ext, avoiding
+    starting a process and creating a directory from Python for every file.
+    Each script runs in a new bash, so no variables are kept between
+    requests. A worker is replaced after max_requests scripts, or when a
+    script runs longer than timeout seconds.
+    """
+    def __init__(self, size=1, max_requests=1000, timeout=60):
+        self.size = size
+        self.max_requests = max_requests
+        self.timeout = timeout
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.idle = queue.LifoQueue()
+        self.workers = 0
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _acquire(self):
+        with self.lock:
+            if self.idle.empty() and self.workers < self.size:
+                self.workers += 1
+                return BashWorker(self.tmpdir.name)
+        return self.idle.get()
+
+    def _release(self, worker, retire=False):
+        if retire or worker.requests >= self.max_requests:
+            worker.close()
+            with self.lock:
+                self.workers -= 1
+            # wake up a waiting thread, if any
+            self.idle.put(BashWorker(self.tmpdir.name))
+            with self.lock:
+                self.workers += 1
+        else:
+            self.idle.put(worker)
+
+    def run(self, script):
+        """
+        Run the script (bytes), returns (stdout, stderr) as bytes.
+        Raises BashPoolError if the worker times out or dies.
+        """
+        worker = self._acquire()
+        try:
+            result = worker.run(script, self.timeout)
+        except (TimeoutError, OSError) as ex:
+            self._release(worker, True)
+            raise BashPoolError(str(ex)) from ex
+        except BaseException:
+            self._release(worker, True)
+            raise
+        self._release(worker)
+        return result
+
+    def close(self):
+        while True:
+            try:
+                worker = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            worker.close()
+        self.workers = 0
+        self.tmpdir.cleanup()
+
+def eval_bashvar_ext(source, filename=None, pool=None):
     # we don't specify encoding here because the env will do.
     var = []
     stdin = []
@@ -198,11 +555,15 @@ def eval_bashvar_ext(source, filename=None):
     for v in var:
         # workaround variables containing newlines
         stdin.append('echo "${%s//$\'\\n\'/\\\\n}"\n' % v)
-    with tempfile.TemporaryDirectory() as tmpdir:
-        outs, errs = subprocess.Popen(
-            ('bash', '-r'), cwd=tmpdir, env={},
-            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE).communicate(''.join(stdin).encode('utf-8'))
+    script = ''.join(stdin).encode('utf-8')
+    if pool is not None:
+        outs, errs = pool.run(script)
+    else:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            outs, errs = subprocess.Popen(
+                ('bash', '-r'), cwd=tmpdir, env={},
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE).communicate(script)
     if errs:
         warnings.warn(errs.decode('utf-8', 'backslashreplace').rstrip(),
             BashErrorWarning)
@@ -211,24 +572,120 @@ def eval_bashvar_ext(source, filename=None):
         warnings.warn('bash output not expected', BashErrorWarning)
     return collections.OrderedDict(zip(var, lines))
 
-def eval_bashvar(source, filename=None, msg=False):
+def eval_bashvar(source, filename=None, msg=False, cache=None, pool=None):
+    if cache is not None:
+        key = cache.key(source)
+        cached = cache.get(key)
+        if cached is not None:
+            ret, err, logs = cached
+            # the messages of the file are logged as if it was parsed again
+            for level, message in logs:
+                logging.log(level, '%s: %s', filename, message)
+            return (ret, err) if msg else ret
+    cacheable = True
     with warnings.catch_warnings(record=True) as wns:
         try:
             ret = eval_bashvar_literal(source)
-        except pp.ParseException:
-            ret = eval_bashvar_ext(source)
+        except (ParseError, pp.ParseException):
+            try:
+                ret = eval_bashvar_ext(source, filename, pool)
+            except BashPoolError as ex:
+                # not the result of the file, don't cache it
+                cacheable = False
+                ret = collections.OrderedDict()
+                warnings.warn(str(ex), BashErrorWarning)
         msgs = []
+        logs = []
         for w in wns:
             if issubclass(w.category, VariableWarning):
-                logging.warning('%s: %s', filename, w.message)
+                logs.append((logging.WARNING, str(w.message)))
             elif issubclass(w.category, BashErrorWarning):
                 msgs.append(str(w.message))
-                logging.error('%s: %s', filename, w.message)
-        if msg:
-            return ret, '\n'.join(msgs) if msgs else None
-        else:
-            return ret
+                logs.append((logging.ERROR, str(w.message)))
+        for level, message in logs:
+            logging.log(level, '%s: %s', filename, message)
+    err = '\n'.join(msgs) if msgs else None
+    if cache is not None and cacheable:
+        cache.put(key, ret, err, logs)
+    if msg:
+        return ret, err
+    else:
+        return ret
 
-def read_bashvar(fp, filename=None, msg=False):
+def read_bashvar(fp, filename=None, msg=False, cache=None, pool=None):
     return eval_bashvar(
-        fp.read(), filename or getattr(fp, 'name', None), msg)
+        fp.read(), filename or getattr(fp, 'name', None), msg, cache, pool)
+
+class ParseCache:
+    """
+    Persistent cache of evaluated variables, error messages and the
+    messages logged for the file, keyed by the hash of the file content.
+    Entries not used for the longest time are evicted when there are more
+    than max_entries.
+    """
+    # bump this when the evaluation results change
+    version = 1
+
+    def __init__(self, filename, max_entries=100000):
+        self.filename = filename
+        self.max_entries = max_entries
+        # several parser processes may share the file
+        self.db = sqlite3.connect(filename, timeout=60, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        columns = [row[1] for row in self.db.execute(
+            'PRAGMA table_info(bashvar_cache)')]
+        if columns and 'logs' not in columns:
+            # from a version without the logged messages
+            self.db.execute('DROP TABLE IF EXISTS bashvar_cache')
+        self.db.execute('CREATE TABLE IF NOT EXISTS bashvar_cache ('
+                        'hash TEXT PRIMARY KEY,'
+                        'variables TEXT,'  # JSON list of [name, value]
+                        'err TEXT,'
+                        'logs TEXT,'  # JSON list of [level, message]
+                        'atime INTEGER'
+                        ')')
+        self.db.execute('CREATE INDEX IF NOT EXISTS idx_bashvar_cache_atime'
+                        ' ON bashvar_cache (atime)')
+        self.atime = int(time.time())
+        self.hits = self.misses = 0
+
+    @classmethod
+    def key(cls, source):
+        return hashlib.blake2b(
+            source.encode('utf-8'), digest_size=20,
+            person=b'bashvar-%d' % cls.version).hexdigest()
+
+    def get(self, key):
+        """
+        Returns (variables, err, logs) as passed to put(), or None.
+        """
+        row = self.db.execute(
+            'SELECT variables, err, logs, atime FROM bashvar_cache '
+            'WHERE hash=?', (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        if row[3] != self.atime:
+            self.db.execute('UPDATE bashvar_cache SET atime=? WHERE hash=?',
+                            (self.atime, key))
+        return (collections.OrderedDict(json.loads(row[0])), row[1],
+                [tuple(item) for item in json.loads(row[2])])
+
+    def put(self, key, variables, err, logs=()):
+        """
+        logs: [(logging level, message)] logged for the file
+        """
+        self.db.execute('REPLACE INTO bashvar_cache VALUES (?,?,?,?,?)', (
+            key, json.dumps(list(variables.items())), err,
+            json.dumps(list(logs)), self.atime))
+
+    def prune(self):
+        self.db.execute(
+            'DELETE FROM bashvar_cache WHERE hash IN ('
+            ' SELECT hash FROM bashvar_cache'
+            ' ORDER BY atime DESC LIMIT -1 OFFSET ?)', (self.max_entries,))
+
+    def close(self):
+        self.db.close()
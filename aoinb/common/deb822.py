@@ -230,6 +230,7 @@ except ImportError:
 
 import datetime
 import email.utils
+import functools
 import io
 import re
 import subprocess
@@ -1329,84 +1330,136 @@ class PkgRelation(object):
     BuildRestriction = collections.namedtuple('BuildRestriction',
                                               ['enabled', 'profile'])
 
-    @classmethod
-    def parse_relations(cls, raw):
-        # type: (str) -> List[List[Dict[str, Optional[Union[str, list, Tuple[str, str]]]]]]
-        """Parse a package relationship string (i.e. the value of a field like
-        Depends, Recommends, Build-Depends ...)
+    Relation = collections.namedtuple('Relation', [
+        'name', 'archqual', 'version', 'arch', 'restrictions'])
+
+    class UnparsedRelation(Relation):
+        """A relationship that cannot be parsed, with the raw text as name"""
+        __slots__ = ()
+
+    @staticmethod
+    def _parse_archs(raw):
+        # type: (str) -> Tuple[PkgRelation.ArchRestriction, ...]
+        # assumption: no space between '!' and architecture name
+        archs = []
+        for arch in PkgRelation.__blank_sep_RE.split(raw.strip()):
+            disabled = arch[0] == '!'
+            if disabled:
+                arch = arch[1:]
+            archs.append(PkgRelation.ArchRestriction(not disabled, arch))
+        return tuple(archs)
+
+    @staticmethod
+    def _parse_restrictions(raw):
+        # type: (str) -> Tuple[Tuple[PkgRelation.BuildRestriction, ...], ...]
+        """ split a restriction formula into a tuple of restriction tuples
+
+        Each term in the restriction tuple is a namedtuple of form:
+
+            (enabled, label)
+
+        where
+            enabled: bool: whether the restriction is positive or negative
+            profile: the profile name of the term e.g. 'stage1'
+        """
+        restrictions = []
+        groups = PkgRelation.__restriction_sep_RE.split(
+            raw.lower().strip('<> '))
+        for rgrp in groups:
+            group = []
+            for restriction in PkgRelation.__blank_sep_RE.split(rgrp):
+                match = PkgRelation.__restriction_RE.match(restriction)
+                if match:
+                    parts = match.groupdict()
+                    group.append(
+                        PkgRelation.BuildRestriction(
+                            parts['enabled'] != '!',
+                            parts['profile'],
+                        ))
+            restrictions.append(tuple(group))
+        return tuple(restrictions)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=32768)
+    def parse_relation(raw):
+        # type: (str) -> PkgRelation.Relation
+        """Parse one alternative of a package relationship, like
+        ``libc6 (>= 2.27)``.
+
+        Results are cached and shared: they are immutable, and the strings in
+        them are interned.
+        """
+        match = PkgRelation.__dep_RE.match(raw)
+        if match:
+            name, archqual, relop, version, archs, restrictions = match.group(
+                'name', 'archqual', 'relop', 'version', 'archs',
+                'restrictions')
+            return PkgRelation.Relation(
+                sys.intern(name),
+                archqual and sys.intern(archqual),
+                (sys.intern(relop), sys.intern(version))
+                if relop or version else None,
+                archs and PkgRelation._parse_archs(archs),
+                restrictions and PkgRelation._parse_restrictions(restrictions),
+            )
+
+        warnings.warn(
+            'cannot parse package'
+            ' relationship "%s", returning it raw' % raw)
+        return PkgRelation.UnparsedRelation(raw, None, None, None, None)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=16384)
+    def parse_relations_cached(raw):
+        # type: (str) -> Tuple[Tuple[PkgRelation.Relation, ...], ...]
+        """Parse a package relationship string like :func:`parse_relations`,
+        into a tuple of tuples of :class:`PkgRelation.Relation`.
+
+        Results are cached and shared, both for the whole string and for
+        each alternative, so they are immutable.
         """
-        def parse_archs(raw):
-            # type: (str) -> List[PkgRelation.ArchRestriction]
-            # assumption: no space between '!' and architecture name
-            archs = []
-            for arch in cls.__blank_sep_RE.split(raw.strip()):
-                disabled = arch[0] == '!'
-                if disabled:
-                    arch = arch[1:]
-                archs.append(cls.ArchRestriction(not disabled, arch))
-            return archs
-
-        def parse_restrictions(raw):
-            # type: (str) -> List[List[PkgRelation.BuildRestriction]]
-            """ split a restriction formula into a list of restriction lists
-
-            Each term in the restriction list is a namedtuple of form:
-
-                (enabled, label)
-
-            where
-                enabled: bool: whether the restriction is positive or negative
-                profile: the profile name of the term e.g. 'stage1'
-            """
-            restrictions = []
-            groups = cls.__restriction_sep_RE.split(raw.lower().strip('<> '))
-            for rgrp in groups:
-                group = []
-                for restriction in cls.__blank_sep_RE.split(rgrp):
-                    match = cls.__restriction_RE.match(restriction)
-                    if match:
-                        parts = match.groupdict()
-                        group.append(
-                            cls.BuildRestriction(
-                                parts['enabled'] != '!',
-                                parts['profile'],
-                            ))
-                restrictions.append(group)
-            return restrictions
-
-        def parse_rel(raw):
-            # type: (str) -> Dict[str, Optional[Union[str, list, Tuple[str, str]]]]
-            match = cls.__dep_RE.match(raw)
-            if match:
-                parts = match.groupdict()
-                d = {
-                    'name': parts['name'],
-                    'archqual': parts['archqual'],
-                    'version': None,
-                    'arch': None,
-                    'restrictions': None,
-                }  # type: Dict[str, Optional[Union[str, list, Tuple[str, str]]]]
-                if parts['relop'] or parts['version']:
-                    d['version'] = (parts['relop'], parts['version'])
-                if parts['archs']:
-                    d['arch'] = parse_archs(parts['archs'])
-                if parts['restrictions']:
-                    d['restrictions'] = parse_restrictions(
-                        parts['restrictions'])
-                return d
-
-            warnings.warn(
-                'cannot parse package'
-                ' relationship "%s", returning it raw' % raw)
+        # the same as splitting with __comma_sep_RE and __pipe_sep_RE
+        parse_relation = PkgRelation.parse_relation
+        rels = []
+        for tl_dep in raw.split(','):   # top-level deps
+            tl_dep = tl_dep.strip()
+            if '|' in tl_dep:
+                rels.append(tuple([parse_relation(or_dep.strip())
+                                   for or_dep in tl_dep.split('|')]))
+            else:
+                rels.append((parse_relation(tl_dep),))
+        return tuple(rels)
+
+    @staticmethod
+    def relation_dict(rel):
+        # type: (PkgRelation.Relation) -> Dict[str, Optional[Union[str, list, Tuple[str, str]]]]
+        """Give a :class:`PkgRelation.Relation` as the dictionary used by
+        :func:`parse_relations`."""
+        if isinstance(rel, PkgRelation.UnparsedRelation):
             return {
-                'name': raw,
+                'name': rel.name,
                 'version': None,
                 'arch': None
             }
+        d = dict(zip(rel._fields, rel))
+        if rel.arch is not None:
+            d['arch'] = list(rel.arch)
+        if rel.restrictions is not None:
+            d['restrictions'] = [list(group) for group in rel.restrictions]
+        return d
+
+    @classmethod
+    def parse_relations(cls, raw):
+        # type: (str) -> List[List[Dict[str, Optional[Union[str, list, Tuple[str, str]]]]]]
+        """Parse a package relationship string (i.e. the value of a field like
+        Depends, Recommends, Build-Depends ...)
 
-        tl_deps = cls.__comma_sep_RE.split(raw.strip())   # top-level deps
-        cnf = map(cls.__pipe_sep_RE.split, tl_deps)
-        return [[parse_rel(or_dep) for or_dep in or_deps] for or_deps in cnf]
+        The result is built from :func:`parse_relations_cached`, and can be
+        modified by the caller.
+        """
+        relation_dict = cls.relation_dict
+        return [[relation_dict(rel) for rel in or_deps]
+                for or_deps in cls.parse_relations_cached(raw)]
 
     @staticmethod
     def str(rels):
@@ -1973,6 +2026,80 @@ class Packages(Deb822, _PkgRelationMixin, _VersionAccessorMixin):
             sequence, fields, use_apt_pkg, shared_storage, encoding, strict)
 
 
+# paragraphs are separated by empty lines, like
+# 'whitespace-separates-paragraphs': False
+_index_separator = re.compile(br'\n(?:\r*\n)+')
+_index_field = re.compile(br'^([^:\s]+)[ \t]*:(.*(?:\n[ \t].*)*)', re.M)
+
+
+def _index_value(value, encoding):
+    # type: (bytes, str) -> str
+    """Give the value of a field the same way as Deb822 does."""
+    first, newline, rest = value.partition(b'\n')
+    value = first.strip()
+    if newline:
+        if b'\r' in rest:
+            rest = b'\n'.join(line.rstrip(b'\r') for line in rest.split(b'\n'))
+        value += b'\n' + rest
+    try:
+        return value.decode(encoding)
+    except UnicodeDecodeError:
+        return _AutoDecoder(encoding).decode(value)
+
+
+def iter_index_fields(sequence,         # type: Iterable[bytes]
+                      fields,           # type: List[str]
+                      encoding="utf-8", # type: str
+                     ):
+    # type: (...) -> Iterator[Tuple[Optional[str], ...]]
+    """Generator that yields a tuple of the values of fields for each
+    paragraph in a Packages or Sources index.
+
+    This is a fast path for large index files: paragraphs are split on empty
+    lines over bytes, only the given fields are decoded, and no Deb822 object
+    is created. The values are the same as those of
+    :func:`Packages.iter_paragraphs`.
+
+    :param sequence: iterable of bytes, split at any position, e.g. chunks
+        of a decompressed file, or a file opened in binary mode.
+    :param fields: names of the fields, case-insensitive. The value of a
+        field the paragraph doesn't have is None.
+    :param encoding: Interpret the values in this encoding.
+
+    Unlike :func:`Deb822.iter_paragraphs`, comment lines and PGP signatures
+    are not supported, since indexes don't have them.
+    """
+    wanted = dict((field.lower().encode('ascii'), i)
+                  for i, field in enumerate(fields))
+    count = len(fields)
+
+    def parse(paragraph):
+        # type: (bytes) -> Optional[Tuple[Optional[str], ...]]
+        values = [None] * count    # type: List[Any]
+        found = False
+        for key, value in _index_field.findall(paragraph):
+            found = True
+            i = wanted.get(key.lower())
+            if i is not None:
+                values[i] = value
+        if not found:
+            return None
+        return tuple(None if value is None else _index_value(value, encoding)
+                     for value in values)
+
+    rest = b''
+    for chunk in sequence:
+        paragraphs = _index_separator.split(rest + chunk)
+        rest = paragraphs.pop()
+        for paragraph in paragraphs:
+            result = parse(paragraph)
+            if result is not None:
+                yield result
+    result = parse(rest)
+    if result is not None:
+        yield result
+
+
 class _ClassInitMeta(type):
     """Metaclass for classes that can be initialized at creation time.
 
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Transitive PKGDEP/BUILDDEP closure of packages in an abbs meta database.
+
+The closure is kept in package_deps_all. The direct dependencies it was
+computed from (with PKGPROV resolved) are kept in package_deps_direct, so
+that an update only recomputes packages which can reach a package whose
+direct dependencies changed.
+"""
+
+import sqlite3
+import logging
+import argparse
+import collections
+
+logger = logging.getLogger('depgraph')
+
+relationships = ('PKGDEP', 'BUILDDEP')
+
+
+def iter_bits(bitset):
+    while bitset:
+        lowest = bitset & -bitset
+        yield lowest.bit_length() - 1
+        bitset ^= lowest
+
+
+class DependencyGraph:
+    """
+    Dependency graph with packages (and unknown dependency names) numbered
+    by integers, and the closure as bitsets of those numbers.
+    """
+    def __init__(self):
+        # id -> name
+        self.names = []
+        # name -> id
+        self.ids = {}
+        # id -> set of ids
+        self.edges = []
+
+    def __len__(self):
+        return len(self.names)
+
+    def node(self, name):
+        nid = self.ids.get(name)
+        if nid is None:
+            nid = self.ids[name] = len(self.names)
+            self.names.append(name)
+            self.edges.append(set())
+        return nid
+
+    def add_edge(self, package, dependency):
+        self.edges[self.node(package)].add(self.node(dependency))
+
+    @classmethod
+    def from_db(cls, db):
+        """
+        Load architecture-independent PKGDEP and BUILDDEP relations.
+        A dependency provided by packages with PKGPROV is replaced by the
+        providers.
+        """
+        graph = cls()
+        providers = collections.defaultdict(list)
+        relations = []
+        for package, dependency, architecture, relationship in db.execute(
+            'SELECT package, dependency, architecture, relationship '
+            'FROM package_dependencies '
+            "WHERE relationship='PKGPROV' OR (architecture='' "
+            'AND relationship IN (%s))' % ','.join('?' * len(relationships)),
+            relationships):
+            if relationship == 'PKGPROV':
+                providers[dependency].append(package)
+            if architecture == '' and relationship in relationships:
+                relations.append((package, dependency))
+        for package, dependency in relations:
+            for provider in providers.get(dependency, (dependency,)):
+                graph.add_edge(package, provider)
+        return graph
+
+    def direct_dependencies(self):
+        """
+        Returns {package: frozenset of dependency names}.
+        """
+        return {self.names[nid]: frozenset(self.names[d] for d in deps)
+                for nid, deps in enumerate(self.edges) if deps}
+
+    def reverse_cone(self, nodes):
+        """
+        Returns ids of nodes reaching any of the nodes, including themselves.
+        """
+        reverse = [[] for i in range(len(self.names))]
+        for nid, deps in enumerate(self.edges):
+            for dep in deps:
+                reverse[dep].append(nid)
+        cone = set(nodes)
+        stack = list(cone)
+        while stack:
+            for nid in reverse[stack.pop()]:
+                if nid not in cone:
+                    cone.add(nid)
+                    stack.append(nid)
+        return cone
+
+    def sccs(self, nodes):
+        """
+        Strongly connected components of the subgraph induced by nodes,
+        each component after all components it reaches (Tarjan's algorithm).
+        """
+        index = {}
+        lowlink = {}
+        onstack = set()
+        stack = []
+        result = []
+        for root in nodes:
+            if root in index:
+                continue
+            index[root] = lowlink[root] = len(index)
+            stack.append(root)
+            onstack.add(root)
+            work = [(root, iter(self.edges[root]))]
+            while work:
+                nid, it = work[-1]
+                for dep in it:
+                    if dep not in nodes:
+                        continue
+                    if dep not in index:
+                        index[dep] = lowlink[dep] = len(index)
+                        stack.append(dep)
+                        onstack.add(dep)
+                        work.append((dep, iter(self.edges[dep])))
+                        break
+                    elif dep in onstack:
+                        lowlink[nid] = min(lowlink[nid], index[dep])
+                else:
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        lowlink[parent] = min(lowlink[parent], lowlink[nid])
+                    if lowlink[nid] == index[nid]:
+                        component = []
+                        while True:
+                            member = stack.pop()
+                            onstack.discard(member)
+                            component.append(member)
+                            if member == nid:
+                                break
+                        result.append(component)
+        return result
+
+    def closure(self, nodes, known=None):
+        """
+        Compute the closure of nodes, the set of nodes reachable by one or
+        more edges, as {id: bitset}.
+        known gives the closure of the other nodes the nodes depend on.
+        """
+        known = known or {}
+        result = {}
+        for component in self.sccs(nodes):
+            bits = 0
+            members = 0
+            for nid in component:
+                members |= 1 << nid
+                for dep in self.edges[nid]:
+                    bits |= (1 << dep) | result.get(dep, 0) | known.get(dep, 0)
+            if len(component) > 1 or bits & members:
+                # members of a cycle reach each other and themselves
+                bits |= members
+            for nid in component:
+                result[nid] = bits
+        return result
+
+
+def init_db(db):
+    db.execute('CREATE TABLE IF NOT EXISTS package_deps_all ('
+               'package TEXT, dependency TEXT,'
+               'PRIMARY KEY (package, dependency)'
+               ') WITHOUT ROWID')
+    db.execute('CREATE TABLE IF NOT EXISTS package_deps_direct ('
+               'package TEXT, dependency TEXT,'
+               'PRIMARY KEY (package, dependency)'
+               ') WITHOUT ROWID')
+
+
+def update_package_deps_all(db, full=False):
+    """
+    Update package_deps_all for packages whose closure may have changed
+    since the last update, or for all packages if full is set.
+    Returns the number of packages recomputed.
+    """
+    init_db(db)
+    cur = db.cursor()
+    graph = DependencyGraph.from_db(db)
+    direct = graph.direct_dependencies()
+    if full:
+        cur.execute('DELETE FROM package_deps_all')
+        cur.execute('DELETE FROM package_deps_direct')
+    last = collections.defaultdict(set)
+    for package, dependency in cur.execute(
+        'SELECT package, dependency FROM package_deps_direct'):
+        last[package].add(dependency)
+    changed = [package for package in set(last).union(direct)
+               if last.get(package, frozenset()) != direct.get(
+                   package, frozenset())]
+    if not changed:
+        return 0
+    cone = graph.reverse_cone([graph.node(package) for package in changed])
+    names = graph.names
+
+    def load_closure(nid):
+        bits = 0
+        for row in cur.execute(
+            'SELECT dependency FROM package_deps_all WHERE package=?',
+            (names[nid],)):
+            bits |= 1 << graph.node(row[0])
+        return bits
+
+    # closures of other dependencies are unchanged, since they don't reach
+    # any changed package
+    known = {}
+    for nid in cone:
+        for dep in graph.edges[nid]:
+            if dep not in cone and dep not in known:
+                known[dep] = load_closure(dep)
+    closure = graph.closure(cone, known)
+    # only write the difference, in primary key order
+    deleted = []
+    inserted = []
+    for nid in sorted(cone, key=names.__getitem__):
+        last_bits = load_closure(nid)
+        bits = closure.get(nid, 0)
+        package = names[nid]
+        deleted.extend((package, dependency) for dependency in sorted(
+            names[dep] for dep in iter_bits(last_bits & ~bits)))
+        inserted.extend((package, dependency) for dependency in sorted(
+            names[dep] for dep in iter_bits(bits & ~last_bits)))
+    cur.executemany(
+        'DELETE FROM package_deps_all WHERE package=? AND dependency=?',
+        deleted)
+    cur.executemany('INSERT INTO package_deps_all VALUES (?,?)', inserted)
+    cur.executemany('DELETE FROM package_deps_direct WHERE package=?',
+                    ((package,) for package in changed))
+    cur.executemany('INSERT INTO package_deps_direct VALUES (?,?)', (
+        (package, dependency) for package in changed
+        for dependency in direct.get(package, ())))
+    logger.info('package_deps_all: %d of %d packages recomputed, '
+                '%d rows deleted, %d rows inserted', len(cone), len(direct),
+                len(deleted), len(inserted))
+    return len(cone)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Update transitive dependencies of packages in an abbs meta database.")
+    parser.add_argument("-f", "--full", help="Recompute all packages", action='store_true')
+    parser.add_argument("dbfile", help="Abbs meta database file")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format='%(asctime)s %(levelname).1s %(message)s', level=logging.INFO)
+    db = sqlite3.connect(args.dbfile)
+    update_package_deps_all(db, args.full)
+    db.commit()
+    db.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Reverse dependencies of binary packages in a dpkg repo database.
+
+Lookups use dpkg_package_relations, the parsed relations kept by dpkgrepo,
+through its index on dep_name, so that finding what depends on a package,
+what breaks if it's removed, and what needs rebuilding after it changes
+don't parse every Depends field of the repos.
+"""
+
+import sqlite3
+import logging
+import argparse
+import collections
+
+import vercomp
+
+logger = logging.getLogger('dpkgdeps')
+
+DEPENDS = ('depends', 'pre-depends')
+
+Dependency = collections.namedtuple('Dependency', (
+    'package', 'version', 'architecture', 'repo', 'relationship',
+    'alt_group', 'alt_index', 'dep_name', 'relop', 'dep_version'))
+
+Provider = collections.namedtuple('Provider', (
+    'package', 'version', 'architecture', 'repo', 'provided_version'))
+
+_relops = {
+    '<<': lambda c: c < 0,
+    '<=': lambda c: c <= 0,
+    '=': lambda c: c == 0,
+    '>=': lambda c: c >= 0,
+    '>>': lambda c: c > 0,
+    # deprecated forms, same as <= and >=
+    '<': lambda c: c <= 0,
+    '>': lambda c: c >= 0,
+}
+
+
+def satisfies(version, relop, dep_version):
+    """
+    Whether version satisfies the version restriction (relop, dep_version).
+    An unversioned restriction (relop is None) is satisfied by anything,
+    while a versioned one is never satisfied by version None (such as an
+    unversioned Provides).
+    """
+    if not relop:
+        return True
+    if version is None:
+        return False
+    return _relops[relop](vercomp.compare(version, dep_version))
+
+
+def _repo_filter(column, repos):
+    if repos is None:
+        return '', ()
+    repos = tuple(repos)
+    return ' AND %s IN (%s)' % (column, ','.join('?' * len(repos))), repos
+
+
+def providers(db, name, repos=None):
+    """
+    Packages in repos (all repos if None) which are or provide name.
+    provided_version is the version of the package itself, or of a
+    versioned Provides.
+    """
+    where, params = _repo_filter('repo', repos)
+    result = [Provider(*row, row[1]) for row in db.execute(
+        'SELECT package, version, architecture, repo FROM dpkg_packages '
+        'WHERE package=?' + where, (name,) + params)]
+    for package, version, architecture, repo, relop, dep_version in db.execute(
+        'SELECT package, version, architecture, repo, relop, dep_version '
+        "FROM dpkg_package_relations WHERE dep_name=? "
+        "AND relationship='provides'" + where, (name,) + params):
+        result.append(Provider(package, version, architecture, repo,
+                               dep_version if relop == '=' else None))
+    return result
+
+
+def reverse_dependencies(db, name, repos=None, relationships=DEPENDS,
+                         version=None):
+    """
+    Relations of packages in repos (all repos if None) on name, as
+    Dependency tuples.
+    If version is given, only the relations it satisfies are returned.
+    """
+    where, params = _repo_filter('repo', repos)
+    relationships = tuple(relationships)
+    result = []
+    for row in db.execute(
+        'SELECT * FROM dpkg_package_relations WHERE dep_name=?' + where +
+        ' AND relationship IN (%s)' % ','.join('?' * len(relationships)),
+        (name,) + params + relationships):
+        dep = Dependency(*row)
+        if version is None or satisfies(version, dep.relop, dep.dep_version):
+            result.append(dep)
+    return result
+
+
+def removal_impact(db, package, repos=None, relationships=DEPENDS):
+    """
+    Relations which can't be satisfied any more if package is removed from
+    repos (all repos if None), as {(package, version, architecture, repo):
+    [Dependency, ...]}, one Dependency per broken alternative group.
+    Alternatives are only resolved in the same repos.
+    """
+    removed = set(
+        (p.package, p.version, p.architecture, p.repo)
+        for p in providers(db, package, repos) if p.package == package)
+    if not removed:
+        return {}
+    names = {package}
+    where, params = _repo_filter('repo', repos)
+    for row in db.execute(
+        'SELECT dep_name FROM dpkg_package_relations '
+        "WHERE package=? AND relationship='provides'" + where,
+        (package,) + params):
+        names.add(row[0])
+    groups = {}
+    for name in sorted(names):
+        for dep in reverse_dependencies(db, name, repos, relationships):
+            if dep.package != package:
+                groups.setdefault(dep[:6], dep)
+    provider_cache = {}
+    result = {}
+    for key, dep in sorted(groups.items()):
+        alternatives = db.execute(
+            'SELECT dep_name, relop, dep_version FROM dpkg_package_relations '
+            'WHERE package=? AND version=? AND architecture=? AND repo=? '
+            'AND relationship=? AND alt_group=?', key).fetchall()
+        for dep_name, relop, dep_version in alternatives:
+            found = provider_cache.get(dep_name)
+            if found is None:
+                found = provider_cache[dep_name] = providers(
+                    db, dep_name, repos)
+            if any(p[:4] not in removed and satisfies(
+                   p.provided_version, relop, dep_version) for p in found):
+                break
+        else:
+            result.setdefault(key[:4], []).append(dep)
+    return result
+
+
+def rebuild_impact(db, package, repos=None, relationships=DEPENDS):
+    """
+    Packages in repos (all repos if None) depending on package directly or
+    transitively, including through the names they provide, as
+    {package: distance}. The version restrictions are not checked.
+    """
+    where, params = _repo_filter('repo', repos)
+    relationships = tuple(relationships)
+    rel_filter = ' AND relationship IN (%s)' % ','.join(
+        '?' * len(relationships))
+    result = {package: 0}
+    queue = collections.deque((package,))
+    while queue:
+        current = queue.popleft()
+        names = [current] + [row[0] for row in db.execute(
+            'SELECT DISTINCT dep_name FROM dpkg_package_relations '
+            "WHERE package=? AND relationship='provides'" + where,
+            (current,) + params)]
+        for name in names:
+            for row in db.execute(
+                'SELECT DISTINCT package FROM dpkg_package_relations '
+                'WHERE dep_name=?' + where + rel_filter,
+                (name,) + params + relationships):
+                if row[0] not in result:
+                    result[row[0]] = result[current] + 1
+                    queue.append(row[0])
+    del result[package]
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query reverse dependencies of packages in a dpkg repo database.")
+    parser.add_argument("-r", "--repo", help="Only look in this repo, may be repeated", action='append')
+    parser.add_argument("-R", "--relationship", help="Relationships to follow, default depends and pre-depends", action='append')
+    parser.add_argument("command", choices=('rdepends', 'impact', 'rebuild'), help="rdepends: direct reverse dependencies; impact: relations broken by removing the package; rebuild: transitive reverse dependencies")
+    parser.add_argument("package", help="Package name")
+    parser.add_argument("dbfile", help="Database file")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format='%(asctime)s %(levelname).1s %(message)s', level=logging.INFO)
+    db = sqlite3.connect(args.dbfile)
+    relationships = args.relationship or DEPENDS
+    if args.command == 'rdepends':
+        for dep in reverse_dependencies(
+            db, args.package, args.repo, relationships):
+            print('%s %s %s %s: %s %s' % (
+                dep.package, dep.version, dep.architecture, dep.repo,
+                dep.relationship, dep.dep_name if not dep.relop else
+                '%s (%s %s)' % (dep.dep_name, dep.relop, dep.dep_version)))
+    elif args.command == 'impact':
+        for key, deps in removal_impact(
+            db, args.package, args.repo, relationships).items():
+            print('%s %s %s %s: %s' % (key + (', '.join(
+                '%s %s' % (dep.relationship, dep.dep_name) for dep in deps),)))
+    else:
+        for name, distance in sorted(rebuild_impact(
+            db, args.package, args.repo, relationships).items(),
+            key=lambda x: (x[1], x[0])):
+            print('%d %s' % (distance, name))
+    db.close()
+
+if __name__ == '__main__':
+    main()
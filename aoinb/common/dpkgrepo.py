@@ -20,13 +20,20 @@
 
 import os
 import lzma
+import time
+import queue
 import sqlite3
 import hashlib
 import logging
 import calendar
 import argparse
+import tempfile
+import functools
+import threading
+import contextlib
 import collections
 import urllib.parse
+import concurrent.futures
 from email.utils import parsedate
 
 try:
@@ -35,6 +42,8 @@ except ImportError:
     import requests
 
 import deb822
+import vercomp
+import repostats
 
 logging.basicConfig(
     format='%(asctime)s %(levelname).1s %(message)s', level=logging.INFO)
@@ -123,10 +132,12 @@ def init_db(db, with_stats=True):
                 'filename TEXT,'
                 'size INTEGER,'
                 'sha256 TEXT,'
+                'version_key BLOB,' # vercomp.sort_key(version)
                 # we have Section and Description in packages table
                 'PRIMARY KEY (package, version, architecture, repo)'
                 # 'FOREIGN KEY(package) REFERENCES packages(name)'
                 ')')
+    vercomp.add_key_column(cur, 'dpkg_packages')
     cur.execute('CREATE TABLE IF NOT EXISTS dpkg_package_dependencies ('
                 'package TEXT,'
                 'version TEXT,'
@@ -137,6 +148,32 @@ def init_db(db, with_stats=True):
                 'PRIMARY KEY (package, version, architecture, repo, relationship)'
                 # 'FOREIGN KEY(package) REFERENCES dpkg_packages(package)'
                 ')')
+    relations_exist = cur.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' "
+        "AND name='dpkg_package_relations'").fetchone()
+    # dpkg_package_dependencies parsed, one row for each alternative
+    cur.execute('CREATE TABLE IF NOT EXISTS dpkg_package_relations ('
+                'package TEXT,'
+                'version TEXT,'
+                'architecture TEXT,'
+                'repo TEXT,'
+                'relationship TEXT,'
+                'alt_group INTEGER,' # index in the comma-separated list
+                'alt_index INTEGER,' # index in the '|'-separated list
+                'dep_name TEXT,'
+                'relop TEXT,'        # NULL if not versioned
+                'dep_version TEXT,'
+                'PRIMARY KEY (package, version, architecture, repo, '
+                'relationship, alt_group, alt_index)'
+                ') WITHOUT ROWID')
+    if not relations_exist:
+        rows = cur.execute(
+            'SELECT package, version, architecture, repo, relationship, value '
+            'FROM dpkg_package_dependencies').fetchall()
+        cur.executemany(
+            'INSERT INTO dpkg_package_relations VALUES (?,?,?,?,?,?,?,?,?,?)',
+            (relation for row in rows for relation in _relation_rows(
+                tuple(row[:4]), {row[4]: row[5]})))
     cur.execute('CREATE TABLE IF NOT EXISTS dpkg_package_duplicate ('
                 'package TEXT,'
                 'version TEXT,'
@@ -149,6 +186,22 @@ def init_db(db, with_stats=True):
                 'sha256 TEXT,'
                 'PRIMARY KEY (repo, filename)'
                 ')')
+    # hash of the fields of dpkg_packages and dpkg_package_dependencies
+    cur.execute('CREATE TABLE IF NOT EXISTS dpkg_package_hashes ('
+                'package TEXT,'
+                'version TEXT,'
+                'architecture TEXT,'
+                'repo TEXT,'
+                'hash BLOB,'
+                'PRIMARY KEY (package, version, architecture, repo)'
+                ')')
+    # the Packages file the packages of a repo were read from
+    cur.execute('CREATE TABLE IF NOT EXISTS dpkg_repo_files ('
+                'repo TEXT PRIMARY KEY,'
+                'filename TEXT,'
+                'size INTEGER,'
+                'sha256 TEXT'
+                ')')
     if with_stats:
         cur.execute('CREATE TABLE IF NOT EXISTS dpkg_repo_stats ('
                     'repo TEXT PRIMARY KEY,'
@@ -162,7 +215,7 @@ def init_db(db, with_stats=True):
         cur.execute("DROP VIEW IF EXISTS v_dpkg_packages_new")
         cur.execute("CREATE VIEW IF NOT EXISTS v_dpkg_packages_new AS "
                     "SELECT dp.package package, "
-                    "  max(version COLLATE vercomp) dpkg_version, "
+                    "  dp.version dpkg_version, max(dp.version_key) dpkg_version_key, "
                     "  dp.repo repo, dr.realname reponame, "
                     "  dr.architecture architecture, "
                     "  dr.suite branch "
@@ -171,8 +224,14 @@ def init_db(db, with_stats=True):
                     "GROUP BY package, repo")
     cur.execute('CREATE INDEX IF NOT EXISTS idx_dpkg_repos'
                 ' ON dpkg_repos (realname)')
-    cur.execute('CREATE INDEX IF NOT EXISTS idx_dpkg_packages'
-                ' ON dpkg_packages (package, repo)')
+    cur.execute('DROP INDEX IF EXISTS idx_dpkg_packages')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_dpkg_packages_version'
+                ' ON dpkg_packages (package, repo, version_key)')
+    # reverse dependencies, see dpkgdeps
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_dpkg_package_relations_dep'
+                ' ON dpkg_package_relations (dep_name, repo)')
+    # also records changed packages
+    repostats.init_db(db)
     db.commit()
     cur.close()
 
@@ -195,46 +254,311 @@ def remove_clearsign(blob):
                 lines.append(ln)
     return b''.join(lines)
 
-def download_catalog(url, local=False, timeout=120, ignore404=False):
+class CatalogClient:
+    """
+    HTTP client shared by the download threads.
+    Concurrent downloads from a mirror (host) are limited to
+    host_limits[host], or max_connections if it's not listed.
+    A download is spooled to a temporary file (in memory up to spool_size
+    bytes) and only read after its connection is released: a thread blocked
+    on the writer must not keep the downloads of later tasks waiting, since
+    the writer may be waiting for them.
+    Plain get() requests are not limited, since they're made by the InRelease
+    threads, which the writer thread, and so the downloads, may be waiting
+    for.
+    """
+    spool_size = 16 * 1024 * 1024
+
+    def __init__(self, max_connections=4, host_limits=None):
+        self.max_connections = max_connections
+        self.host_limits = host_limits or {}
+        # and max_connections for get() from the InRelease threads
+        poolsize = max(
+            (max_connections,) + tuple(self.host_limits.values())
+        ) + max_connections
+        if requests.__name__ == 'httpx':
+            self.session = requests.Client(limits=requests.Limits(
+                max_connections=None, max_keepalive_connections=poolsize))
+        else:
+            self.session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=poolsize)
+            self.session.mount('http://', adapter)
+            self.session.mount('https://', adapter)
+        self.semaphores = {}
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _semaphore(self, url):
+        host = urllib.parse.urlsplit(url).netloc
+        with self.lock:
+            semaphore = self.semaphores.get(host)
+            if semaphore is None:
+                semaphore = self.semaphores[host] = threading.BoundedSemaphore(
+                    self.host_limits.get(host, self.max_connections))
+        return semaphore
+
+    def get(self, url, timeout=120, headers=None):
+        return self.session.get(url, timeout=timeout, headers=headers)
+
+    @contextlib.contextmanager
+    def spool(self, url, timeout=120, headers=None, cache=None,
+              chunk_size=65536):
+        """
+        Context manager giving a file with the content of url, as for
+        open_catalog.
+        """
+        with tempfile.SpooledTemporaryFile(self.spool_size) as f:
+            with self._semaphore(url), \
+                 _http_stream(self.session, url, timeout, headers) as req, \
+                 _response_body(req, url, headers, cache, chunk_size) as chunks:
+                for chunk in chunks:
+                    f.write(chunk)
+            f.seek(0)
+            yield f
+
+    def close(self):
+        self.session.close()
+
+@contextlib.contextmanager
+def _http_stream(session, url, timeout, headers=None):
+    """
+    Context manager giving the response, with the body not read yet.
+    """
+    if requests.__name__ == 'httpx':
+        with session.stream(
+            'GET', url, timeout=timeout, headers=headers) as req:
+            yield req
+    else:
+        with session.get(
+            url, timeout=timeout, headers=headers, stream=True) as req:
+            yield req
+
+def _iter_body(req, chunk_size):
+    if requests.__name__ == 'httpx':
+        return req.iter_bytes(chunk_size)
+    return req.iter_content(chunk_size)
+
+@contextlib.contextmanager
+def _response_body(req, url, headers, cache, chunk_size):
+    """
+    Context manager giving the content of a response as an iterator of
+    chunks, from the cache if the conditional request with headers found it
+    not modified, and stored in the cache otherwise.
+    """
+    if headers and req.status_code == 304:
+        with cache.open(url) as f:
+            yield iter(functools.partial(f.read, chunk_size), b'')
+        return
+    req.raise_for_status()
+    chunks = _iter_body(req, chunk_size)
+    if cache:
+        chunks = cache.store(url, req.headers, chunks)
+    yield chunks
+
+class CatalogCache:
+    """
+    Directory of downloaded catalogs, keyed by URL, for conditional requests.
+    The index (index.db) records their ETag and Last-Modified headers and
+    when they were last used. Entries not used for max_age days are removed
+    by prune().
+    """
+    def __init__(self, path, max_age=30):
+        self.path = path
+        self.max_age = max_age
+        os.makedirs(path, exist_ok=True)
+        # used by the download threads
+        self.db = sqlite3.connect(
+            os.path.join(path, 'index.db'), timeout=60,
+            isolation_level=None, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS catalog_cache ('
+                        'url TEXT PRIMARY KEY,'
+                        'filename TEXT,'
+                        'etag TEXT,'
+                        'last_modified TEXT,'
+                        'size INTEGER,'
+                        'atime INTEGER'
+                        ')')
+        self.lock = threading.Lock()
+        self.atime = int(time.time())
+        self.hits = self.misses = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @staticmethod
+    def filename(url):
+        return '%s_%s' % (hashlib.sha256(url.encode('utf-8')).hexdigest()[:32],
+                          url.rstrip('/').rsplit('/', 1)[-1])
+
+    def headers(self, url):
+        """
+        Returns headers for a conditional request of url.
+        """
+        with self.lock:
+            row = self.db.execute(
+                'SELECT filename, etag, last_modified FROM catalog_cache '
+                'WHERE url=?', (url,)).fetchone()
+        if row is None or not os.path.isfile(
+            os.path.join(self.path, row[0])):
+            return {}
+        headers = {}
+        if row[1]:
+            headers['If-None-Match'] = row[1]
+        if row[2]:
+            headers['If-Modified-Since'] = row[2]
+        return headers
+
+    def open(self, url):
+        """
+        Open the cached file of url, after a 304 Not Modified response.
+        """
+        with self.lock:
+            self.hits += 1
+            self.db.execute('UPDATE catalog_cache SET atime=? WHERE url=?',
+                            (self.atime, url))
+        return open(os.path.join(self.path, self.filename(url)), 'rb')
+
+    def store(self, url, headers, chunks):
+        """
+        Generator passing through chunks of a response with headers, which
+        are saved as the cached content of url once all of them are read.
+        """
+        filename = self.filename(url)
+        tmpname = os.path.join(
+            self.path, '%s.%d.part' % (filename, threading.get_ident()))
+        size = 0
+        try:
+            with open(tmpname, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    size += len(chunk)
+                    yield chunk
+            os.replace(tmpname, os.path.join(self.path, filename))
+            with self.lock:
+                self.misses += 1
+                self.db.execute(
+                    'REPLACE INTO catalog_cache VALUES (?,?,?,?,?,?)',
+                    (url, filename, headers.get('ETag'),
+                     headers.get('Last-Modified'), size, self.atime))
+        finally:
+            if os.path.exists(tmpname):
+                os.unlink(tmpname)
+
+    def prune(self):
+        """
+        Remove entries not used for max_age days, and files not in the index.
+        """
+        with self.lock:
+            self.db.execute('DELETE FROM catalog_cache WHERE atime<?',
+                            (self.atime - self.max_age * 86400,))
+            filenames = frozenset(row[0] for row in self.db.execute(
+                'SELECT filename FROM catalog_cache'))
+        removed = 0
+        for filename in os.listdir(self.path):
+            if filename.startswith('index.db') or filename in filenames:
+                continue
+            os.unlink(os.path.join(self.path, filename))
+            removed += 1
+        logging.info('catalog cache: %d hits, %d misses, %d files removed',
+                     self.hits, self.misses, removed)
+
+    def close(self):
+        self.db.close()
+
+def _apt_list_path(url):
+    urlsp = urllib.parse.urlsplit(url)
+    return '/var/lib/apt/lists/' + (urlsp.netloc + urlsp.path).replace('/', '_')
+
+@contextlib.contextmanager
+def open_catalog(url, local=False, timeout=120, client=None, cache=None,
+                 chunk_size=65536):
+    """
+    Context manager giving the content of url as an iterator of chunks,
+    without reading it all into memory. With a CatalogClient, the content
+    is downloaded before the first chunk (see CatalogClient).
+    With a CatalogCache, the request is conditional, and the content comes
+    from the cache if it's not modified.
+    """
+    f = None
     if local:
-        urlsp = urllib.parse.urlsplit(url)
-        filename = (urlsp.netloc + urlsp.path).replace('/', '_')
         try:
-            with open('/var/lib/apt/lists/' + filename, 'rb') as f:
+            f = open(_apt_list_path(url), 'rb')
+        except FileNotFoundError:
+            pass
+    if f is not None:
+        with f:
+            yield iter(functools.partial(f.read, chunk_size), b'')
+        return
+    headers = cache.headers(url) if cache else None
+    if client:
+        with client.spool(url, timeout, headers, cache, chunk_size) as f:
+            yield iter(functools.partial(f.read, chunk_size), b'')
+        return
+    with _http_stream(requests, url, timeout, headers) as req, \
+         _response_body(req, url, headers, cache, chunk_size) as chunks:
+        yield chunks
+
+def download_catalog(url, local=False, timeout=120, ignore404=False,
+                     client=None, cache=None):
+    if local:
+        try:
+            with open(_apt_list_path(url), 'rb') as f:
                 content = f.read()
             return content
         except FileNotFoundError:
             pass
-    req = requests.get(url, timeout=120)
+    headers = cache.headers(url) if cache else None
+    req = (client or requests).get(url, timeout=timeout, headers=headers)
     if ignore404 and req.status_code == 404:
         return None
+    if headers and req.status_code == 304:
+        with cache.open(url) as f:
+            return f.read()
     req.raise_for_status()
+    if cache:
+        for chunk in cache.store(url, req.headers, (req.content,)):
+            pass
     return req.content
 
-def suite_update(db, mirror, suite, repos=None, local=False, force=False):
+def _clear_repo(cur, repo):
     """
-    Fetch and parse InRelease file. Update relavant metadata.
-    suite: branch
-    repos: list of Repos
+    Remove the release info and packages of a repo missing from the mirror.
+    """
+    cur.execute('UPDATE dpkg_repos SET origin=null, label=null, '
+        'codename=null, date=null, valid_until=null, description=null '
+        'WHERE name=?', (repo.name,))
+    cur.execute('INSERT OR IGNORE INTO package_changes '
+        'SELECT package FROM dpkg_packages WHERE repo=?', (repo.name,))
+    cur.execute('DELETE FROM dpkg_package_dependencies WHERE repo=?',
+        (repo.name,))
+    cur.execute('DELETE FROM dpkg_package_relations WHERE repo=?',
+        (repo.name,))
+    cur.execute('DELETE FROM dpkg_package_duplicate WHERE repo=?',
+        (repo.name,))
+    cur.execute('DELETE FROM dpkg_packages WHERE repo=?', (repo.name,))
+    cur.execute('DELETE FROM dpkg_package_hashes WHERE repo=?', (repo.name,))
+    cur.execute('DELETE FROM dpkg_repo_files WHERE repo=?', (repo.name,))
+
+def fetch_release(mirror, suite, local=False, client=None, cache=None):
+    """
+    Fetch and parse the InRelease file of a suite.
+    This doesn't use the database, so that suites can be fetched in threads.
+    Returns (deb822.Release, [(Repo, filename, size, sha256)] of the
+    Packages files), or None if the suite is not found.
     """
     url = urllib.parse.urljoin(mirror, '/'.join(('dists', suite, 'InRelease')))
-    content = download_catalog(url, local)
-    cur = db.cursor()
+    content = download_catalog(url, local, client=client, cache=cache)
     if content is None:
-        logging.error('dpkg suite %s not found' % suite)
-        if not repos:
-            return {}
-        for repo in repos:
-            cur.execute('UPDATE dpkg_repos SET origin=null, label=null, '
-                'codename=null, date=null, valid_until=null, description=null '
-                'WHERE name=?', (repo.name,))
-            cur.execute('DELETE FROM dpkg_package_dependencies WHERE repo=?',
-                (repo.name,))
-            cur.execute('DELETE FROM dpkg_package_duplicate WHERE repo=?',
-                (repo.name,))
-            cur.execute('DELETE FROM dpkg_packages WHERE repo=?', (repo.name,))
-        db.commit()
-        return {}
+        return None
     releasetxt = remove_clearsign(content).decode('utf-8')
     rel = deb822.Release(releasetxt)
     pkgrepos = []
@@ -253,249 +577,450 @@ def suite_update(db, mirror, suite, repos=None, local=False, force=False):
             repo = Repo(name, realname, None, 'base', 0, suite, component, arch)
             pkgrepos.append(
                 (repo, item['name'], int(item['size']), item['sha256']))
-    rel_date = calendar.timegm(parsedate(rel['Date'])) if 'Date' in rel else None
-    rel_valid = None
-    if 'Valid-Until' in rel:
-        rel_valid = calendar.timegm(parsedate(rel['Valid-Until']))
-    result_repos = {}
-    repo_dict = {}
-    if repos:
-        repo_dict = {(r.component, r.architecture): r for r in repos}
-    for pkgrepo, filename, size, sha256 in pkgrepos:
-        try:
-            repo = repo_dict.pop((pkgrepo.component, pkgrepo.architecture))
-        except KeyError:
-            repo = pkgrepo
-        res = cur.execute('SELECT date FROM dpkg_repos WHERE name=?',
-                          (repo.name,)).fetchone()
-        if res and rel_date and not force:
-            if res[0] and res[0] >= rel_date:
-                continue
-        pkgpath = '/'.join(('dists', suite, filename))
-        result_repos[repo.component, repo.architecture] = (repo, pkgpath, size, sha256)
-        cur.execute('REPLACE INTO dpkg_repos VALUES '
-            '(?,?,?,?,?, ?,?,?,?,?, ?,?,?,?)', (
-            repo.name, repo.realname,
-            repo.source_tree, repo.category, repo.testing, repo.suite,
-            repo.component, repo.architecture, rel.get('Origin'),
-            rel.get('Label'), rel.get('Codename'), rel_date, rel_valid,
-            rel.get('Description')
-        ))
-    for repo in repo_dict.values():
-        cur.execute('UPDATE dpkg_repos SET origin=null, label=null, '
-            'codename=null, date=null, valid_until=null, description=null '
-            'WHERE name=?', (repo.name,))
-        cur.execute('DELETE FROM dpkg_package_dependencies WHERE repo=?',
-            (repo.name,))
-        cur.execute('DELETE FROM dpkg_package_duplicate WHERE repo=?',
-            (repo.name,))
-        cur.execute('DELETE FROM dpkg_packages WHERE repo=?', (repo.name,))
-    cur.close()
+    return rel, pkgrepos
+
+class SuiteUpdate:
+    """
+    Changes of a suite from its InRelease file: dpkg_repos rows to write,
+    repos to clear, and {(component, architecture): (repo, path, size,
+    sha256)} of the changed Packages files in catalogs.
+    write() only writes dpkg_repos, so that the caller can write the
+    Packages files in the same transaction.
+    """
+    def __init__(self, suite):
+        self.suite = suite
+        self.repo_rows = []
+        self.cleared = []
+        self.catalogs = {}
+
+    @classmethod
+    def from_release(cls, db, suite, release, repos=None, force=False):
+        """
+        Compare a fetch_release() result with the database.
+        repos: list of Repos
+        """
+        self = cls(suite)
+        if release is None:
+            logging.error('dpkg suite %s not found' % suite)
+            self.cleared.extend(repos or ())
+            return self
+        rel, pkgrepos = release
+        rel_date = calendar.timegm(parsedate(rel['Date'])) if 'Date' in rel else None
+        rel_valid = None
+        if 'Valid-Until' in rel:
+            rel_valid = calendar.timegm(parsedate(rel['Valid-Until']))
+        repo_dict = {}
+        if repos:
+            repo_dict = {(r.component, r.architecture): r for r in repos}
+        cur = db.cursor()
+        for pkgrepo, filename, size, sha256 in pkgrepos:
+            try:
+                repo = repo_dict.pop((pkgrepo.component, pkgrepo.architecture))
+            except KeyError:
+                repo = pkgrepo
+            res = cur.execute('SELECT date FROM dpkg_repos WHERE name=?',
+                              (repo.name,)).fetchone()
+            if res and rel_date and not force:
+                if res[0] and res[0] >= rel_date:
+                    continue
+            pkgpath = '/'.join(('dists', suite, filename))
+            if not force and cur.execute(
+                'SELECT 1 FROM dpkg_repo_files WHERE repo=? AND filename=? '
+                'AND size=? AND sha256=?',
+                (repo.name, pkgpath, size, sha256)).fetchone():
+                logging.info('%s not changed', repo.name)
+            else:
+                self.catalogs[repo.component, repo.architecture] = (
+                    repo, pkgpath, size, sha256)
+            self.repo_rows.append((
+                repo.name, repo.realname,
+                repo.source_tree, repo.category, repo.testing, repo.suite,
+                repo.component, repo.architecture, rel.get('Origin'),
+                rel.get('Label'), rel.get('Codename'), rel_date, rel_valid,
+                rel.get('Description')
+            ))
+        cur.close()
+        self.cleared.extend(repo_dict.values())
+        return self
+
+    def write(self, db):
+        cur = db.cursor()
+        cur.executemany('REPLACE INTO dpkg_repos VALUES '
+            '(?,?,?,?,?, ?,?,?,?,?, ?,?,?,?)', self.repo_rows)
+        for repo in self.cleared:
+            _clear_repo(cur, repo)
+        cur.close()
+
+def suite_update(db, mirror, suite, repos=None, local=False, force=False,
+                 client=None, cache=None):
+    """
+    Fetch and parse InRelease file. Update relavant metadata.
+    suite: branch
+    repos: list of Repos
+    """
+    update = SuiteUpdate.from_release(db, suite, fetch_release(
+        mirror, suite, local, client, cache), repos, force)
+    update.write(db)
     db.commit()
-    return result_repos
+    return update.catalogs
+
+def _iter_suites(db, suites, arch=None, local=False, force=False,
+                 client=None, jobs=1, cache=None):
+    """
+    Fetch the InRelease files of (mirror, suite, repos) suites in a pool of
+    jobs threads, and yield (SuiteUpdate, tasks) in order, tasks for
+    packages_update.
+    """
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        futures = collections.deque(
+            (mirror, suite, repos, executor.submit(
+                fetch_release, mirror, suite, local, client, cache))
+            for mirror, suite, repos in suites)
+        try:
+            while futures:
+                mirror, suite, repos, future = futures.popleft()
+                update = SuiteUpdate.from_release(
+                    db, suite, future.result(), repos, force)
+                tasks = []
+                for repo, path, size, sha256 in update.catalogs.values():
+                    if arch and repo.architecture != arch:
+                        continue
+                    tasks.append((mirror, repo, path, size, sha256, local))
+                yield update, tasks
+        finally:
+            for item in futures:
+                item[3].cancel()
 
 _relationship_fields = ('depends', 'pre-depends', 'recommends',
         'suggests', 'breaks', 'conflicts', 'provides', 'replaces',
         'enhances')
 
-def package_update(db, mirror, repo, path, size, sha256, local=False):
+_package_fields = ('Package', 'Version', 'Architecture', 'Maintainer',
+        'Installed-Size', 'Filename', 'Size', 'SHA256') + _relationship_fields
+
+def _iter_xz(chunks):
+    decompressor = lzma.LZMADecompressor()
+    for chunk in chunks:
+        yield decompressor.decompress(chunk)
+    if not decompressor.eof:
+        raise EOFError('compressed file ended before the end-of-stream marker')
+
+class ChecksumError(ValueError):
+    pass
+
+def fetch_packages(mirror, repo, path, size, sha256, local=False,
+                   client=None, cache=None):
+    """
+    Generator yielding (pkginfo, {relationship: value}) of a Packages file
+    while it's being downloaded, where pkginfo is a row of dpkg_packages.
+    The file is decompressed and hashed on the fly and never kept in memory.
+    Raises ChecksumError after the last package if the file doesn't match
+    size and sha256.
+    """
     logging.info(repo.name)
     url = urllib.parse.urljoin(mirror, path)
-    content = download_catalog(url, local)
-    if len(content) != size:
-        logging.warning('%s size %d != %d', url, len(content), size)
-    elif hashlib.sha256(content).hexdigest() != sha256:
-        logging.warning('%s sha256 mismatch', url)
-    pkgs = lzma.decompress(content).decode('utf-8')
-    packages = {}
+    hasher = hashlib.sha256()
+    length = 0
+
+    def hashed(chunks):
+        nonlocal length
+        for chunk in chunks:
+            hasher.update(chunk)
+            length += len(chunk)
+            yield chunk
+
+    with open_catalog(url, local, client=client, cache=cache) as chunks:
+        for values in deb822.iter_index_fields(
+            _iter_xz(hashed(chunks)), _package_fields):
+            (package, version, architecture, maintainer, installed_size,
+             filename, pkgsize, pkgsha256) = values[:8]
+            if None in (package, version, architecture, filename, pkgsize):
+                raise KeyError('%s: required field missing in %r' % (
+                    url, values[:8]))
+            pkginfo = (
+                package, version, architecture, repo.name, maintainer,
+                None if installed_size is None else int(installed_size),
+                filename, int(pkgsize), pkgsha256
+            )
+            rels = {rel: value for rel, value in zip(
+                _relationship_fields, values[8:]) if value is not None}
+            yield pkginfo, rels
+    if length != size:
+        raise ChecksumError('%s size %d != %d' % (url, length, size))
+    elif hasher.hexdigest() != sha256:
+        raise ChecksumError('%s sha256 mismatch' % url)
+
+def _relation_rows(pkgtuple, rels):
+    """
+    Rows of dpkg_package_relations of a package, from {relationship: value}.
+    """
+    for relationship, value in rels.items():
+        for alt_group, alternatives in enumerate(
+            deb822.PkgRelation.parse_relations_cached(value)):
+            for alt_index, rel in enumerate(alternatives):
+                relop, dep_version = rel.version or (None, None)
+                yield pkgtuple + (relationship, alt_group, alt_index,
+                                  rel.name, relop, dep_version)
+
+def _package_hash(pkginfo, rels):
+    return hashlib.blake2b(
+        repr((pkginfo, sorted(rels.items()))).encode('utf-8'),
+        digest_size=16).digest()
+
+def write_packages(db, repo, packages, catalog=None, commit=True):
+    """
+    Update the packages of repo to packages, an iterable of
+    (pkginfo, {relationship: value}) from fetch_packages.
+    Packages are compared with the hashes in dpkg_package_hashes, and only
+    new, changed and removed packages are written.
+    Of the entries of a package listed more than once, the one with the
+    greatest filename is kept. The entries of packages which were
+    duplicates last time are chosen from before they're compared, so that
+    the kept entry isn't rewritten every time.
+    catalog is (filename, size, sha256) of the Packages file, recorded in
+    dpkg_repo_files to skip it while it's unchanged.
+    If commit is false, the changes are left in the current transaction.
+    """
     cur = db.cursor()
+    duplicates_old = frozenset(cur.execute(
+        'SELECT package, version, architecture, repo'
+        ' FROM dpkg_package_duplicate WHERE repo = ?', (repo.name,)))
     cur.execute('DELETE FROM dpkg_package_duplicate WHERE repo = ?', (repo.name,))
-    packages_old = set(cur.execute(
-        'SELECT package, version, architecture, repo FROM dpkg_packages'
-        ' WHERE repo = ?', (repo.name,)
-    ))
-    for pkg in deb822.Packages.iter_paragraphs(pkgs):
-        name = pkg['Package']
-        arch = pkg['Architecture']
-        ver = pkg['Version']
-        pkgtuple = (name, ver, arch, repo.name)
-        pkginfo = (
-            name, ver, arch, repo.name, pkg.get('Maintainer'),
-            int(pkg['Installed-Size']) if 'Installed-Size' in pkg else None,
-            pkg['Filename'], int(pkg['Size']), pkg.get('SHA256')
-        )
-        if pkgtuple in packages:
-            logging.warning('duplicate package: %r', pkgtuple)
-            cur.execute(
-                'REPLACE INTO dpkg_package_duplicate VALUES (?,?,?,?,?,?,?,?,?)',
-                packages[pkgtuple])
-            cur.execute(
-                'REPLACE INTO dpkg_package_duplicate VALUES (?,?,?,?,?,?,?,?,?)',
-                pkginfo)
-            if pkg['Filename'] < packages[pkgtuple][6]:
-                continue
-        packages[pkgtuple] = pkginfo
-        cur.execute('REPLACE INTO dpkg_packages VALUES (?,?,?,?,?,?,?,?,?)',
-                    pkginfo)
-        oldrels = frozenset(row[0] for row in cur.execute(
-            'SELECT relationship FROM dpkg_package_dependencies'
-            ' WHERE package = ? AND version = ? AND architecture = ? AND repo = ?',
-            (name, ver, arch, repo.name)
-        ))
-        newrels = set()
-        for rel in _relationship_fields:
-            if rel in pkg:
-                cur.execute(
-                    'REPLACE INTO dpkg_package_dependencies VALUES (?,?,?,?,?,?)',
-                    (name, ver, arch, repo.name, rel, pkg[rel])
-                )
-                newrels.add(rel)
-        for rel in oldrels.difference(newrels):
+    packages_old = {row[:4]: row[4] for row in cur.execute(
+        'SELECT p.package, p.version, p.architecture, p.repo, h.hash'
+        ' FROM dpkg_packages p LEFT JOIN dpkg_package_hashes h'
+        ' USING (package, version, architecture, repo)'
+        ' WHERE p.repo = ?', (repo.name,)
+    )}
+    # hashes of the rows in dpkg_packages now
+    packages_cur = dict(packages_old)
+    # pkgtuple -> pkginfo of the kept entry
+    packages_new = {}
+
+    def replaces(pkginfo, kept):
+        """
+        Record a duplicate, returns whether pkginfo is kept instead of kept.
+        """
+        logging.warning('duplicate package: %r', pkginfo[:4])
+        cur.executemany(
+            'REPLACE INTO dpkg_package_duplicate VALUES (?,?,?,?,?,?,?,?,?)',
+            (kept, pkginfo))
+        return pkginfo[6] >= kept[6]
+
+    def write(pkginfo, rels):
+        pkgtuple = pkginfo[:4]
+        kept = packages_new.get(pkgtuple)
+        if kept is not None and not replaces(pkginfo, kept):
+            return
+        packages_new[pkgtuple] = pkginfo
+        pkghash = _package_hash(pkginfo, rels)
+        if pkgtuple in packages_cur:
+            if packages_cur[pkgtuple] == pkghash:
+                return
             cur.execute(
                 'DELETE FROM dpkg_package_dependencies'
                 ' WHERE package = ? AND version = ? AND architecture = ?'
-                ' AND repo = ? AND relationship = ?',
-                (name, ver, arch, repo.name, rel)
-            )
-    for pkg in packages_old.difference(packages.keys()):
+                ' AND repo = ?', pkgtuple)
+            cur.execute(
+                'DELETE FROM dpkg_package_relations'
+                ' WHERE package = ? AND version = ? AND architecture = ?'
+                ' AND repo = ?', pkgtuple)
+        packages_cur[pkgtuple] = pkghash
+        cur.execute(
+            'REPLACE INTO dpkg_packages VALUES (?,?,?,?,?,?,?,?,?,?)',
+            pkginfo + (vercomp.sort_key(pkginfo[1]),))
+        cur.executemany(
+            'INSERT INTO dpkg_package_dependencies VALUES (?,?,?,?,?,?)',
+            (pkgtuple + item for item in rels.items()))
+        cur.executemany(
+            'INSERT INTO dpkg_package_relations'
+            ' VALUES (?,?,?,?,?,?,?,?,?,?)',
+            _relation_rows(pkgtuple, rels))
+        cur.execute('REPLACE INTO dpkg_package_hashes VALUES (?,?,?,?,?)',
+                    pkgtuple + (pkghash,))
+
+    # pkgtuple -> (pkginfo, rels) of the kept entry
+    deferred = {}
+    try:
+        for pkginfo, rels in packages:
+            pkgtuple = pkginfo[:4]
+            if pkgtuple not in duplicates_old:
+                write(pkginfo, rels)
+                continue
+            kept = deferred.get(pkgtuple)
+            if kept is None or replaces(pkginfo, kept[0]):
+                deferred[pkgtuple] = (pkginfo, rels)
+    except ChecksumError as ex:
+        # keep the packages, but read the file again next time
+        logging.warning('%s', ex)
+        catalog = None
+    for pkginfo, rels in deferred.values():
+        write(pkginfo, rels)
+    inserted = updated = 0
+    # names of new and changed packages
+    changed = set()
+    for pkgtuple in packages_new:
+        if pkgtuple not in packages_old:
+            inserted += 1
+        elif packages_cur[pkgtuple] != packages_old[pkgtuple]:
+            updated += 1
+        else:
+            continue
+        changed.add(pkgtuple[0])
+    deleted = packages_old.keys() - packages_new.keys()
+    for pkg in deleted:
         cur.execute('DELETE FROM dpkg_packages WHERE package = ? AND version = ?'
                     ' AND architecture = ? AND repo = ?', pkg)
         cur.execute('DELETE FROM dpkg_package_dependencies WHERE package = ?'
                     ' AND version = ? AND architecture = ? AND repo = ?', pkg)
+        cur.execute('DELETE FROM dpkg_package_relations WHERE package = ?'
+                    ' AND version = ? AND architecture = ? AND repo = ?', pkg)
+        cur.execute('DELETE FROM dpkg_package_hashes WHERE package = ?'
+                    ' AND version = ? AND architecture = ? AND repo = ?', pkg)
+    cur.executemany(
+        'INSERT OR IGNORE INTO package_changes VALUES (?)',
+        ((name,) for name in changed.union(pkg[0] for pkg in deleted)))
+    cur.execute('DELETE FROM dpkg_repo_files WHERE repo = ?', (repo.name,))
+    if catalog:
+        cur.execute('INSERT INTO dpkg_repo_files VALUES (?,?,?,?)',
+                    (repo.name,) + tuple(catalog))
     cur.close()
-    db.commit()
+    if commit:
+        db.commit()
+    logging.info('%s: %d new, %d changed, %d removed, %d unchanged',
+                 repo.name, inserted, updated, len(deleted),
+                 len(packages_new) - inserted - updated)
 
-SQL_COUNT_REPO = '''
-REPLACE INTO dpkg_repo_stats
-SELECT c1.repo repo, pkgcount, ghost, lagging, missing, coalesce(olddebcnt, 0)
-FROM (
-SELECT
-  dpkg_repos.name repo, dpkg_repos.realname reponame,
-  dpkg_repos.testing testing, dpkg_repos.category category,
-  count(packages.name) pkgcount,
-  (CASE WHEN count(packages.name)
-   THEN sum(CASE WHEN packages.name IS NULL THEN 1 ELSE 0 END)
-   ELSE 0 END) ghost
-FROM dpkg_repos
-LEFT JOIN (
-    SELECT DISTINCT dp.package, dp.repo, dr.realname reponame, dr.architecture
-    FROM dpkg_packages dp
-    LEFT JOIN dpkg_repos dr ON dr.name=dp.repo
-  ) dpkg
-  ON dpkg.repo = dpkg_repos.name
-LEFT JOIN packages
-  ON packages.name = dpkg.package
-LEFT JOIN package_spec spabhost
-  ON spabhost.package = packages.name AND spabhost.key = 'ABHOST'
-WHERE packages.name IS NULL
-OR ((spabhost.value IS 'noarch') = (dpkg.architecture IS 'noarch'))
-GROUP BY dpkg_repos.name
-) c1
-LEFT JOIN (
-SELECT
-  dpkg.repo repo, dpkg.reponame reponame,
-  sum(pkgver.fullver > dpkg.version COLLATE vercomp) lagging
-FROM packages
-INNER JOIN (
-    SELECT
-      package, branch,
-      ((CASE WHEN ifnull(epoch, '') = '' THEN '' ELSE epoch || ':' END) ||
-       version || (CASE WHEN ifnull(release, '') IN ('', '0') THEN '' ELSE '-'
-       || release END)) fullver
-    FROM package_versions
-  ) pkgver
-  ON pkgver.package = packages.name
-INNER JOIN trees ON trees.name = packages.tree
-LEFT JOIN package_spec spabhost
-  ON spabhost.package = packages.name AND spabhost.key = 'ABHOST'
-LEFT JOIN (
-    SELECT
-      dp_d.name package, dr.name repo, dr.realname reponame,
-      max(dp.version COLLATE vercomp) version, dr.category category,
-      dr.architecture architecture, dr.suite branch
-    FROM packages dp_d
-    INNER JOIN dpkg_repos dr
-    LEFT JOIN dpkg_packages dp ON dp.package=dp_d.name AND dp.repo=dr.name
-    GROUP BY dp_d.name, dr.name
-  ) dpkg ON dpkg.package = packages.name
-WHERE pkgver.branch = dpkg.branch
-  AND ((spabhost.value IS 'noarch') = (dpkg.architecture IS 'noarch'))
-  AND dpkg.repo IS NOT null
-  AND (dpkg.version IS NOT null OR (dpkg.category='bsp') = (trees.category='bsp'))
-GROUP BY dpkg.repo
-) c2 ON c2.repo=c1.repo
-LEFT JOIN (
-SELECT reponame, sum(CASE WHEN dpp IS NULL THEN 1 ELSE 0 END) missing
-FROM (
-  SELECT
-    packages.name package, dr.realname reponame, dr.category category,
-    max(dp.package) dpp
-  FROM packages
-  INNER JOIN dpkg_repos dr
-  INNER JOIN trees ON trees.name = packages.tree
-  INNER JOIN package_versions pv
-    ON pv.package=packages.name AND pv.branch=trees.mainbranch
-    AND pv.version IS NOT NULL
-  LEFT JOIN package_spec spabhost
-    ON spabhost.package = packages.name AND spabhost.key = 'ABHOST'
-  LEFT JOIN dpkg_packages dp ON dp.package=packages.name AND dp.repo=dr.name
-  WHERE ((spabhost.value IS 'noarch') = (dr.architecture IS 'noarch'))
-  AND dr.category != 'overlay'
-  AND (dp.package IS NOT null OR (dr.category='bsp') = (trees.category='bsp'))
-  GROUP BY packages.name, dr.realname
-)
-GROUP BY reponame
-) c3 ON c3.reponame=c1.reponame AND c1.testing=0
-LEFT JOIN (
-  SELECT repo, count(repo) olddebcnt
-  FROM (
-    SELECT dp.repo
-    FROM dpkg_packages dp
-    INNER JOIN dpkg_repos dr ON dr.name=dp.repo
-    LEFT JOIN (
-      SELECT package, max(version COLLATE vercomp) version, architecture, repo
-      FROM dpkg_packages
-      GROUP BY package, architecture, repo
-    ) dpnew USING (package, version, architecture, repo)
-    LEFT JOIN packages ON packages.name = dp.package
-    LEFT JOIN package_spec spabhost
-      ON spabhost.package = dp.package AND spabhost.key = 'ABHOST'
-    LEFT JOIN (
-      SELECT dp.package, (dr.architecture = 'noarch') noarch,
-        max(dp.version COLLATE vercomp) version
-      FROM dpkg_packages dp
-      INNER JOIN dpkg_repos dr ON dr.name=dp.repo
-      GROUP BY dp.package, (dr.architecture = 'noarch')
-    ) dparch ON dparch.package=dp.package
-    AND (dr.architecture != 'noarch') = dparch.noarch
-    AND dparch.version=dpnew.version
-    WHERE (dpnew.package IS NULL OR packages.name IS NULL
-    OR ((dr.architecture = 'noarch') = (spabhost.value IS NOT 'noarch')
-      AND dparch.package IS NULL))
-    UNION ALL
-    SELECT repo FROM dpkg_package_duplicate
-  ) q1
-  GROUP BY repo
-) c4 ON c4.repo=c1.repo
-ORDER BY c1.category, c1.reponame, c1.testing
-'''
-
-def stats_update(db):
-    db.execute(SQL_COUNT_REPO)
-    db.commit()
+def package_update(db, mirror, repo, path, size, sha256, local=False,
+                   client=None, cache=None):
+    write_packages(db, repo, fetch_packages(
+        mirror, repo, path, size, sha256, local, client, cache),
+        (path, size, sha256))
+
+class _PackagesStream:
+    """
+    Bounded queue of batches of fetch_packages results, from a download
+    thread to the writer.
+    """
+    batch_size = 1000
+    maxsize = 2
+
+    def __init__(self):
+        self.queue = queue.Queue(self.maxsize)
+        self.cancelled = False
+
+    def _put(self, item):
+        while True:
+            try:
+                self.queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                if self.cancelled:
+                    raise
+
+    def produce(self, task, client, cache):
+        try:
+            batch = []
+            for item in fetch_packages(*task, client, cache):
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    self._put(batch)
+                    batch = []
+            self._put(batch)
+            self._put(None)
+        except queue.Full:
+            pass
+        except BaseException as ex:
+            self._put(ex)
+
+    def __iter__(self):
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                return
+            elif isinstance(batch, BaseException):
+                raise batch
+            yield from batch
 
-def update(db, mirror, branches=None, arch=None, local=False, force=False):
+def packages_update(db, suites, client=None, jobs=1, cache=None):
+    """
+    Run fetch_packages on the (mirror, repo, path, size, sha256, local) tasks
+    of (SuiteUpdate, tasks) suites in a pool of jobs threads, and write the
+    results with write_packages in this thread, in order.
+    Each suite is written in one transaction with its SuiteUpdate, so that
+    readers never see a suite with only some of its repos updated, and a
+    failed download leaves the suite as it was.
+    suites may be a generator using db, it's consumed in this thread.
+    Each thread keeps at most a few batches of parsed packages waiting to be
+    written, so memory use doesn't depend on the size of Packages files.
+    """
+    # SuiteUpdate or (task, stream)
+    pending = collections.deque()
+    streams = 0
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        try:
+            for update, tasks in suites:
+                pending.append(update)
+                for task in tasks:
+                    # queue some more tasks, so that the threads don't wait
+                    # for the next InRelease
+                    while streams >= jobs * 2:
+                        streams -= _write_pending(db, pending)
+                    stream = _PackagesStream()
+                    executor.submit(stream.produce, task, client, cache)
+                    pending.append((task, stream))
+                    streams += 1
+            while pending:
+                _write_pending(db, pending)
+            db.commit()
+        except BaseException:
+            db.rollback()
+            raise
+        finally:
+            for item in pending:
+                if not isinstance(item, SuiteUpdate):
+                    item[1].cancelled = True
+
+def _write_pending(db, pending):
+    """
+    Write the first item of pending, returns 1 for a stream, 0 for a suite.
+    The item is removed once it's written, so that a stream left unread
+    after an error is still cancelled.
+    """
+    item = pending[0]
+    if isinstance(item, SuiteUpdate):
+        # the previous suite is complete
+        db.commit()
+        item.write(db)
+        pending.popleft()
+        return 0
+    (mirror, repo, path, size, sha256, local), stream = item
+    write_packages(db, repo, stream, (path, size, sha256), False)
+    pending.popleft()
+    return 1
+
+def stats_update(db, full=False):
+    repostats.update(db, full)
+
+def update(db, mirror, branches=None, arch=None, local=False, force=False,
+           client=None, jobs=1, cache=None):
     branches = frozenset(branches if branches else ())
-    for suite, repos in REPOS.items():
-        if branches and suite not in branches:
-            continue
-        pkgrepos = suite_update(db, mirror, suite, repos, local, force)
-        for repo, path, size, sha256 in pkgrepos.values():
-            if arch and repo.architecture != arch:
-                continue
-            package_update(db, mirror, repo, path, size, sha256, local)
+    suites = [(mirror, suite, repos) for suite, repos in REPOS.items()
+              if not branches or suite in branches]
+    packages_update(db, _iter_suites(
+        db, suites, arch, local, force, client, jobs, cache),
+        client, jobs, cache)
+
+def update_sources_list(db, filename, branches=None, arch=None, local=False,
+                        force=False, client=None, jobs=1, cache=None):
+    packages_update(db, _iter_suites(
+        db, _iter_sources_list(filename, branches), arch, local, force,
+        client, jobs, cache), client, jobs, cache)
 
-def update_sources_list(db, filename, branches=None, arch=None, local=False, force=False):
+def _iter_sources_list(filename, branches):
+    """
+    (mirror, suite, None) of the deb lines of a sources.list file.
+    """
     with open(filename, 'r', encoding='utf-8') as f:
         for ln in f:
             if ln[0] == '#':
@@ -510,12 +1035,7 @@ def update_sources_list(db, filename, branches=None, arch=None, local=False, for
                 continue
             elif branches and fields[2] not in branches:
                 continue
-            mirror = _url_slash(fields[1])
-            pkgrepos = suite_update(db, mirror, fields[2], None, local, force)
-            for repo, path, size, sha256 in pkgrepos.values():
-                if arch and repo.architecture != arch:
-                    continue
-                package_update(db, mirror, repo, path, size, sha256, local)
+            yield _url_slash(fields[1]), fields[2], None
 
 def main(argv):
     parser = argparse.ArgumentParser(description="Get package info from DPKG sources.")
@@ -534,28 +1054,48 @@ def main(argv):
     parser.add_argument("-s", "--sources-list",
         help="Use specified sources.list file as repo list."
     )
+    parser.add_argument("-j", "--jobs",
+        help="Number of Packages files to download and parse at a time, "
+             "also the default limit of connections to a mirror",
+        type=int, default=4)
+    parser.add_argument("-J", "--host-jobs",
+        help="Limit connections to a mirror host, in the form HOST=N. "
+             "Can be specified multiple times",
+        action='append', default=[], metavar='HOST=N')
+    parser.add_argument("-c", "--cache-dir",
+        help="Keep downloaded files in DIR, and only download them again "
+             "if they are modified", metavar='DIR')
+    parser.add_argument("--cache-days",
+        help="Remove files not used for N days from the cache",
+        type=int, default=30, metavar='N')
     parser.add_argument("dbfile", help="abbs database file")
     args = parser.parse_args(argv)
 
     db = sqlite3.connect(args.dbfile)
-    try:
-        db.enable_load_extension(True)
-        extpath = os.path.abspath(
-            os.path.join(os.path.dirname(__file__), 'mod_vercomp.so'))
-        db.load_extension(extpath)
-    except sqlite3.OperationalError:
-        logging.error('mod_vercomp.so not found, run `make` first.')
-        sys.exit(1)
-    db.enable_load_extension(False)
+    if not vercomp.register(db):
+        logging.info('mod_vercomp.so not found, comparing versions in Python')
     init_db(db, not args.no_stats)
-    if args.sources_list:
-        update_sources_list(
-            db, args.sources_list, args.branch, args.arch, args.local, args.force)
-    else:
-        update(
-            db, _url_slash(args.mirror),
-            args.branch, args.arch, args.local, args.force
-        )
+    host_limits = {}
+    for item in args.host_jobs:
+        host, limit = item.rsplit('=', 1)
+        host_limits[host] = int(limit)
+    cache = None
+    if args.cache_dir:
+        cache = CatalogCache(args.cache_dir, args.cache_days)
+    with CatalogClient(args.jobs, host_limits) as client:
+        if args.sources_list:
+            update_sources_list(
+                db, args.sources_list, args.branch, args.arch, args.local,
+                args.force, client, args.jobs, cache)
+        else:
+            update(
+                db, _url_slash(args.mirror),
+                args.branch, args.arch, args.local, args.force,
+                client, args.jobs, cache
+            )
+    if cache:
+        cache.prune()
+        cache.close()
     db.execute('PRAGMA optimize')
     if not args.no_stats:
         stats_update(db)
@@ -2,8 +2,12 @@
 # -*- coding: utf-8 -*-
 
 import os
+import errno
+import ctypes
+import select
 import shutil
 import socket
+import struct
 import hashlib
 import pathlib
 import platform
@@ -82,3 +86,106 @@ def get_arch_name():
     return None
 
 
+class DirectoryWatcher:
+    """
+    Watch directories for changes with inotify(7).
+
+    wait() returns the set of watched directories in which files or
+    subdirectories are created, removed, renamed or written to.
+    Directories are not watched recursively; add() new ones as they appear.
+    """
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_MOVE_SELF = 0x800
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ONLYDIR = 0x1000000
+    IN_DONT_FOLLOW = 0x2000000
+    IN_CLOEXEC = 0o2000000
+
+    mask = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+            IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF |
+            IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW)
+    event_header = struct.Struct('iIII')
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(self.IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        # wd -> path
+        self.watches = {}
+        # path -> wd
+        self.paths = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def add(self, path):
+        if path in self.paths:
+            return
+        wd = self.libc.inotify_add_watch(
+            self.fd, os.fsencode(path), self.mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err in (errno.ENOENT, errno.ENOTDIR):
+                return
+            raise OSError(err, os.strerror(err), path)
+        self.watches[wd] = path
+        self.paths[path] = wd
+
+    def read(self, timeout=None):
+        """
+        Read pending events, waiting up to timeout seconds.
+        Returns the set of changed directories.
+        If the kernel event queue overflowed, all watched directories are
+        returned.
+        """
+        changed = set()
+        if not select.select((self.fd,), (), (), timeout)[0]:
+            return changed
+        data = os.read(self.fd, 65536)
+        pos = 0
+        while pos < len(data):
+            wd, mask, cookie, length = self.event_header.unpack_from(data, pos)
+            pos += self.event_header.size + length
+            if mask & self.IN_Q_OVERFLOW:
+                changed.update(self.paths)
+                continue
+            path = self.watches.get(wd)
+            if path is None:
+                continue
+            changed.add(path)
+            if mask & self.IN_IGNORED:
+                # the directory is removed
+                del self.watches[wd]
+                if self.paths.get(path) == wd:
+                    del self.paths[path]
+        return changed
+
+    def wait(self, delay=1):
+        """
+        Wait for changes, then for delay seconds without further changes.
+        Returns the set of changed directories.
+        """
+        changed = self.read()
+        while True:
+            more = self.read(delay)
+            if not more:
+                return changed
+            changed.update(more)
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
@@ -0,0 +1,426 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Package statistics of dpkg repos (dpkg_repo_stats), maintained
+incrementally.
+
+SQL_COUNT_REPO computes them from scratch. All of its counts are sums of
+terms that only depend on the rows of one package name, so the terms are
+kept per package in the repo_stats_* tables. Writers record the names of
+packages they change in package_changes; update() recomputes the terms of
+those packages only, and sums them up per repo.
+The terms compare versions by version_key (see vercomp), SQL_COUNT_REPO by
+the vercomp collation, so check() also checks the keys.
+"""
+
+import sys
+import sqlite3
+import hashlib
+import logging
+import argparse
+
+import vercomp
+
+logger = logging.getLogger('repostats')
+
+SQL_COUNT_REPO = '''
+REPLACE INTO dpkg_repo_stats
+SELECT c1.repo repo, pkgcount, ghost, lagging, missing, coalesce(olddebcnt, 0)
+FROM (
+SELECT
+  dpkg_repos.name repo, dpkg_repos.realname reponame,
+  dpkg_repos.testing testing, dpkg_repos.category category,
+  count(packages.name) pkgcount,
+  (CASE WHEN count(packages.name)
+   THEN sum(CASE WHEN packages.name IS NULL THEN 1 ELSE 0 END)
+   ELSE 0 END) ghost
+FROM dpkg_repos
+LEFT JOIN (
+    SELECT DISTINCT dp.package, dp.repo, dr.realname reponame, dr.architecture
+    FROM dpkg_packages dp
+    LEFT JOIN dpkg_repos dr ON dr.name=dp.repo
+  ) dpkg
+  ON dpkg.repo = dpkg_repos.name
+LEFT JOIN packages
+  ON packages.name = dpkg.package
+LEFT JOIN package_spec spabhost
+  ON spabhost.package = packages.name AND spabhost.key = 'ABHOST'
+WHERE packages.name IS NULL
+OR ((spabhost.value IS 'noarch') = (dpkg.architecture IS 'noarch'))
+GROUP BY dpkg_repos.name
+) c1
+LEFT JOIN (
+SELECT
+  dpkg.repo repo, dpkg.reponame reponame,
+  sum(pkgver.fullver > dpkg.version COLLATE vercomp) lagging
+FROM packages
+INNER JOIN (
+    SELECT
+      package, branch,
+      ((CASE WHEN ifnull(epoch, '') = '' THEN '' ELSE epoch || ':' END) ||
+       version || (CASE WHEN ifnull(release, '') IN ('', '0') THEN '' ELSE '-'
+       || release END)) fullver
+    FROM package_versions
+  ) pkgver
+  ON pkgver.package = packages.name
+INNER JOIN trees ON trees.name = packages.tree
+LEFT JOIN package_spec spabhost
+  ON spabhost.package = packages.name AND spabhost.key = 'ABHOST'
+LEFT JOIN (
+    SELECT
+      dp_d.name package, dr.name repo, dr.realname reponame,
+      max(dp.version COLLATE vercomp) version, dr.category category,
+      dr.architecture architecture, dr.suite branch
+    FROM packages dp_d
+    INNER JOIN dpkg_repos dr
+    LEFT JOIN dpkg_packages dp ON dp.package=dp_d.name AND dp.repo=dr.name
+    GROUP BY dp_d.name, dr.name
+  ) dpkg ON dpkg.package = packages.name
+WHERE pkgver.branch = dpkg.branch
+  AND ((spabhost.value IS 'noarch') = (dpkg.architecture IS 'noarch'))
+  AND dpkg.repo IS NOT null
+  AND (dpkg.version IS NOT null OR (dpkg.category='bsp') = (trees.category='bsp'))
+GROUP BY dpkg.repo
+) c2 ON c2.repo=c1.repo
+LEFT JOIN (
+SELECT reponame, sum(CASE WHEN dpp IS NULL THEN 1 ELSE 0 END) missing
+FROM (
+  SELECT
+    packages.name package, dr.realname reponame, dr.category category,
+    max(dp.package) dpp
+  FROM packages
+  INNER JOIN dpkg_repos dr
+  INNER JOIN trees ON trees.name = packages.tree
+  INNER JOIN package_versions pv
+    ON pv.package=packages.name AND pv.branch=trees.mainbranch
+    AND pv.version IS NOT NULL
+  LEFT JOIN package_spec spabhost
+    ON spabhost.package = packages.name AND spabhost.key = 'ABHOST'
+  LEFT JOIN dpkg_packages dp ON dp.package=packages.name AND dp.repo=dr.name
+  WHERE ((spabhost.value IS 'noarch') = (dr.architecture IS 'noarch'))
+  AND dr.category != 'overlay'
+  AND (dp.package IS NOT null OR (dr.category='bsp') = (trees.category='bsp'))
+  GROUP BY packages.name, dr.realname
+)
+GROUP BY reponame
+) c3 ON c3.reponame=c1.reponame AND c1.testing=0
+LEFT JOIN (
+  SELECT repo, count(repo) olddebcnt
+  FROM (
+    SELECT dp.repo
+    FROM dpkg_packages dp
+    INNER JOIN dpkg_repos dr ON dr.name=dp.repo
+    LEFT JOIN (
+      SELECT package, max(version COLLATE vercomp) version, architecture, repo
+      FROM dpkg_packages
+      GROUP BY package, architecture, repo
+    ) dpnew USING (package, version, architecture, repo)
+    LEFT JOIN packages ON packages.name = dp.package
+    LEFT JOIN package_spec spabhost
+      ON spabhost.package = dp.package AND spabhost.key = 'ABHOST'
+    LEFT JOIN (
+      SELECT dp.package, (dr.architecture = 'noarch') noarch,
+        max(dp.version COLLATE vercomp) version
+      FROM dpkg_packages dp
+      INNER JOIN dpkg_repos dr ON dr.name=dp.repo
+      GROUP BY dp.package, (dr.architecture = 'noarch')
+    ) dparch ON dparch.package=dp.package
+    AND (dr.architecture != 'noarch') = dparch.noarch
+    AND dparch.version=dpnew.version
+    WHERE (dpnew.package IS NULL OR packages.name IS NULL
+    OR ((dr.architecture = 'noarch') = (spabhost.value IS NOT 'noarch')
+      AND dparch.package IS NULL))
+    UNION ALL
+    SELECT repo FROM dpkg_package_duplicate
+  ) q1
+  GROUP BY repo
+) c4 ON c4.repo=c1.repo
+ORDER BY c1.category, c1.reponame, c1.testing
+'''
+
+# terms of SQL_COUNT_REPO, for packages in t_stats_names
+# versions are compared by version_key instead of COLLATE vercomp
+
+# c1: dpkg packages with (matched) and without (ghost) an abbs package
+SQL_TERMS_DPKG = """
+INSERT INTO repo_stats_dpkg
+SELECT dpkg.package, dpkg.repo,
+  (packages.name IS NOT NULL AND
+   (spabhost.value IS 'noarch') = (dpkg.architecture IS 'noarch')) matched,
+  (packages.name IS NULL) ghost
+FROM (
+    SELECT DISTINCT dp.package, dp.repo, dr.architecture
+    FROM dpkg_packages dp
+    LEFT JOIN dpkg_repos dr ON dr.name=dp.repo
+    WHERE dp.package IN (SELECT package FROM t_stats_names)
+  ) dpkg
+LEFT JOIN packages
+  ON packages.name = dpkg.package
+LEFT JOIN package_spec spabhost
+  ON spabhost.package = packages.name AND spabhost.key = 'ABHOST'
+"""
+
+# c2
+SQL_TERMS_LAGGING = """
+INSERT INTO repo_stats_lagging
+SELECT
+  packages.name, dpkg.repo,
+  sum(pkgver.version_key > dpkg.version_key) lagging
+FROM packages
+INNER JOIN (
+    SELECT package, branch, version_key
+    FROM package_versions
+    WHERE package IN (SELECT package FROM t_stats_names)
+  ) pkgver
+  ON pkgver.package = packages.name
+INNER JOIN trees ON trees.name = packages.tree
+LEFT JOIN package_spec spabhost
+  ON spabhost.package = packages.name AND spabhost.key = 'ABHOST'
+LEFT JOIN (
+    SELECT
+      dp_d.name package, dr.name repo, dr.realname reponame,
+      max(dp.version_key) version_key, dr.category category,
+      dr.architecture architecture, dr.suite branch
+    FROM packages dp_d
+    INNER JOIN dpkg_repos dr
+    LEFT JOIN dpkg_packages dp ON dp.package=dp_d.name AND dp.repo=dr.name
+    WHERE dp_d.name IN (SELECT package FROM t_stats_names)
+    GROUP BY dp_d.name, dr.name
+  ) dpkg ON dpkg.package = packages.name
+WHERE pkgver.branch = dpkg.branch
+  AND ((spabhost.value IS 'noarch') = (dpkg.architecture IS 'noarch'))
+  AND dpkg.repo IS NOT null
+  AND (dpkg.version_key IS NOT null OR (dpkg.category='bsp') = (trees.category='bsp'))
+  AND packages.name IN (SELECT package FROM t_stats_names)
+GROUP BY packages.name, dpkg.repo
+"""
+
+# c3
+SQL_TERMS_MISSING = """
+INSERT INTO repo_stats_missing
+SELECT package, reponame, (dpp IS NULL) missing
+FROM (
+  SELECT
+    packages.name package, dr.realname reponame, max(dp.package) dpp
+  FROM packages
+  INNER JOIN dpkg_repos dr
+  INNER JOIN trees ON trees.name = packages.tree
+  INNER JOIN package_versions pv
+    ON pv.package=packages.name AND pv.branch=trees.mainbranch
+    AND pv.version IS NOT NULL
+  LEFT JOIN package_spec spabhost
+    ON spabhost.package = packages.name AND spabhost.key = 'ABHOST'
+  LEFT JOIN dpkg_packages dp ON dp.package=packages.name AND dp.repo=dr.name
+  WHERE ((spabhost.value IS 'noarch') = (dr.architecture IS 'noarch'))
+  AND dr.category != 'overlay'
+  AND (dp.package IS NOT null OR (dr.category='bsp') = (trees.category='bsp'))
+  AND packages.name IN (SELECT package FROM t_stats_names)
+  GROUP BY packages.name, dr.realname
+)
+"""
+
+# c4, except dpkg_package_duplicate
+SQL_TERMS_OLD = """
+INSERT INTO repo_stats_old
+SELECT dp.package, dp.repo, count(*) old
+FROM dpkg_packages dp
+INNER JOIN dpkg_repos dr ON dr.name=dp.repo
+LEFT JOIN (
+  SELECT package, max(version_key) version_key, architecture, repo
+  FROM dpkg_packages
+  WHERE package IN (SELECT package FROM t_stats_names)
+  GROUP BY package, architecture, repo
+) dpnew USING (package, version_key, architecture, repo)
+LEFT JOIN packages ON packages.name = dp.package
+LEFT JOIN package_spec spabhost
+  ON spabhost.package = dp.package AND spabhost.key = 'ABHOST'
+LEFT JOIN (
+  SELECT dp.package, (dr.architecture = 'noarch') noarch,
+    max(dp.version_key) version_key
+  FROM dpkg_packages dp
+  INNER JOIN dpkg_repos dr ON dr.name=dp.repo
+  WHERE dp.package IN (SELECT package FROM t_stats_names)
+  GROUP BY dp.package, (dr.architecture = 'noarch')
+) dparch ON dparch.package=dp.package
+AND (dr.architecture != 'noarch') = dparch.noarch
+AND dparch.version_key=dpnew.version_key
+WHERE (dpnew.package IS NULL OR packages.name IS NULL
+OR ((dr.architecture = 'noarch') = (spabhost.value IS NOT 'noarch')
+  AND dparch.package IS NULL))
+AND dp.package IN (SELECT package FROM t_stats_names)
+GROUP BY dp.package, dp.repo
+"""
+
+# the same rows as SQL_COUNT_REPO
+SQL_SUM_REPO = """
+SELECT dr.name repo, coalesce(s1.pkgcount, 0) pkgcount,
+  (CASE WHEN s1.pkgcount THEN s1.ghost ELSE 0 END) ghost,
+  s2.lagging, s3.missing,
+  coalesce(s4.old, 0) + coalesce(s5.duplicate, 0)
+FROM dpkg_repos dr
+LEFT JOIN (
+  SELECT repo, sum(matched) pkgcount, sum(ghost) ghost,
+    sum(matched OR ghost) included
+  FROM repo_stats_dpkg GROUP BY repo
+) s1 ON s1.repo=dr.name
+LEFT JOIN (
+  SELECT repo, sum(lagging) lagging FROM repo_stats_lagging GROUP BY repo
+) s2 ON s2.repo=dr.name
+LEFT JOIN (
+  SELECT reponame, sum(missing) missing
+  FROM repo_stats_missing GROUP BY reponame
+) s3 ON s3.reponame=dr.realname AND dr.testing=0
+LEFT JOIN (
+  SELECT repo, sum(old) old FROM repo_stats_old GROUP BY repo
+) s4 ON s4.repo=dr.name
+LEFT JOIN (
+  SELECT repo, count(repo) duplicate
+  FROM dpkg_package_duplicate GROUP BY repo
+) s5 ON s5.repo=dr.name
+WHERE s1.repo IS NULL OR s1.included
+"""
+
+TERM_TABLES = (
+    ('repo_stats_dpkg', SQL_TERMS_DPKG),
+    ('repo_stats_lagging', SQL_TERMS_LAGGING),
+    ('repo_stats_missing', SQL_TERMS_MISSING),
+    ('repo_stats_old', SQL_TERMS_OLD),
+)
+
+def init_db(db):
+    cur = db.cursor()
+    # names of packages changed in packages, package_versions, package_spec
+    # or dpkg_packages since the last update
+    cur.execute('CREATE TABLE IF NOT EXISTS package_changes ('
+                'package TEXT PRIMARY KEY'
+                ')')
+    cur.execute('CREATE TABLE IF NOT EXISTS repo_stats_dpkg ('
+                'package TEXT,'
+                'repo TEXT,'
+                'matched INTEGER,'
+                'ghost INTEGER,'
+                'PRIMARY KEY (package, repo)'
+                ')')
+    cur.execute('CREATE TABLE IF NOT EXISTS repo_stats_lagging ('
+                'package TEXT,'
+                'repo TEXT,'
+                'lagging INTEGER,'
+                'PRIMARY KEY (package, repo)'
+                ')')
+    cur.execute('CREATE TABLE IF NOT EXISTS repo_stats_missing ('
+                'package TEXT,'
+                'reponame TEXT,'
+                'missing INTEGER,'
+                'PRIMARY KEY (package, reponame)'
+                ')')
+    cur.execute('CREATE TABLE IF NOT EXISTS repo_stats_old ('
+                'package TEXT,'
+                'repo TEXT,'
+                'old INTEGER,'
+                'PRIMARY KEY (package, repo)'
+                ')')
+    # for databases written before package_versions had version_key
+    vercomp.add_key_column(cur, 'package_versions',
+        ('epoch', 'version', 'release'), vercomp.package_sort_key)
+    cur.execute('CREATE TABLE IF NOT EXISTS repo_stats_state ('
+                'name TEXT PRIMARY KEY,'
+                'value TEXT'
+                ')')
+    cur.close()
+
+def _fingerprint(cur):
+    """
+    Hash of the rows every term depends on. The terms are recomputed for
+    all packages when it changes.
+    """
+    h = hashlib.sha256()
+    for row in cur.execute(
+        'SELECT name, realname, category, testing, suite, architecture '
+        'FROM dpkg_repos ORDER BY name'):
+        h.update(repr(tuple(row)).encode('utf-8'))
+    for row in cur.execute(
+        'SELECT name, category, mainbranch FROM trees ORDER BY name'):
+        h.update(repr(tuple(row)).encode('utf-8'))
+    return h.hexdigest()
+
+def update(db, full=False):
+    """
+    Recompute the terms of changed packages, or of all packages if full is
+    set, then dpkg_repo_stats.
+    Returns the number of packages recomputed.
+    """
+    init_db(db)
+    cur = db.cursor()
+    fingerprint = _fingerprint(cur)
+    row = cur.execute("SELECT value FROM repo_stats_state "
+                      "WHERE name='fingerprint'").fetchone()
+    if row is None or row[0] != fingerprint:
+        full = True
+    cur.execute('CREATE TEMP TABLE t_stats_names (package TEXT PRIMARY KEY)')
+    if full:
+        cur.execute('INSERT OR IGNORE INTO t_stats_names '
+                    'SELECT name FROM packages')
+        cur.execute('INSERT OR IGNORE INTO t_stats_names '
+                    'SELECT package FROM dpkg_packages')
+        cur.execute('INSERT OR IGNORE INTO t_stats_names '
+                    'SELECT package FROM package_changes')
+        for table, sql in TERM_TABLES:
+            cur.execute('DELETE FROM ' + table)
+    else:
+        cur.execute('INSERT INTO t_stats_names '
+                    'SELECT package FROM package_changes')
+        for table, sql in TERM_TABLES:
+            cur.execute('DELETE FROM %s WHERE package IN '
+                        '(SELECT package FROM t_stats_names)' % table)
+    count = cur.execute('SELECT count(*) FROM t_stats_names').fetchone()[0]
+    for table, sql in TERM_TABLES:
+        cur.execute(sql)
+    cur.execute('DELETE FROM package_changes WHERE package IN '
+                '(SELECT package FROM t_stats_names)')
+    cur.execute('DROP TABLE t_stats_names')
+    cur.execute('REPLACE INTO dpkg_repo_stats ' + SQL_SUM_REPO)
+    cur.execute("REPLACE INTO repo_stats_state VALUES ('fingerprint', ?)",
+                (fingerprint,))
+    cur.close()
+    db.commit()
+    logger.info('dpkg_repo_stats: %s%d packages recomputed',
+                'all ' if full else '', count)
+    return count
+
+def check(db):
+    """
+    Compare the statistics from the stored terms with SQL_COUNT_REPO.
+    Returns a list of (repo, expected row, row from terms) that differ.
+    """
+    query = SQL_COUNT_REPO.replace('REPLACE INTO dpkg_repo_stats', '', 1)
+    expected = {row[0]: tuple(row) for row in db.execute(query)}
+    actual = {row[0]: tuple(row) for row in db.execute(SQL_SUM_REPO)}
+    return [(repo, expected.get(repo), actual.get(repo))
+            for repo in sorted(expected.keys() | actual.keys())
+            if expected.get(repo) != actual.get(repo)]
+
+def main():
+    parser = argparse.ArgumentParser(description="Update package statistics of dpkg repos.")
+    parser.add_argument("-f", "--full", help="Recompute all packages", action='store_true')
+    parser.add_argument("-c", "--check", help="Check the statistics against a full recomputation with SQL_COUNT_REPO", action='store_true')
+    parser.add_argument("dbfile", help="abbs database file")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format='%(asctime)s %(levelname).1s %(message)s', level=logging.INFO)
+    db = sqlite3.connect(args.dbfile)
+    if not vercomp.register(db):
+        logger.info('mod_vercomp.so not found, comparing versions in Python')
+    update(db, args.full)
+    if args.check:
+        differences = check(db)
+        for repo, expected, actual in differences:
+            logger.error('%s: expected %r, got %r', repo, expected, actual)
+        if differences:
+            return 1
+        logger.info('dpkg_repo_stats: consistent')
+    db.close()
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Debian version comparison, as in dpkg (lib/dpkg/version.c).
+
+sort_key() maps a version to bytes that compare like the versions, so that
+the newest version is max(version_key) with a plain index, and versions can
+be compared in Python or SQL without mod_vercomp.so.
+register() loads mod_vercomp.so into a database connection, or falls back
+to a collation in Python.
+"""
+
+import os
+import re
+import sys
+import sqlite3
+import argparse
+import functools
+
+__all__ = ['parse_version', 'compare', 'sort_key', 'full_version',
+           'package_sort_key', 'add_key_column', 'register']
+
+_DIGITS = frozenset(b'0123456789')
+_ALPHA = frozenset(b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz')
+_SEGMENT = re.compile(rb'([^0-9]*)([0-9]*)')
+
+
+def _order(c):
+    # c is None at the end of the string
+    if c is None or c in _DIGITS:
+        return 0
+    elif c in _ALPHA:
+        return c
+    elif c == 0x7e:  # ~
+        return -1
+    return c + 256
+
+# sort key of non-digit bytes: 1 for '~', 2 for the end of a non-digit part,
+# then the rest in the order of _order()
+_TRANSLATE = bytearray(256)
+_TRANSLATE[0x7e] = 1
+for _code, _c in enumerate(sorted(
+    (c for c in range(256) if c not in _DIGITS and c != 0x7e), key=_order), 3):
+    _TRANSLATE[_c] = _code
+_TRANSLATE = bytes(_TRANSLATE)
+del _code, _c
+
+_END = b'\x02'
+
+
+def parse_version(version):
+    """
+    Split a version string into (epoch, upstream version, revision) as
+    bytes, the epoch as an integer.
+    An epoch which is not a number is taken as part of the upstream version.
+    """
+    if isinstance(version, str):
+        version = version.encode('utf-8')
+    version = version.strip()
+    epoch = 0
+    epochstr, colon, rest = version.partition(b':')
+    if colon and epochstr.isdigit():
+        epoch = int(epochstr)
+        version = rest
+    upstream, hyphen, revision = version.rpartition(b'-')
+    if not hyphen:
+        upstream = revision
+        revision = b''
+    return epoch, upstream, revision
+
+
+def _verrevcmp(a, b):
+    a_len = len(a)
+    b_len = len(b)
+    i = j = 0
+    while i < a_len or j < b_len:
+        first_diff = 0
+        while ((i < a_len and a[i] not in _DIGITS) or
+               (j < b_len and b[j] not in _DIGITS)):
+            ac = _order(a[i] if i < a_len else None)
+            bc = _order(b[j] if j < b_len else None)
+            if ac != bc:
+                return ac - bc
+            i += 1
+            j += 1
+        while i < a_len and a[i] == 0x30:
+            i += 1
+        while j < b_len and b[j] == 0x30:
+            j += 1
+        while (i < a_len and a[i] in _DIGITS and
+               j < b_len and b[j] in _DIGITS):
+            if not first_diff:
+                first_diff = a[i] - b[j]
+            i += 1
+            j += 1
+        if i < a_len and a[i] in _DIGITS:
+            return 1
+        if j < b_len and b[j] in _DIGITS:
+            return -1
+        if first_diff:
+            return first_diff
+    return 0
+
+
+def compare(a, b):
+    """
+    Compare two versions like dpkg --compare-versions.
+    Returns a negative number, 0 or a positive number if a is older than,
+    the same as or newer than b.
+    """
+    a_epoch, a_upstream, a_revision = parse_version(a)
+    b_epoch, b_upstream, b_revision = parse_version(b)
+    if a_epoch != b_epoch:
+        return -1 if a_epoch < b_epoch else 1
+    return (_verrevcmp(a_upstream, b_upstream) or
+            _verrevcmp(a_revision, b_revision))
+
+
+def _number_key(digits):
+    # length first, in a way that has no upper limit
+    digits = digits.lstrip(b'0')
+    length = len(digits)
+    return b'\xff' * (length // 255) + bytes((length % 255,)) + digits
+
+
+def _part_key(part):
+    segments = _SEGMENT.findall(part)
+    # the first part may have no non-digits, the others always have some
+    key = [segments[0][0].translate(_TRANSLATE), _END,
+           _number_key(segments[0][1])]
+    for nondigits, digits in segments[1:]:
+        if not nondigits:
+            break
+        key.extend((nondigits.translate(_TRANSLATE), _END,
+                    _number_key(digits)))
+    # a shorter version continues with empty non-digit parts
+    key.append(_END)
+    return b''.join(key)
+
+
+@functools.lru_cache(maxsize=4096)
+def sort_key(version):
+    """
+    Sort key of a version as bytes. Keys compare bytewise like compare()
+    compares the versions, also as BLOBs in SQLite.
+    """
+    epoch, upstream, revision = parse_version(version)
+    return (_number_key(str(epoch).encode('ascii')) +
+            _part_key(upstream) + _part_key(revision))
+
+
+def full_version(epoch, version, release):
+    """
+    The version string of the version, release and epoch of an abbs package,
+    the same as full_version of v_packages.
+    Returns None if version is None.
+    """
+    if version is None:
+        return None
+    fullver = version
+    if epoch:
+        fullver = '%s:%s' % (epoch, fullver)
+    if release and release != '0':
+        fullver = '%s-%s' % (fullver, release)
+    return fullver
+
+
+def package_sort_key(epoch, version, release):
+    """
+    Sort key of the full version of an abbs package, None if version is None.
+    """
+    fullver = full_version(epoch, version, release)
+    return None if fullver is None else sort_key(fullver)
+
+
+def add_key_column(cur, table, columns=('version',), key=sort_key):
+    """
+    Add a version_key column to a table created before it had one, and fill
+    it with key(*columns) of the existing rows.
+    Returns whether the column is added.
+    """
+    names = [row[1] for row in cur.execute(
+        'PRAGMA table_info(%s)' % table).fetchall()]
+    if not names or 'version_key' in names:
+        return False
+    cur.execute('ALTER TABLE %s ADD COLUMN version_key BLOB' % table)
+    cur.executemany(
+        'UPDATE %s SET version_key=? WHERE rowid=?' % table,
+        [(key(*row[1:]), row[0]) for row in cur.execute(
+            'SELECT rowid, %s FROM %s' % (', '.join(columns), table))])
+    return True
+
+
+def _collation(a, b):
+    result = compare(a, b)
+    return (result > 0) - (result < 0)
+
+
+def _sql_sort_key(version):
+    if version is None:
+        return None
+    return sort_key(version)
+
+
+def register(db):
+    """
+    Make the vercomp collation and the vercomp_key(version) function
+    available in the database connection.
+    The collation is from mod_vercomp.so if it can be loaded, otherwise it's
+    done in Python. Returns whether mod_vercomp.so is loaded.
+    """
+    db.create_function('vercomp_key', 1, _sql_sort_key, deterministic=True)
+    extpath = os.path.abspath(
+        os.path.join(os.path.dirname(__file__), 'mod_vercomp.so'))
+    try:
+        db.enable_load_extension(True)
+        db.load_extension(extpath)
+        db.enable_load_extension(False)
+        return True
+    except (AttributeError, sqlite3.OperationalError):
+        db.create_collation('vercomp', _collation)
+        return False
+
+
+# (a, b, result of dpkg --compare-versions a lt/eq/gt b)
+CONFORMANCE_CASES = (
+    ('0', '0', 0),
+    ('0', '00', 0),
+    ('1', '2', -1),
+    ('2', '1', 1),
+    ('1.0', '1.0', 0),
+    ('1.0', '1.00', 0),
+    ('1.0', '1.1', -1),
+    ('1.2', '1.10', -1),
+    ('1.0', '1.0.0', -1),
+    ('1.0', '1.0-0', 0),
+    ('1.0', '1.0-1', -1),
+    ('1.0-1', '1.0-2', -1),
+    ('1.0-10', '1.0-9', 1),
+    ('1.0-1', '1.0.1', -1),
+    ('1.0-1.1', '1.0-1', 1),
+    ('1.0-a', '1.0-1', 1),
+    ('1.0-1-1', '1.0-1', 1),
+    ('1.0-1-1', '1.0-2', 1),
+    ('1.0-1-1', '1.1-1', -1),
+    ('1:1.0', '1.0', 1),
+    ('0:1.0', '1.0', 0),
+    ('00:1.0', '0:1.0', 0),
+    ('1:0', '0:9999', 1),
+    ('2:1.0', '10:1.0', -1),
+    ('1:1.0-1', '1:1.0-1', 0),
+    ('1.0~rc1', '1.0', -1),
+    ('1.0~rc1', '1.0~rc2', -1),
+    ('1.0~~', '1.0~', -1),
+    ('1.0~~a', '1.0~~', 1),
+    ('1.0~', '1.0', -1),
+    ('1.0~', '1.0-1', -1),
+    ('1.0-1~bpo1', '1.0-1', -1),
+    ('1.0+1', '1.0', 1),
+    ('1.0+1', '1.0.1', -1),
+    ('1.0a', '1.0', 1),
+    ('1.0a', '1.0+', -1),
+    ('1.0a', '1.0A', 1),
+    ('1.0Z', '1.0a', -1),
+    ('1.0a', '1.0.', -1),
+    ('1.0.', '1.0+', 1),
+    ('1.0a', '1.0a0', 0),
+    ('1.0a1', '1.0a', 1),
+    ('1.0.', '1.0', 1),
+    ('1.0.~', '1.0.', -1),
+    ('a', '0a', 1),
+    ('0a', '0', 1),
+    ('0~', '0', -1),
+    ('1.002', '1.2', 0),
+    ('1.0010', '1.9', 1),
+    ('12345678901234567890', '12345678901234567891', -1),
+    ('99999999999999999999', '100000000000000000000', -1),
+    ('1.0-1ubuntu1', '1.0-1', 1),
+    ('1.0-1+b1', '1.0-1', 1),
+    ('1.0-1+b1', '1.0-1.1', -1),
+    ('2.30+git20200101', '2.30', 1),
+    ('2.30~git20200101', '2.30', -1),
+    ('7.0.0~rc1', '7.0.0~beta2', 1),
+    ('1:2.0~1', '1:2.0', -1),
+    ('3.0-0', '3.0', 0),
+    ('1.0 ', ' 1.0', 0),
+)
+
+
+def self_test(verbose=False):
+    """
+    Check compare() and sort_key() against CONFORMANCE_CASES and against
+    each other. Returns a list of failure messages.
+    """
+    failures = []
+    for a, b, expected in CONFORMANCE_CASES:
+        for x, y, result in ((a, b, expected), (b, a, -expected)):
+            got = _collation(x, y)
+            key_got = (sort_key(x) > sort_key(y)) - (sort_key(x) < sort_key(y))
+            if got != result:
+                failures.append('compare(%r, %r) = %d, expected %d' % (
+                    x, y, got, result))
+            if key_got != result:
+                failures.append('sort_key(%r) vs sort_key(%r) = %d, '
+                                'expected %d' % (x, y, key_got, result))
+            if verbose:
+                print('%r %s %r' % (x, '<=>'[result + 1], y))
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare Debian versions.")
+    parser.add_argument("-t", "--test", help="Check against the dpkg conformance cases", action='store_true')
+    parser.add_argument("-v", "--verbose", help="Print the checked cases", action='store_true')
+    parser.add_argument("version", nargs='*', help="Two versions to compare, prints <, = or >")
+    args = parser.parse_args()
+
+    if args.test:
+        failures = self_test(args.verbose)
+        for msg in failures:
+            print(msg, file=sys.stderr)
+        print('%d cases, %d failures' % (len(CONFORMANCE_CASES), len(failures)))
+        return 1 if failures else 0
+    if len(args.version) != 2:
+        parser.error('two versions are required')
+    print('<=>'[_collation(*args.version) + 1])
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
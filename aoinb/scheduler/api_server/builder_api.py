@@ -1,6 +1,8 @@
 from websockets import WebSocketServerProtocol
+from websockets.exceptions import ConnectionClosed
 import json
 import logging
+import collections
 from typing import List, Union
 
 from type_definitions import Job
@@ -25,6 +27,15 @@ class Builder:
 class BuilderAPIServer:
     builders: List[Builder] = []
 
+    def __init__(self, dispatcher=None, estimator=None, versions=None):
+        # dispatch.Dispatcher handing out the jobs, with machines named
+        # after the builders
+        self.dispatcher = dispatcher
+        # stats.OnlineEstimator, updated by the finished jobs
+        self.estimator = estimator
+        # package -> version to build, sent with the jobs
+        self.versions = versions or {}
+
     async def hello(self, ws: WebSocketServerProtocol, j: json) -> bool:
         try:
             builder_name = j['builder']['name']
@@ -61,10 +72,62 @@ class BuilderAPIServer:
         await b.ws.send(json.dumps(res))
         await b.ws.close()
         self.builders.remove(b)
+        if self.dispatcher is not None:
+            # its job goes to another builder
+            await self.send_jobs(self.dispatcher.machine_lost(b.name))
 
     async def new_job(self, j: Job):
         pass
 
+    async def send_jobs(self, assignments):
+        assignments = collections.deque(assignments)
+        while assignments:
+            machine, package = assignments.popleft()
+            b = next(filter(lambda x: x.name == machine, self.builders), None)
+            if b is not None:
+                res = {"type": "job", "package": package,
+                       "version": self.versions.get(package)}
+                try:
+                    await b.ws.send(json.dumps(res))
+                    continue
+                except ConnectionClosed:
+                    self.builders.remove(b)
+            # the builder is gone, the job goes to another one
+            assignments.extend(self.dispatcher.machine_lost(machine))
+
+    async def connection_closed(self, ws: WebSocketServerProtocol):
+        # also without a bye
+        b = next(filter(lambda x: x.ws == ws, self.builders), None)
+        if b is None:
+            return
+        self.builders.remove(b)
+        if self.dispatcher is not None:
+            await self.send_jobs(self.dispatcher.machine_lost(b.name))
+
+    async def idle(self, b: Builder):
+        if self.dispatcher is not None:
+            await self.send_jobs(self.dispatcher.machine_idle(b.name))
+
+    async def job_finished(self, b: Builder, j: json):
+        try:
+            package = j['job']['package']
+            success = j['job']['result'] == 'success'
+        except KeyError:
+            await b.ws.send('Bad request!')
+            return
+        # the version the builder built, or the one it was sent
+        version = j['job'].get('version') or self.versions.get(package)
+        speed_factor = None
+        if self.estimator is not None and success and version is not None:
+            old_speed = self.estimator.speed(b.name)
+            updated = self.estimator.job_finished(
+                package, b.arch, version, b.name, j['job'].get('cpu_time'))
+            if updated is not None:
+                speed_factor = updated[0] / old_speed
+        if self.dispatcher is not None:
+            await self.send_jobs(self.dispatcher.job_finished(
+                b.name, package, success, speed_factor))
+
     async def new_builder_handler(self, ws: WebSocketServerProtocol, msg: str):
         try:
             j: json = json.loads(msg)
@@ -95,6 +158,10 @@ class BuilderAPIServer:
         req_type = j['type']
         if req_type == 'bye':
             await self.bye(b)
+        elif req_type == 'idle':
+            await self.idle(b)
+        elif req_type == 'job_finished':
+            await self.job_finished(b, j)
 
     async def builder_handler(self, ws: WebSocketServerProtocol, msg):
         registered_builders = []
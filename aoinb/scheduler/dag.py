@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Scheduling builds which depend on each other on heterogeneous machines.
+
+The dependencies between the packages of a build list come from the
+PKGDEP/BUILDDEP graph of an abbs meta database. Packages are prioritised by
+their upward rank, the length of the longest chain of average compile times
+from the package to the end of the build, and each is put on the machine
+where it finishes first, also in gaps left earlier (HEFT).
+"""
+
+import time
+import bisect
+import collections
+
+from ..common import depgraph
+
+PlannedJob = collections.namedtuple('PlannedJob', (
+    'package', 'machine', 'start', 'finish'))
+
+Plan = collections.namedtuple('Plan', (
+    'jobs',           # [PlannedJob] by start time
+    'makespan',
+    'critical_path',  # length with the fastest machine of each package
+    'levels',         # {package: topological level}, 0 for no dependencies
+    'solve_time',     # (s)
+    'unassigned',     # packages without a feasible machine
+    'cycles',         # [[package]], dependencies inside them are ignored
+))
+
+
+def build_dependencies(graph, packages):
+    """
+    {package: set of packages of the build list it depends on}, directly or
+    through packages not in the list.
+    graph is a depgraph.DependencyGraph.
+    """
+    wanted = frozenset(packages)
+    result = {}
+    for package in packages:
+        deps = set()
+        nid = graph.ids.get(package)
+        if nid is not None:
+            seen = {nid}
+            stack = list(graph.edges[nid])
+            while stack:
+                dep = stack.pop()
+                if dep in seen:
+                    continue
+                seen.add(dep)
+                name = graph.names[dep]
+                if name in wanted:
+                    deps.add(name)
+                else:
+                    stack.extend(graph.edges[dep])
+        deps.discard(package)
+        result[package] = deps
+    return result
+
+
+def load_dependencies(db, packages):
+    """
+    build_dependencies() of packages with the graph of an abbs meta
+    database.
+    """
+    return build_dependencies(
+        depgraph.DependencyGraph.from_db(db), packages)
+
+
+def load_versions(db, packages):
+    """
+    {package: full version} of packages in the main branch of their tree in
+    an abbs meta database, for those which have one.
+    """
+    wanted = frozenset(packages)
+    return {name: version for name, version in db.execute(
+        'SELECT name, full_version FROM v_packages '
+        'WHERE full_version IS NOT NULL') if name in wanted}
+
+
+def topological_order(dependencies):
+    """
+    Returns (packages with dependencies first, cycles). Dependencies
+    between members of a cycle are dropped from dependencies.
+    """
+    graph = depgraph.DependencyGraph()
+    for package, deps in sorted(dependencies.items()):
+        graph.node(package)
+        for dep in sorted(deps):
+            graph.add_edge(package, dep)
+    order = []
+    cycles = []
+    for component in graph.sccs(range(len(graph))):
+        names = sorted(graph.names[nid] for nid in component)
+        if len(names) > 1:
+            cycles.append(names)
+            members = frozenset(names)
+            for name in names:
+                dependencies[name] = dependencies[name] - members
+        order.extend(names)
+    return order, cycles
+
+
+def upward_ranks(order, dependents, by_package):
+    """
+    {package: average compile time of the package, plus the largest rank
+    of its dependents}, for packages in order (dependencies first).
+    by_package is {package: {machine: compile_time}}.
+    """
+    rank = {}
+    for package in reversed(order):
+        machines = by_package[package]
+        rank[package] = sum(machines.values()) / len(machines) + max(
+            (rank[dependent] for dependent in dependents.get(package, ())
+             if dependent in rank), default=0)
+    return rank
+
+
+def _earliest_slot(busy, ready, duration):
+    """
+    Earliest start time >= ready of a job of duration on a machine with busy,
+    a sorted list of (start, finish).
+    """
+    # the job can't start in a gap before the last job finishing by ready
+    k = max(bisect.bisect_right(busy, (ready, float('inf'))) - 1, 0)
+    start = ready
+    for job_start, job_finish in busy[k:]:
+        if start + duration <= job_start:
+            return start
+        start = max(start, job_finish)
+    return start
+
+
+def plan(times, dependencies):
+    """
+    HEFT schedule of the packages in dependencies, {package: set of
+    packages it depends on}, with {(machine, package): compile_time} of the
+    feasible pairs.
+    Packages without a feasible machine are not built, and not waited for.
+    Returns a Plan.
+    """
+    start_time = time.monotonic()
+    by_package = collections.defaultdict(dict)
+    for (machine, package), compile_time in times.items():
+        if package in dependencies:
+            by_package[package][machine] = compile_time
+    unassigned = sorted(set(dependencies).difference(by_package))
+    dependencies = {package: set(deps).intersection(by_package)
+                    for package, deps in dependencies.items()
+                    if package in by_package}
+    order, cycles = topological_order(dependencies)
+    dependents = collections.defaultdict(list)
+    for package, deps in dependencies.items():
+        for dep in deps:
+            dependents[dep].append(package)
+
+    levels = {}
+    earliest = {}
+    for package in order:
+        deps = dependencies[package]
+        levels[package] = max((levels[dep] + 1 for dep in deps), default=0)
+        earliest[package] = max((earliest[dep] for dep in deps), default=0) + (
+            min(by_package[package].values()))
+    rank = upward_ranks(order, dependents, by_package)
+
+    busy = collections.defaultdict(list)
+    finish = {}
+    jobs = []
+    # dependents rank lower, so they come after their dependencies; ties
+    # (zero compile times) are kept in topological order
+    position = {package: k for k, package in enumerate(order)}
+    for package in sorted(order, key=lambda p: (-rank[p], position[p])):
+        ready = max((finish[dep] for dep in dependencies[package]),
+                    default=0)
+        best = None
+        for machine, compile_time in sorted(by_package[package].items()):
+            start = _earliest_slot(busy[machine], ready, compile_time)
+            if best is None or start + compile_time < best[3]:
+                best = PlannedJob(package, machine, start,
+                                  start + compile_time)
+        bisect.insort(busy[best.machine], (best.start, best.finish))
+        finish[package] = best.finish
+        jobs.append(best)
+    jobs.sort(key=lambda job: (job.start, job.machine))
+    return Plan(jobs, max(finish.values(), default=0),
+                max(earliest.values(), default=0), levels,
+                time.monotonic() - start_time, unassigned, cycles)
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Dispatching builds to machines as they become idle, instead of following a
+plan made before the build.
+
+Packages whose dependencies are built wait in a ready queue ordered by
+their upward rank (see dag.upward_ranks). An idle machine gets the first
+one it can build which wouldn't finish clearly sooner on another machine,
+counting when the busy machines are expected to be free. So the order
+follows the real progress of the machines, and a slow machine or a failed
+build only delays what depends on it.
+When the speed estimate of a machine changes, its compile times are scaled
+and the ranks of the packages not built yet are computed again.
+"""
+
+import time
+import bisect
+import collections
+
+from . import dag
+
+RunningJob = collections.namedtuple('RunningJob', (
+    'package', 'start', 'finish'))  # finish is expected
+
+
+class Dispatcher:
+    # a machine takes a package if it finishes it in at most (1 + slack)
+    # times the time the best other machine would
+    slack = 0.1
+    # builds of a package before it's failed
+    max_attempts = 2
+    # the ranks are computed again when the speed of a machine changed by
+    # this much since the last time
+    replan_threshold = 0.1
+
+    def __init__(self, times, dependencies, clock=time.monotonic):
+        """
+        times is {(machine, package): compile_time} of the feasible pairs,
+        dependencies is {package: set of packages it depends on}, as for
+        dag.plan.
+        Packages without a feasible machine are not built, and not waited
+        for.
+        """
+        self.clock = clock
+        # package -> {machine: time}
+        self.by_package = collections.defaultdict(dict)
+        for (machine, package), compile_time in times.items():
+            if package in dependencies:
+                self.by_package[package][machine] = compile_time
+        self.unassigned = sorted(
+            set(dependencies).difference(self.by_package))
+        self.dependencies = {
+            package: set(deps).intersection(self.by_package)
+            for package, deps in dependencies.items()
+            if package in self.by_package}
+        self.order, self.cycles = dag.topological_order(self.dependencies)
+        self.position = {package: k for k, package in enumerate(self.order)}
+        self.dependents = collections.defaultdict(list)
+        for package, deps in self.dependencies.items():
+            for dep in deps:
+                self.dependents[dep].append(package)
+        # package -> number of dependencies not built yet
+        self.waiting = {package: len(deps)
+                        for package, deps in self.dependencies.items()}
+        # sorted [(-rank, position, package)]
+        self.ready = []
+        # machine -> RunningJob
+        self.running = {}
+        # connected machines, and those without a job
+        self.machines = set()
+        self.idle = set()
+        self.done = set()
+        self.failed = set()
+        # not built because a dependency failed
+        self.blocked = set()
+        self.attempts = collections.Counter()
+        self.rank = {}
+        # machine -> speed factor not applied to by_package yet
+        self.drift = {}
+        self.replan()
+        for package in self.order:
+            if not self.waiting[package]:
+                self._push(package)
+
+    def _push(self, package):
+        del self.waiting[package]
+        bisect.insort(self.ready, (
+            -self.rank[package], self.position[package], package))
+
+    def replan(self):
+        """
+        Compute the ranks of the packages not built yet, and reorder the
+        ready queue.
+        """
+        if self.drift:
+            for machines in self.by_package.values():
+                for machine in machines.keys() & self.drift.keys():
+                    machines[machine] /= self.drift[machine]
+            self.drift.clear()
+        pending = set(self.waiting)
+        pending.update(package for key, pos, package in self.ready)
+        pending.update(job.package for job in self.running.values())
+        self.rank = dag.upward_ranks(
+            [package for package in self.order if package in pending],
+            self.dependents, self.by_package)
+        self.ready = sorted((-self.rank[package], pos, package)
+                            for key, pos, package in self.ready)
+
+    def update_speed(self, machine, factor):
+        """
+        machine turned out to be factor times as fast as estimated.
+        """
+        if factor <= 0 or factor == 1:
+            return
+        job = self.running.get(machine)
+        if job is not None:
+            self.running[machine] = job._replace(
+                finish=job.start + (job.finish - job.start) / factor)
+        drift = self.drift[machine] = self.drift.get(machine, 1) * factor
+        if abs(drift - 1) > self.replan_threshold:
+            self.replan()
+
+    def _available(self, machine, now):
+        job = self.running.get(machine)
+        if job is None:
+            return now
+        return max(now, job.finish)
+
+    def _pick(self, machine, now):
+        """
+        The first ready package machine can build, for which no other
+        machine is clearly better. A package left to a better machine adds
+        to its load for the next packages, so that a slower machine still
+        gets work when the better ones have enough.
+        Returns (package, compile_time) or None.
+        """
+        claimed = collections.defaultdict(float)
+        for k, (key, pos, package) in enumerate(self.ready):
+            machines = self.by_package[package]
+            compile_time = machines.get(machine)
+            if compile_time is None:
+                continue
+            compile_time /= self.drift.get(machine, 1)
+            limit = compile_time / (1 + self.slack)
+            best = None
+            for other, other_time in machines.items():
+                if other == machine or other not in self.machines:
+                    continue
+                other_time /= self.drift.get(other, 1)
+                if other_time < limit:
+                    finish = (self._available(other, now) - now +
+                              claimed[other] + other_time)
+                    if finish < limit and (best is None or finish < best[0]):
+                        best = (finish, other, other_time)
+            if best is None:
+                del self.ready[k]
+                return package, compile_time
+            claimed[best[1]] += best[2]
+        return None
+
+    def dispatch(self):
+        """
+        Start jobs on the idle machines.
+        Returns [(machine, package)] of the new jobs.
+        """
+        now = self.clock()
+        result = []
+        for machine in sorted(self.idle):
+            picked = self._pick(machine, now)
+            if picked is None:
+                continue
+            package, compile_time = picked
+            self.running[machine] = RunningJob(
+                package, now, now + compile_time)
+            self.attempts[package] += 1
+            self.idle.discard(machine)
+            result.append((machine, package))
+        return result
+
+    def machine_idle(self, machine):
+        """
+        machine is connected and waiting for a job.
+        Returns dispatch().
+        """
+        self.machines.add(machine)
+        job = self.running.pop(machine, None)
+        if job is not None:
+            # it doesn't build it any more
+            self._requeue(job.package)
+        self.idle.add(machine)
+        return self.dispatch()
+
+    def machine_lost(self, machine):
+        """
+        machine is disconnected, its job is built elsewhere.
+        Returns dispatch().
+        """
+        self.machines.discard(machine)
+        self.idle.discard(machine)
+        job = self.running.pop(machine, None)
+        if job is not None:
+            self._requeue(job.package)
+        return self.dispatch()
+
+    def _requeue(self, package):
+        self.attempts[package] -= 1
+        if package in self.done:
+            return
+        bisect.insort(self.ready, (
+            -self.rank[package], self.position[package], package))
+
+    def job_finished(self, machine, package, success=True, speed_factor=None):
+        """
+        machine finished building package, and is idle.
+        speed_factor is passed to update_speed() if given.
+        A failed package is built again up to max_attempts times, then the
+        packages depending on it are blocked.
+        Returns dispatch().
+        """
+        job = self.running.pop(machine, None)
+        if job is not None and job.package != package:
+            self._requeue(job.package)
+            job = None
+        self.machines.add(machine)
+        self.idle.add(machine)
+        if package in self.done or package in self.failed:
+            # reported twice
+            pass
+        elif not success and job is None:
+            # not its job, it's queued or running elsewhere
+            pass
+        elif success:
+            self.done.add(package)
+            if job is None:
+                # it may have been queued again
+                self.ready = [entry for entry in self.ready
+                              if entry[2] != package]
+            for dependent in self.dependents[package]:
+                if dependent in self.waiting:
+                    self.waiting[dependent] -= 1
+                    if not self.waiting[dependent]:
+                        self._push(dependent)
+        elif self.attempts[package] < self.max_attempts:
+            bisect.insort(self.ready, (
+                -self.rank[package], self.position[package], package))
+        else:
+            self.failed.add(package)
+            stack = list(self.dependents[package])
+            while stack:
+                dependent = stack.pop()
+                if self.waiting.pop(dependent, None) is not None:
+                    self.blocked.add(dependent)
+                    stack.extend(self.dependents[dependent])
+        if speed_factor:
+            self.update_speed(machine, speed_factor)
+        return self.dispatch()
+
+    def finished(self):
+        """
+        Whether nothing is ready or running any more. The packages not done
+        then are in failed, blocked or unassigned.
+        """
+        return not self.ready and not self.running
@@ -1,24 +1,71 @@
 #!/usr/bin/env python3
+import os
+import re
+import sys
 import asyncio
+import sqlite3
+import argparse
 import websockets
 from websockets import WebSocketServerProtocol
-import re
 from api_server.builder_api import BuilderAPIServer
 
 
 class APIServer:
     builder_api: BuilderAPIServer
-    def __init__(self):
-        builder_api = BuilderAPIServer()
+    def __init__(self, dispatcher=None, estimator=None, versions=None):
+        self.builder_api = BuilderAPIServer(dispatcher, estimator, versions)
 
     async def ws_handler(self, ws: WebSocketServerProtocol, path: str):
-        async for msg in ws:
-            if re.match("^/builder", path):
-                await self.builder_api.builder_handler(ws, msg)
+        try:
+            async for msg in ws:
+                if re.match("^/builder", path):
+                    await self.builder_api.builder_handler(ws, msg)
+        finally:
+            await self.builder_api.connection_closed(ws)
+
+
+def load_dispatcher(stats_db, abbs_db, build_list):
+    """
+    Returns (dispatch.Dispatcher, stats.OnlineEstimator, {package: version})
+    of building the packages in build_list, one per line, on the machines
+    in stats_db.
+    """
+    # the aoinb package, for the statistics
+    sys.path.append(os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+    from aoinb.scheduler import dag, stats
+    build_stats = stats.BuildStatistics(stats_db)
+    machines = [row[0] for row in build_stats.db.execute(
+        "SELECT id FROM aoinb_machines")]
+    with open(build_list, 'r', encoding='utf-8') as f:
+        packages = [ln.strip() for ln in f
+                    if ln.strip() and not ln.startswith('#')]
+    abbs = sqlite3.connect(abbs_db)
+    dispatcher = build_stats.dispatcher(abbs, machines, packages)
+    versions = dag.load_versions(abbs, packages)
+    abbs.close()
+    return dispatcher, stats.OnlineEstimator(build_stats), versions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Scheduler server for builders.")
+    parser.add_argument("-s", "--stats-db", help="Build statistics database")
+    parser.add_argument("-a", "--abbs-db", help="abbs meta database, for the dependencies")
+    parser.add_argument("-l", "--build-list", help="Dispatch the packages in this file, one per line, to the builders. Needs --stats-db and --abbs-db")
+    args = parser.parse_args()
+
+    dispatcher = estimator = versions = None
+    if args.build_list:
+        if not (args.stats_db and args.abbs_db):
+            parser.error("--build-list needs --stats-db and --abbs-db")
+        dispatcher, estimator, versions = load_dispatcher(
+            args.stats_db, args.abbs_db, args.build_list)
+    api_server = APIServer(dispatcher, estimator, versions)
+    start_server = websockets.serve(api_server.ws_handler, "localhost", 4000)
 
+    asyncio.get_event_loop().run_until_complete(start_server)
+    asyncio.get_event_loop().run_forever()
 
-api_server = APIServer()
-start_server = websockets.serve(api_server.ws_handler, "localhost", 4000)
 
-asyncio.get_event_loop().run_until_complete(start_server)
-asyncio.get_event_loop().run_forever()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Solvers assigning independent builds to machines, minimising the makespan.
+
+A problem is {(machine, package): compile_time} of the feasible pairs only,
+so every solver keeps the memory and disk limits checked when the times are
+computed. Packages without a feasible machine are reported as unassigned.
+"""
+
+import time
+import collections
+
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+try:
+    import pulp
+    PULP_AVAILABLE = True
+except ImportError:
+    PULP_AVAILABLE = False
+
+Schedule = collections.namedtuple('Schedule', (
+    'assignment',   # {machine: [packages]}
+    'makespan',
+    'lower_bound',  # no schedule has a smaller makespan
+    'solve_time',   # (s)
+    'solver',
+    'unassigned',   # packages without a feasible machine
+))
+
+SOLVERS = collections.OrderedDict()
+
+# 'auto' doesn't try the ILP with more (machine, package) pairs
+ILP_MAX_PAIRS = 5000
+
+
+def solver(name):
+    """
+    Register fn(problem, deadline) -> {package: machine} or None as a solver.
+    deadline is a time.monotonic() value or None.
+    """
+    def decorator(fn):
+        SOLVERS[name] = fn
+        return fn
+    return decorator
+
+
+class Problem:
+    def __init__(self, times, packages=()):
+        self.times = times
+        # package -> {machine: time}
+        self.by_package = collections.defaultdict(dict)
+        for (machine, package), compile_time in times.items():
+            self.by_package[package][machine] = compile_time
+        self.machines = sorted(set(machine for machine, package in times))
+        self.packages = sorted(self.by_package)
+        self.unassigned = sorted(set(packages).difference(self.by_package))
+
+    def lower_bound(self):
+        """
+        A lower bound of the makespan: the longest minimum time of a
+        package, or for weights s of machines,
+        sum(min(s[m] * time[m, p] for m) for p) / sum(s), which every
+        fractional schedule is above. The weights tried are all 1, and the
+        relative speeds of the machines.
+        """
+        if not self.packages:
+            return 0
+        min_times = {package: min(self.by_package[package].values())
+                     for package in self.packages}
+        ratios = collections.defaultdict(list)
+        for (machine, package), compile_time in self.times.items():
+            ratios[machine].append(min_times[package] / compile_time)
+        speeds = {}
+        for machine, values in ratios.items():
+            values.sort()
+            speeds[machine] = values[len(values) // 2]
+        bound = max(min_times.values())
+        for weights in (dict.fromkeys(self.machines, 1), speeds):
+            total = sum(min(weights[machine] * compile_time
+                            for machine, compile_time in times.items())
+                        for times in self.by_package.values())
+            bound = max(bound, total / sum(weights.values()))
+        return bound
+
+    def loads(self, assignment):
+        loads = dict.fromkeys(self.machines, 0)
+        for package, machine in assignment.items():
+            loads[machine] += self.times[machine, package]
+        return loads
+
+    def makespan(self, assignment):
+        return max(self.loads(assignment).values(), default=0)
+
+
+@solver('lpt')
+def solve_lpt(problem, deadline=None):
+    """
+    List scheduling in order of decreasing minimum time (longest processing
+    time first), each package on the machine where it finishes first.
+    """
+    loads = dict.fromkeys(problem.machines, 0)
+    assignment = {}
+    for package in sorted(problem.packages, key=lambda p: (
+        -min(problem.by_package[p].values()), p)):
+        machine = min(problem.by_package[package].items(),
+                      key=lambda x: (loads[x[0]] + x[1], x[0]))[0]
+        loads[machine] += problem.times[machine, package]
+        assignment[package] = machine
+    return assignment
+
+
+def _min_max_min(problem, sign):
+    """
+    Assign the package with the smallest (sign=1) or largest (sign=-1)
+    earliest completion time, repeatedly.
+    Assigning to a machine only changes the completion times of the
+    packages whose best machine it was. Loads only increase, so for those
+    the completion time on the other machines computed before is a lower
+    bound, and the best machines are only searched again if the new
+    completion time is beyond it.
+    Returns None without NumPy.
+    """
+    if not NUMPY_AVAILABLE:
+        return None
+    elif not problem.packages:
+        return {}
+    machine_idx = {machine: k for k, machine in enumerate(problem.machines)}
+    times = np.full((len(problem.packages), len(problem.machines)), np.inf)
+    for k, package in enumerate(problem.packages):
+        for machine, compile_time in problem.by_package[package].items():
+            times[k, machine_idx[machine]] = compile_time
+    loads = np.zeros(len(problem.machines))
+    rows = np.arange(len(problem.packages))
+
+    def best_machines(rows):
+        finish = loads + times[rows]
+        best = finish.argmin(axis=1)
+        if finish.shape[1] > 1:
+            second = np.partition(finish, 1, axis=1)[:, 1]
+        else:
+            second = np.full(len(rows), np.inf)
+        return finish[np.arange(len(rows)), best], best, second
+
+    best_finish, best_machine, second_finish = best_machines(rows)
+    # assigned packages are never chosen again
+    done = np.inf if sign > 0 else -np.inf
+    assignment = {}
+    for i in range(len(problem.packages)):
+        k = (best_finish.argmin() if sign > 0 else best_finish.argmax())
+        machine = best_machine[k]
+        assignment[problem.packages[k]] = problem.machines[machine]
+        best_finish[k] = done
+        best_machine[k] = -1
+        added = times[k, machine]
+        loads[machine] += added
+        stale = np.flatnonzero(best_machine == machine)
+        best_finish[stale] += added
+        stale = stale[best_finish[stale] > second_finish[stale]]
+        if len(stale):
+            (best_finish[stale], best_machine[stale],
+             second_finish[stale]) = best_machines(stale)
+    return assignment
+
+
+@solver('min-min')
+def solve_min_min(problem, deadline=None):
+    return _min_max_min(problem, 1)
+
+
+@solver('max-min')
+def solve_max_min(problem, deadline=None):
+    return _min_max_min(problem, -1)
+
+
+def _find_move(problem, loads, packages, makespan):
+    """
+    The best move of a package off a machine with the largest load, where
+    it's below that load on the other machine, or else the first such swap
+    with a package of the other machine.
+    Returns ((package, source, target), ...) or None.
+    """
+    times = problem.times
+    critical = [machine for machine, load in loads.items()
+                if load == makespan]
+    best = None
+    best_load = makespan
+    for machine in critical:
+        for package in packages[machine]:
+            load = loads[machine] - times[machine, package]
+            for other, other_time in problem.by_package[package].items():
+                new_load = max(load, loads[other] + other_time)
+                if other != machine and new_load < best_load:
+                    best = ((package, machine, other),)
+                    best_load = new_load
+    if best:
+        return best
+    for machine in critical:
+        for package in packages[machine]:
+            load = loads[machine] - times[machine, package]
+            for other, other_time in problem.by_package[package].items():
+                if other == machine:
+                    continue
+                # the swapped package must take longer than this on other
+                limit = loads[other] + other_time - makespan
+                for swapped in packages[other]:
+                    swapped_time = times.get((machine, swapped))
+                    if (swapped_time is not None and
+                        load + swapped_time < makespan and
+                        times[other, swapped] > limit):
+                        return ((package, machine, other),
+                                (swapped, other, machine))
+    return None
+
+
+def improve(problem, assignment, deadline=None):
+    """
+    Local search: move a package off a machine with the largest load, or
+    swap it with a package of another machine, while both machines end up
+    below that load, until there's no such move or the deadline.
+    Changes assignment in place and returns it.
+    """
+    loads = problem.loads(assignment)
+    packages = collections.defaultdict(set)
+    for package, machine in assignment.items():
+        packages[machine].add(package)
+    times = problem.times
+    while deadline is None or time.monotonic() < deadline:
+        move = _find_move(problem, loads, packages,
+                          max(loads.values(), default=0))
+        if move is None:
+            break
+        for moved, source, target in move:
+            loads[source] -= times[source, moved]
+            loads[target] += times[target, moved]
+            packages[source].discard(moved)
+            packages[target].add(moved)
+            assignment[moved] = target
+    return assignment
+
+
+@solver('ilp')
+def solve_ilp(problem, deadline=None):
+    """
+    Integer linear program with a binary variable for each feasible pair,
+    solved with GLPK. Returns None if GLPK is not available, or finds no
+    integer solution before the deadline.
+    """
+    if not PULP_AVAILABLE or not problem.packages:
+        return None
+    options = ['--cuts']
+    if deadline is not None:
+        time_limit = int(deadline - time.monotonic())
+        if time_limit < 1:
+            return None
+        options.extend(('--tmlim', str(time_limit)))
+    model = pulp.LpProblem("WorkerSched", pulp.LpMinimize)
+    max_time = pulp.LpVariable("m", 0)
+    variables = {}
+    machine_time = collections.defaultdict(int)
+    package_constr = collections.defaultdict(int)
+    for k, ((machine, package), compile_time) in enumerate(
+        sorted(problem.times.items())):
+        var = variables[machine, package] = pulp.LpVariable(
+            "a%d" % k, 0, cat="Binary")
+        machine_time[machine] += var * compile_time
+        package_constr[package] += var
+    for row in machine_time.values():
+        model += max_time >= row
+    for row in package_constr.values():
+        model += row == 1
+    # objective function
+    model += max_time
+    try:
+        model.solve(pulp.GLPK(msg=False, options=options))
+    except pulp.PulpSolverError:
+        return None
+    assignment = {}
+    for (machine, package), var in variables.items():
+        if round(var.varValue or 0):
+            assignment[package] = machine
+    if len(assignment) != len(problem.packages):
+        return None
+    return assignment
+
+
+def schedule(times, packages=(), solver='auto', time_limit=10):
+    """
+    Assign packages to machines with {(machine, package): compile_time} of
+    the feasible pairs.
+    solver is a name in SOLVERS, 'heuristic' for the best of the heuristics,
+    or 'auto' to also try the ILP if the problem is small enough, and keep
+    the heuristic solution if it finds nothing better in time.
+    Heuristic solutions are improved by local search, sharing time_limit
+    (s), or half of it when the ILP is tried. None is no limit.
+    Returns a Schedule.
+    """
+    start = time.monotonic()
+    deadline = None if time_limit is None else start + time_limit
+    problem = Problem(times, packages)
+    lower_bound = problem.lower_bound()
+    if solver in ('auto', 'heuristic'):
+        candidates = ['lpt', 'min-min', 'max-min']
+        if (solver == 'auto' and PULP_AVAILABLE and
+            len(times) <= ILP_MAX_PAIRS):
+            candidates.append('ilp')
+    else:
+        candidates = [solver]
+    heuristic_deadline = deadline
+    if deadline is not None and 'ilp' in candidates and len(candidates) > 1:
+        heuristic_deadline = start + time_limit / 2
+    heuristics = [name for name in candidates if name != 'ilp']
+    best = best_name = None
+    best_makespan = None
+    for name in candidates:
+        if name == 'ilp':
+            if best_makespan is not None and best_makespan <= lower_bound:
+                # already optimal
+                break
+            assignment = SOLVERS[name](problem, deadline)
+        else:
+            assignment = SOLVERS[name](problem, deadline)
+            heuristics.remove(name)
+            if assignment is not None:
+                # the rest of the time is shared with the next heuristics
+                improve_deadline = heuristic_deadline
+                if heuristic_deadline is not None:
+                    now = time.monotonic()
+                    improve_deadline = now + max(
+                        0, heuristic_deadline - now) / (len(heuristics) + 1)
+                improve(problem, assignment, improve_deadline)
+        if assignment is None:
+            continue
+        makespan = problem.makespan(assignment)
+        if best is None or makespan < best_makespan:
+            best, best_name, best_makespan = assignment, name, makespan
+    result = collections.defaultdict(list)
+    for package, machine in sorted((best or {}).items()):
+        result[machine].append(package)
+    return Schedule(dict(result), best_makespan, lower_bound,
+                    time.monotonic() - start, best_name, problem.unassigned)
@@ -10,19 +10,43 @@ import collections
 
 try:
     import numpy as np
-    import scipy.stats
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+try:
     import scipy.sparse
     import scipy.sparse.linalg
-    SCIPY_AVAILABLE = True
+    SCIPY_AVAILABLE = NUMPY_AVAILABLE
 except ImportError:
     SCIPY_AVAILABLE = False
 
-try:
-    import pulp
-    from pulp.solvers import GLPK
-    PULP_AVAILABLE = True
-except ImportError:
-    PULP_AVAILABLE = False
+from . import dag
+from . import solvers
+from . import dispatch
+from ..common import vercomp
+
+
+def _linear_regressions(groups, x, y, group_num):
+    """
+    Least squares (slope, intercept) of y = slope * x + intercept for each
+    group, as arrays indexed by the group numbers in groups.
+    A group with only one distinct x gets slope 0 and the mean of y, an
+    empty group gets (0, 0).
+    """
+    count = np.bincount(groups, minlength=group_num)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_x = np.bincount(groups, x, group_num) / count
+        mean_y = np.bincount(groups, y, group_num) / count
+    dx = x - mean_x[groups]
+    sxx = np.bincount(groups, dx * dx, group_num)
+    sxy = np.bincount(groups, dx * (y - mean_y[groups]), group_num)
+    slope = np.zeros(group_num)
+    np.divide(sxy, sxx, out=slope, where=sxx > 0)
+    intercept = np.zeros(group_num)
+    nonempty = count > 0
+    intercept[nonempty] = (mean_y - slope * mean_x)[nonempty]
+    return slope, intercept
 
 
 class BuildStatistics:
@@ -32,6 +56,7 @@ class BuildStatistics:
 
     def __init__(self, dbconn):
         self.db = sqlite3.connect(dbconn)
+        vercomp.register(self.db)
 
     def init_db(self):
         cur = self.db.cursor()
@@ -71,8 +96,8 @@ class BuildStatistics:
             "real_time INTEGER,"  # (ns)
             "mem_max INTEGER,"
             "disk_usage INTEGER,"
-            "start_time INTEGER"
-            "end_time INTEGER"
+            "start_time INTEGER,"
+            "end_time INTEGER,"
             "result TEXT,"
             "source TEXT,"
             "spec_version TEXT"
@@ -80,6 +105,14 @@ class BuildStatistics:
         self.db.commit()
 
     def calc_params(self):
+        """
+        Estimate machine speeds and package parameters from the successful
+        builds in aoinb_build_log.
+        The log is loaded as column arrays, and the regressions and the
+        least squares system of all packages are computed at once.
+        Without SciPy, the speeds and works keep their defaults; without
+        NumPy, the regressions are also replaced by the mean.
+        """
         cur = self.db.cursor()
         avg_speeds = {}
         for arch, speed in cur.execute(
@@ -90,169 +123,500 @@ class BuildStatistics:
             "SELECT package, arch, avg(work) "
             "FROM aoinb_package_params GROUP BY package, arch"):
             avg_work[package, arch] = work
-        cur.execute("""
+        if not NUMPY_AVAILABLE:
+            self._calc_params_simple(avg_speeds, avg_work)
+            return
+        log = self._load_build_log()
+        if log is None:
+            return
+        pkg_keys = log['pkg_keys']
+        machine_ids = log['machine_ids']
+        pkg_idx = log['package']
+        machine_idx = log['machine']
+        package_num = len(pkg_keys)
+        machine_num = len(machine_ids)
+        # the default speed of a machine is from the arch of the last
+        # package built on it, for machines without usable builds
+        last_row = len(machine_idx) - 1 - np.unique(
+            machine_idx[::-1], return_index=True)[1]
+        v_machines = np.array([
+            avg_speeds.get(pkg_keys[pkg_idx[k]][1], self.default_speed)
+            for k in last_row.tolist()], dtype=float)
+        w_packages = np.array([
+            avg_work.get(key[:2], self.default_work) for key in pkg_keys],
+            dtype=float)
+
+        cpu_count = log['cpu_count']
+        cpu_time = log['cpu_time']
+        real_time = log['real_time']
+        valid = real_time > 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            prate = np.maximum(0, cpu_time / real_time - 1)
+        prate_slope, prate_intercept = _linear_regressions(
+            pkg_idx[valid], cpu_count[valid], prate[valid], package_num)
+        mem = log['mem_max']
+        valid = ~np.isnan(mem) & (mem != 0)
+        mem_slope, mem_intercept = _linear_regressions(
+            pkg_idx[valid], cpu_count[valid], mem[valid], package_num)
+        disk = np.nan_to_num(log['disk_usage'])
+        max_disk = np.maximum.reduceat(
+            np.maximum(disk, 0), np.flatnonzero(np.diff(pkg_idx, prepend=-1)))
+
+        # the latest build of each package on each machine
+        last = np.flatnonzero(np.diff(
+            pkg_idx * machine_num + machine_idx, append=-1))
+        last = last[cpu_time[last] > 0]
+        ref_pkgs = np.flatnonzero(
+            np.asarray([key[0] for key in pkg_keys]) == self.ref_package)
+        if SCIPY_AVAILABLE:
+            log_v, log_w = self._estimate_params(
+                machine_idx[last], pkg_idx[last],
+                np.log(cpu_time[last] / 1e9),
+                machine_num, package_num, ref_pkgs)
+            has_data = np.bincount(
+                machine_idx[last], minlength=machine_num) > 0
+            v_machines[has_data] = np.exp(log_v[has_data])
+            has_data = np.bincount(pkg_idx[last], minlength=package_num) > 0
+            w_packages[has_data] = np.exp(log_w[has_data])
+        else:
+            w_packages[ref_pkgs] = 1
+
+        cur.executemany(
+            "UPDATE aoinb_machines SET speed=? WHERE id=?",
+            zip(v_machines.tolist(), machine_ids))
+        upd = int(time.time())
+        cur.executemany(
+            "INSERT OR REPLACE INTO aoinb_package_params "
+            "(package, arch, version, work, prate_slope, prate_intercept, "
+            " mem_slope, mem_intercept, disk_usage, updated) "
+            "VALUES (?,?,?,?,?,?,?,?,?,?)",
+            (key + row + (upd,) for key, row in zip(pkg_keys, zip(
+                w_packages.tolist(), prate_slope.tolist(),
+                prate_intercept.tolist(), mem_slope.tolist(),
+                mem_intercept.tolist(), max_disk.astype(np.int64).tolist())))
+        )
+        self.db.commit()
+
+    def _calc_params_simple(self, avg_speeds, avg_work):
+        """
+        calc_params without NumPy: the machines get the average speed of
+        their arch and the packages the average work of their other
+        versions, and the prate and memory use are the mean of the builds.
+        """
+        cur = self.db.cursor()
+        v_machines = {}
+        package_params = {}
+        rows = cur.execute("""
         SELECT
           bl.package, bl.arch, bl.version, bl.machine_id,
-          bl.cpu_time, bl.real_time, bl.mem_max, bl.disk_usage, am.cpu_count
+          bl.cpu_time, bl.real_time, bl.mem_max, bl.disk_usage
         FROM aoinb_build_log bl
         INNER JOIN aoinb_machines am
         ON bl.machine_id = am.id
         AND bl.start_time > am.valid_from
         WHERE bl.result = 'success'
-        ORDER BY bl.package, bl.arch, bl.version, bl.machine_id, bl.start_time DESC
-        """)
-        machines = {}
-        machine_num = 0
-        packages = {}
-        package_num = 0
-        v_machines = {}
-        w_packages = {}
-        package_params = {}
-        data = {}
-        for pkg_key, group in itertools.groupby(cur, operator.itemgetter(0, 1, 2)):
-            max_disk = 0
-            last_machine = None
-            packages[pkg_key] = package_num
-            w_packages[pkg_key] = avg_work.get(pkg_key[:2], self.default_work)
+        ORDER BY bl.package, bl.arch, bl.version, bl.machine_id, bl.start_time
+        """).fetchall()
+        for pkg_key, group in itertools.groupby(
+                rows, operator.itemgetter(0, 1, 2)):
             prates = []
-            max_mems = []
+            mems = []
+            max_disk = 0
             for row in group:
-                (package, arch, version, machine_id,
-                 cpu_time, real_time, mem, disk, cpu_count) = row
+                machine_id, cpu_time, real_time, mem, disk = row[3:]
+                v_machines[machine_id] = avg_speeds.get(
+                    pkg_key[1], self.default_speed)
+                if real_time and real_time > 0:
+                    prates.append(max(0, (cpu_time or 0) / real_time - 1))
                 if mem:
-                    max_mems.append((cpu_count, mem))
+                    mems.append(mem)
                 if disk:
                     max_disk = max(max_disk, disk)
-                prates.append((cpu_count, max(0, (cpu_time/real_time - 1))))
-                if machine_id != last_machine:
-                    v_machines[machine_id] = avg_speeds.get(
-                        arch, self.default_speed)
-                    machine_idx = machines.get(machine_id, machine_num)
-                    if machine_idx == machine_num:
-                        machines[machine_id] = machine_num
-                        machine_num += 1
-                    data[machine_idx, package_num] = cpu_time / 1e9
-                last_machine = machine_id
+            if pkg_key[0] == self.ref_package:
+                work = 1
+            else:
+                work = avg_work.get(pkg_key[:2], self.default_work)
             package_params[pkg_key] = (
-                self._linear_regression(prates) +
-                self._linear_regression(max_mems) + (max_disk,)
-            )
-            package_num += 1
-        if SCIPY_AVAILABLE:
-            results = self._estimate_params(
-                data, machines, packages)
-            v_machines.update(results[0])
-            w_packages.update(results[1])
-        for machine_id, value in v_machines.items():
-            cur.execute("UPDATE aoinb_machines SET speed=? WHERE id=?",
-                        (value, machine_id))
-        for key, value in w_packages.items():
-            upd = (int(time.time()),)
-            cur.execute(
-                "INSERT OR REPLACE INTO aoinb_package_params "
-                "(package, arch, version, work, prate_slope, prate_intercept, "
-                " mem_slope, mem_intercept, disk_usage, updated) "
-                "VALUES (?,?,?,?,?,?,?,?,?)",
-                key + (value,) + package_params[key] + upd
-            )
+                work, 0, sum(prates) / len(prates) if prates else 0,
+                0, sum(mems) / len(mems) if mems else 0, int(max_disk))
+        cur.executemany(
+            "UPDATE aoinb_machines SET speed=? WHERE id=?",
+            ((speed, machine_id) for machine_id, speed in v_machines.items()))
+        upd = int(time.time())
+        cur.executemany(
+            "INSERT OR REPLACE INTO aoinb_package_params "
+            "(package, arch, version, work, prate_slope, prate_intercept, "
+            " mem_slope, mem_intercept, disk_usage, updated) "
+            "VALUES (?,?,?,?,?,?,?,?,?,?)",
+            (key + row + (upd,) for key, row in package_params.items()))
         self.db.commit()
 
-    def _linear_regression(self, data):
-        if not data:
-            return 0, 0
-        elif len(data) == 1:
-            return 0, data[0][1]
-        if SCIPY_AVAILABLE:
-            arr = np.array(data).T
-            if np.all(arr[1]) == 0:
-                return 0, 0
-            result = scipy.stats.linregress(arr[0], arr[1])
-            return result[:2]
-        else:
-            y_sum = sum(row[1] for row in data)
-            return 0, y_sum / len(data)
-
-    def _estimate_params(self, data, machines, packages):
-        ref_pkg_idx = packages.get(self.ref_package)
-        machine_num = len(machines)
-        package_num = len(packages)
-        colnum = machine_num + package_num
-        datapoints = len(data)
-        data_keys = [None] * datapoints
-        if ref_pkg_idx is not None:
-            datapoints += 1
-        mtx_dok = scipy.sparse.dok_matrix((datapoints, colnum))
-        mtx_b = np.empty(shape=(datapoints,))
-        if ref_pkg_idx is not None:
-            mtx_dok[-1, machine_num+ref_pkg_idx] = 1
-            mtx_b[-1] = 0
-        for k, row in enumerate(data.items()):
-            machine_idx, package_idx = data_keys[k] = row[0]
-            mtx_dok[k, machine_idx] = -1
-            mtx_dok[k, machine_num+package_idx] = 1
-            mtx_b[k] = math.log(row[1])
-        matrix = mtx_dok.tocsr()
-        result = scipy.sparse.linalg.lsqr(matrix, mtx_b)
-        result_params = np.exp(result[0])
-        v_machines = {}
-        w_packages = {}
-        for name, idx in machines.items():
-            v_machines[name] = result_params[idx]
-        for name, idx in packages.items():
-            w_packages[name] = result_params[machine_num+idx]
-        return v_machines, w_packages
+    def _load_build_log(self):
+        """
+        Load the successful builds as column arrays, sorted by package key,
+        machine and start time.
+        Returns a dict of the columns, with the package keys and machine ids
+        numbered in 'package' and 'machine', or None if there are no builds.
+        """
+        rows = self.db.execute("""
+        SELECT
+          bl.package, bl.arch, bl.version, bl.machine_id,
+          bl.cpu_time, bl.real_time, bl.mem_max, bl.disk_usage, am.cpu_count,
+          bl.start_time
+        FROM aoinb_build_log bl
+        INNER JOIN aoinb_machines am
+        ON bl.machine_id = am.id
+        AND bl.start_time > am.valid_from
+        WHERE bl.result = 'success'
+        """).fetchall()
+        if not rows:
+            return None
+        columns = list(zip(*rows))
+        pkg_ids = []
+        pkg_names = []
+        for col in columns[:3]:
+            names, ids = np.unique(np.asarray(col), return_inverse=True)
+            pkg_names.append(names.tolist())
+            pkg_ids.append(ids)
+        dims = tuple(len(names) for names in pkg_names)
+        pkg_codes, pkg_idx = np.unique(
+            np.ravel_multi_index(pkg_ids, dims), return_inverse=True)
+        machine_ids, machine_idx = np.unique(
+            np.asarray(columns[3]), return_inverse=True)
+        start_time = np.asarray(columns[9])
+        order = np.lexsort((start_time, machine_idx, pkg_idx))
+        key_ids = np.unravel_index(pkg_codes, dims)
+        log = {
+            'pkg_keys': list(zip(*(
+                [names[i] for i in ids.tolist()]
+                for names, ids in zip(pkg_names, key_ids)))),
+            'machine_ids': machine_ids.tolist(),
+            'package': pkg_idx[order],
+            'machine': machine_idx[order],
+        }
+        for name, col in zip(('cpu_time', 'real_time', 'mem_max',
+                              'disk_usage', 'cpu_count'), columns[4:9]):
+            log[name] = np.array(col, dtype=float)[order]
+        return log
 
-    def schedule_work(self, machines, packages):
+    def _estimate_params(self, machine_idx, package_idx, log_time,
+                         machine_num, package_num, ref_pkgs=()):
         """
-        Use linear programming to schedule work among machines.
-        Returns ({machine: packages}, total_time)
+        Solve log(time) = log(w_package) - log(v_machine) for the log speed
+        of machines and log work of packages, in the least squares sense.
+        ref_pkgs are fixed to log(w) = 0.
+        Returns (log_v, log_w) arrays.
+        """
+        datapoints = len(log_time)
+        rows = np.arange(datapoints)
+        ref_rows = np.arange(datapoints, datapoints + len(ref_pkgs))
+        matrix = scipy.sparse.coo_matrix((
+            np.concatenate((np.full(datapoints, -1.), np.ones(datapoints),
+                            np.ones(len(ref_pkgs)))),
+            (np.concatenate((rows, rows, ref_rows)),
+             np.concatenate((machine_idx, machine_num + package_idx,
+                             machine_num + np.asarray(ref_pkgs, dtype=int))))
+        ), shape=(datapoints + len(ref_pkgs), machine_num + package_num)
+        ).tocsr()
+        mtx_b = np.concatenate((log_time, np.zeros(len(ref_pkgs))))
+        result = scipy.sparse.linalg.lsqr(matrix, mtx_b)[0]
+        return result[:machine_num], result[machine_num:]
+
+    def compile_times(self, machines, packages):
+        """
+        Estimated compile time of packages on machines, for the pairs where
+        the memory and disk usage of the package fit the machine, as
+        {(machine, package): compile_time}.
+        The latest parameters of a package are used, and of those updated
+        at the same time, the ones of the newest version.
         """
-        if not machines or packages:
-            return {}, None
-        elif len(machines) == 1:
-            return {machines[0]: packages}, None
         cur = self.db.cursor()
-        cur.execute("CREATE TEMPORARY TABLE t_machines (id TEXT PRIMARY KEY)")
-        for machine in machines:
-            cur.execute("INSERT OR IGNORE INTO t_machines VALUES (?)", (machine,))
-        cur.execute("CREATE TEMPORARY TABLE t_packages (name TEXT PRIMARY KEY)")
-        for package in packages:
-            cur.execute("INSERT OR IGNORE INTO t_packages VALUES (?)", (package,))
+        cur.execute("CREATE TEMPORARY TABLE IF NOT EXISTS t_machines "
+                    "(id TEXT PRIMARY KEY)")
+        cur.execute("DELETE FROM t_machines")
+        cur.executemany("INSERT OR IGNORE INTO t_machines VALUES (?)",
+                        ((machine,) for machine in machines))
+        cur.execute("CREATE TEMPORARY TABLE IF NOT EXISTS t_packages "
+                    "(name TEXT PRIMARY KEY)")
+        cur.execute("DELETE FROM t_packages")
+        cur.executemany("INSERT OR IGNORE INTO t_packages VALUES (?)",
+                        ((package,) for package in packages))
+        # calc_params updates all rows at the same time
         cur.execute("""
+            WITH latest AS (
+              SELECT * FROM (
+                SELECT *, row_number() OVER (
+                  PARTITION BY package, arch
+                  ORDER BY updated DESC, vercomp_key(version) DESC,
+                  version DESC) num
+                FROM aoinb_package_params
+                WHERE package IN (SELECT name FROM t_packages)
+              ) WHERE num = 1
+            )
             SELECT
               m.id machine, p.package package,
               p.work / (m.speed * (1 + (m.cpu_count-1)*(
-                p.prate_slope*m.cpu_count + p.prate_intercept))) compile_time
+                p.prate_slope*m.cpu_count + p.prate_intercept))) compile_time,
+              (p.mem_slope*m.cpu_count + p.mem_intercept <= m.mem_avail
+               AND p.disk_usage <= m.disk_avail) feasible
             FROM aoinb_machines m
-            INNER JOIN aoinb_package_params p ON p.arch=m.arch
-            AND p.mem_slope*m.cpu_count + p.mem_intercept <= m.mem_avail
-            AND p.disk_usage <= m.disk_avail
+            INNER JOIN latest p ON p.arch=m.arch
             WHERE m.id IN (SELECT id FROM t_machines)
-            AND p.package IN (SELECT name FROM t_packages)
-            ORDER BY m.id, p.package
         """)
-        model = pulp.LpProblem("WorkerSched", pulp.LpMinimize)
-        assignment = {}
-        max_time = pulp.LpVariable("m", 0)
-        package_constr = collections.defaultdict(int)
-        for machine, group in itertools.groupby(cur, operator.itemgetter(0)):
-            machine_time = 0
-            for _, package, compile_time in group:
-                assign_var = pulp.LpVariable(
-                    "a_%s_%s" % (machine, package), 0, cat="Binary")
-                assignment[machine, package] = assign_var
-                machine_time += assign_var * compile_time
-                package_constr[package] += assign_var
-            model += max_time >= machine_time
-        for row in package_constr.values():
-            model += row == 1
-        # objective function
-        model += max_time
-        model.solve(GLPK(options=['--cuts']))
-
-        results = collections.defaultdict(list)
-        for key, var in assignment.items():
-            if round(var.varValue or 0):
-                machine, package = key
-                results[machine].append(package)
-        return results, pulp.value(max_time)
+        return {(machine, package): compile_time
+                for machine, package, compile_time, feasible in cur
+                if feasible and compile_time is not None}
+
+    def schedule(self, machines, packages, solver='auto', time_limit=10):
+        """
+        Schedule work among machines with a solver in solvers.SOLVERS, or
+        'heuristic' or 'auto' (see solvers.schedule).
+        Returns a solvers.Schedule, with the makespan, its lower bound and
+        the solve time.
+        """
+        return solvers.schedule(self.compile_times(machines, packages),
+                                packages, solver, time_limit)
+
+    def schedule_work(self, machines, packages):
+        """
+        Schedule work among machines, with linear programming if it's done
+        in time, otherwise with heuristics.
+        Returns ({machine: packages}, total_time)
+        """
+        if not machines or not packages:
+            return {}, None
+        elif len(machines) == 1:
+            return {machines[0]: packages}, None
+        result = self.schedule(machines, packages)
+        return result.assignment, result.makespan
+
+    def plan_builds(self, abbs_db, machines, packages):
+        """
+        Timed plan of building packages on machines in the order of their
+        PKGDEP/BUILDDEP dependencies, from abbs_db, a connection to an abbs
+        meta database.
+        Returns a dag.Plan.
+        """
+        return dag.plan(self.compile_times(machines, packages),
+                        dag.load_dependencies(abbs_db, packages))
+
+    def dispatcher(self, abbs_db, machines, packages):
+        """
+        dispatch.Dispatcher of building packages on machines, with the
+        dependencies from abbs_db as for plan_builds.
+        """
+        return dispatch.Dispatcher(self.compile_times(machines, packages),
+                                   dag.load_dependencies(abbs_db, packages))
+
+
+class OnlineEstimator:
+    """
+    Incremental estimates of machine speed and package work, updated by
+    each finished build instead of solving the whole build log again.
+
+    A build is an observation log(cpu_time) = log(work) - log(speed). It
+    updates the two parameters like recursive least squares (a Kalman
+    filter), with a variance for each parameter. The variances are divided
+    by forgetting before each update, so that old builds lose weight and the
+    estimates follow machines and packages that change.
+    Initial values are from aoinb_machines and aoinb_package_params, as
+    written by BuildStatistics.calc_params, with a variance of noise_var
+    divided by the number of builds they were fitted on. The variances are
+    only kept in memory.
+    The first build of a package without any parameters only sets its work,
+    since the default work says nothing about the machine.
+
+    The builds of other packages can't tell if all speeds and works of an
+    arch are off by the same factor, only those of ref_package can, whose
+    work is 1. So this common factor is a parameter of its own, updated by
+    the builds of ref_package, and all speeds and works of the arch are
+    scaled when it changes.
+    """
+    # per update of a parameter
+    forgetting = 0.95
+    # of log(cpu_time) of a build
+    noise_var = 0.04
+    # of a parameter without an estimate, also the upper limit
+    prior_var = 1.0
+
+    def __init__(self, stats):
+        self.stats = stats
+        self.db = stats.db
+        # machine_id -> [log(speed), variance]
+        self.machines = {}
+        # (package, arch, version) -> [log(work), variance]
+        self.packages = {}
+        # package keys at the default work
+        self.new_packages = set()
+        # arch -> variance of the common factor of the arch
+        self.scales = {}
+        # machine_id -> arch it builds
+        self.machine_archs = {}
+        # machine_id, (package, arch) or (package, arch, version) -> number
+        # of successful builds in the log, loaded on first use
+        self.build_counts = None
+
+    def _build_count(self, key):
+        if self.build_counts is None:
+            self.build_counts = collections.Counter()
+            for package, arch, version, machine_id, count in self.db.execute(
+                "SELECT package, arch, version, machine_id, count(*) "
+                "FROM aoinb_build_log WHERE result='success' AND cpu_time > 0 "
+                "GROUP BY package, arch, version, machine_id"):
+                self.build_counts[machine_id] += count
+                self.build_counts[package, arch] += count
+                self.build_counts[package, arch, version] += count
+        return self.build_counts[key]
+
+    def _fitted_var(self, key):
+        """
+        Variance of a parameter fitted on the builds of key, a machine id or
+        package key.
+        """
+        return self.noise_var / max(self._build_count(key), 1)
+
+    def _machine(self, machine_id):
+        param = self.machines.get(machine_id)
+        if param is not None:
+            return param
+        row = self.db.execute(
+            "SELECT m.speed, (SELECT avg(speed) FROM aoinb_machines "
+            "WHERE arch=m.arch) FROM aoinb_machines m WHERE m.id=?",
+            (machine_id,)).fetchone()
+        speed = None
+        variance = self.prior_var
+        if row is not None:
+            speed = row[0] or row[1]
+            if row[0]:
+                variance = self._fitted_var(machine_id)
+        param = self.machines[machine_id] = [
+            math.log(speed or self.stats.default_speed), variance]
+        return param
+
+    def _package(self, key):
+        param = self.packages.get(key)
+        if param is not None:
+            return param
+        row = self.db.execute(
+            "SELECT work FROM aoinb_package_params "
+            "WHERE package=? AND arch=? AND version=?", key).fetchone()
+        if row is not None and row[0]:
+            work = row[0]
+            variance = self._fitted_var(key)
+        else:
+            # other versions
+            work = self.db.execute(
+                "SELECT avg(work) FROM aoinb_package_params "
+                "WHERE package=? AND arch=?", key[:2]).fetchone()[0]
+            if work:
+                variance = self._fitted_var(key[:2])
+            else:
+                work = self.stats.default_work
+                variance = self.prior_var
+                self.new_packages.add(key)
+        if key[0] == self.stats.ref_package:
+            # it fixes the scale of work and speed
+            variance = 0
+            self.new_packages.discard(key)
+        param = self.packages[key] = [math.log(work), variance]
+        return param
+
+    def _scale_var(self, arch):
+        variance = self.scales.get(arch)
+        if variance is None:
+            count = self._build_count((self.stats.ref_package, arch))
+            variance = self.scales[arch] = (
+                self.noise_var / count if count else self.prior_var)
+        return variance
+
+    def _rescale(self, arch, log_factor, cur):
+        """
+        Multiply all speeds and works of arch by exp(log_factor), except the
+        work of ref_package.
+        """
+        for machine_id, param in self.machines.items():
+            if self.machine_archs.get(machine_id) == arch:
+                param[0] += log_factor
+        for key, param in self.packages.items():
+            if key[1] == arch and key[0] != self.stats.ref_package:
+                param[0] += log_factor
+        factor = math.exp(log_factor)
+        cur.execute("UPDATE aoinb_machines SET speed=speed*? WHERE arch=?",
+                    (factor, arch))
+        cur.execute("UPDATE aoinb_package_params SET work=work*? "
+                    "WHERE arch=? AND package!=?",
+                    (factor, arch, self.stats.ref_package))
+
+    def estimate(self, package, arch, version, machine_id):
+        """
+        Estimated cpu time (s) of a build of package on machine_id.
+        """
+        log_w = self._package((package, arch, version))[0]
+        log_v = self._machine(machine_id)[0]
+        return math.exp(log_w - log_v)
+
+    def speed(self, machine_id):
+        """
+        Estimated speed of machine_id.
+        """
+        return math.exp(self._machine(machine_id)[0])
+
+    def job_finished(self, package, arch, version, machine_id, cpu_time,
+                     commit=True):
+        """
+        Update the estimates with a successful build which took cpu_time
+        (ns), and write them to aoinb_machines and aoinb_package_params.
+        Returns (speed, work), or None if cpu_time is not positive or the
+        version is unknown.
+        """
+        if not cpu_time or cpu_time <= 0 or version is None:
+            return None
+        key = (package, arch, version)
+        w_param = self._package(key)
+        v_param = self._machine(machine_id)
+        self.machine_archs[machine_id] = arch
+        log_time = math.log(cpu_time / 1e9)
+        cur = self.db.cursor()
+        if key in self.new_packages:
+            # the work as measured with the machine
+            self.new_packages.discard(key)
+            w_param[0] = log_time + v_param[0]
+            w_param[1] = min(v_param[1] + self.noise_var, self.prior_var)
+        elif package == self.stats.ref_package:
+            # the speed of the machine is the common factor of the arch
+            # times its own factor
+            scale_var = min(self._scale_var(arch) / self.forgetting,
+                            self.prior_var)
+            v_param[1] = min(v_param[1] / self.forgetting, self.prior_var)
+            residual = log_time - (w_param[0] - v_param[0])
+            total_var = scale_var + v_param[1] + self.noise_var
+            v_param[0] -= v_param[1] / total_var * residual
+            v_param[1] -= v_param[1] ** 2 / total_var
+            self.scales[arch] = scale_var - scale_var ** 2 / total_var
+            self._rescale(arch, -scale_var / total_var * residual, cur)
+        else:
+            w_param[1] = min(w_param[1] / self.forgetting, self.prior_var)
+            v_param[1] = min(v_param[1] / self.forgetting, self.prior_var)
+            residual = log_time - (w_param[0] - v_param[0])
+            total_var = w_param[1] + v_param[1] + self.noise_var
+            w_param[0] += w_param[1] / total_var * residual
+            v_param[0] -= v_param[1] / total_var * residual
+            w_param[1] -= w_param[1] ** 2 / total_var
+            v_param[1] -= v_param[1] ** 2 / total_var
+        speed = math.exp(v_param[0])
+        work = math.exp(w_param[0])
+        cur.execute("UPDATE aoinb_machines SET speed=? WHERE id=?",
+                    (speed, machine_id))
+        upd = int(time.time())
+        cur.execute(
+            "UPDATE aoinb_package_params SET work=?, updated=? "
+            "WHERE package=? AND arch=? AND version=?", (work, upd) + key)
+        if not cur.rowcount:
+            cur.execute(
+                "INSERT INTO aoinb_package_params "
+                "(package, arch, version, work, prate_slope, prate_intercept, "
+                " mem_slope, mem_intercept, disk_usage, updated) "
+                "VALUES (?,?,?,?,0,0,0,0,0,?)", key + (work, upd))
+        if commit:
+            self.db.commit()
+        return speed, work
@@ -0,0 +1,201 @@
+import os
+import sys
+import random
+import tempfile
+import unittest
+import warnings
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', 'aoinb', 'common'))
+
+import bashvar
+
+# spec and defines files
+CORPUS = (
+    '',
+    '\n\n',
+    'VER=5.1\nSRCTBL="https://ftp.gnu.org/gnu/bash/bash-$VER.tar.gz"\n'
+    'CHKSUM="sha256::cc012bc860406dcf42f64431bcd3d2fa7560c02915a601aba9cd'
+    '597a39329baa"\n',
+    'VER=2.30\nREL=1\n'
+    'SRCS="tbl::https://ftp.gnu.org/gnu/glibc/glibc-${VER}.tar.xz"\n'
+    'CHKSUMS="SKIP"\n',
+    'VER=1.2.3\nSRCTBL="https://example.org/${VER%.*}/foo-${VER}.tar.gz"\n'
+    'SUBDIR="foo-${VER//./_}"\nMAJOR=${VER%%.*}\nMINOR=${VER#*.}\n'
+    'LAST=${VER##*.}\n',
+    'VER=20200101\nSHORT=${VER:2}\nYEAR=${VER:0:4}\nDAY=${VER: -2}\n'
+    'MID=${VER:4:-2}\n',
+    'PKGNAME=bash\nPKGSEC=shells\n'
+    'PKGDEP="glibc ncurses readline"\n'
+    'BUILDDEP="bison texinfo"\n'
+    "PKGDES='The GNU Bourne Again shell'\n",
+    'PKGNAME=gcc\nPKGDEP="binutils glibc \\\n    isl libmpc"\n'
+    'PKGDEP__RETRO="${PKGDEP/isl /}"\n'
+    'PKGBREAK="gcc-runtime<=1:8.3.0"\n',
+    '# comment\nPKGNAME=foo  # trailing\n\t# indented\n  PKGVER=1\n',
+    'A=x\nB="$A$A"\'$A\'$A\nC="a\\"b\\$c\\\\d\\`e"\n',
+    'A="multi\nline"\nB=$A\n',
+    'NOEXPAND="$UNDEFINED"\nB=${ALSO_UNDEFINED:1}\n',
+    'A=1\nA=2\nB=$A\n',
+    'A=\nB=""\nC=\'\'\n',
+    'A=abc\nB=${A/b}\nC=${A//}\nD=${A#}\n',
+    'A=value   \n   \n',
+    'PKGDEP="foo bar"\r\n',
+    'ABSPLITDBG=0\nNOLTO=1\n\tAB_FLAGS_O3=1\n',
+)
+
+UNSUPPORTED = (
+    'A=abc.def/g_h\nB=${A/\\./_}\n',
+    'A=$(uname -m)\n',
+    'A=`date`\n',
+    'if true; then A=1; fi\n',
+    'A=(a b c)\n',
+    'A=~/x\n',
+    'A=*.c\n',
+    'A=${B:-default}\n',
+    'export A=1\n',
+    'A="unterminated\n',
+    "A='unterminated\n",
+    'A=1 B=2\n',
+    'A=${#B}\n',
+    'A=123\nB=${A:-1}\n',
+    'A="a*b"\n',
+)
+
+PIECES = (
+    'A', 'B', 'PKGVER', '_x1', '=', '"', "'", '$', '${', '}', '{', ':', '/',
+    '//', '#', '##', '%', '%%', ' ', '  ', '\t', '\n', '\n', '\\', '\\\n',
+    '\\$', '\\"', '1', '-1', '0', '12', 'abc', 'x.y', '*', '?', '[', ']',
+    '~', '(', ')', '`', ';', '\r', 'é', '-', ' -2', '@', '&', '|',
+    '$A', '${A}', '${B:1:2}', '${A/b/c}', '${A//./_}', '${A%.*}',
+    '${A##*/}', '${A/[ab]/c}', '${A%[0-9]}', '${A:-1}', '${A: -1}',
+    '${A:1:-1}', '"$A"', '"a*b"', "'q'", 'A=', 'B=', '\nA=', '\nB=',
+    '\n#c\n',
+)
+
+
+def random_corpus(count, seed=0):
+    """
+    Random files made of PIECES, half of them as lines of assignments,
+    which parse more often.
+    """
+    rnd = random.Random(seed)
+    for k in range(count):
+        if rnd.random() < 0.5:
+            source = ''.join(rnd.choice(PIECES)
+                             for piece in range(rnd.randint(0, 25)))
+        else:
+            source = '\n'.join(
+                rnd.choice(('A=', 'B=', 'PKGVER=')) + ''.join(
+                    rnd.choice(PIECES) for piece in range(rnd.randint(0, 3)))
+                for line in range(rnd.randint(1, 4)))
+        if rnd.random() < 0.5:
+            source = 'A=abc.def/g_h\nB=12345\n' + source
+        yield source
+
+
+def evaluate(source, engine):
+    with warnings.catch_warnings(record=True) as wns:
+        warnings.simplefilter('always')
+        try:
+            result = list(bashvar.eval_bashvar_literal(source, engine).items())
+        except (bashvar.ParseError, bashvar.ParseException):
+            result = None
+    return result, [str(w.message) for w in wns
+                    if issubclass(w.category, bashvar.VariableWarning)]
+
+
+class LiteralEngineTest(unittest.TestCase):
+    def assertSameResult(self, source):
+        expected = evaluate(source, 'pyparsing')
+        self.assertEqual(evaluate(source, 'lexer'), expected, source)
+        return expected
+
+    def test_corpus(self):
+        for source in CORPUS:
+            result, wns = self.assertSameResult(source)
+            self.assertIsNotNone(result, source)
+        for source in UNSUPPORTED:
+            result, wns = self.assertSameResult(source)
+            self.assertIsNone(result, source)
+
+    def test_values(self):
+        variables = bashvar.eval_bashvar_literal(CORPUS[4])
+        self.assertEqual(variables['SRCTBL'],
+                         'https://example.org/1.2/foo-1.2.3.tar.gz')
+        self.assertEqual(variables['SUBDIR'], 'foo-1_2_3')
+        self.assertEqual(
+            (variables['MAJOR'], variables['MINOR'], variables['LAST']),
+            ('1', '2.3', '3'))
+
+    def test_random(self):
+        for source in random_corpus(3000):
+            self.assertSameResult(source)
+
+
+# scripts with errors, and what they can see of the process
+ERROR_SCRIPTS = (
+    'A=1\nB=2\nreadonly A\nA=5\nC=3\n',
+    'A=1\nnot_a_command\nB=2\n',
+    'A=1\nB=${UNSET?missing}\nC=3\n',
+    'A=1\nif\nB=2\n',
+    'A=1\ncd /\nB=2\n',
+    'A=1\nexit 3\nB=2\n',
+    'A=1\nread B\nC=x\nD=$B\n',
+    'A=$(echo error >&2; echo x)\nB=$((1/0))\nC=3\n',
+    'A=$(ls -a)\nB=$(env | grep -v ^PWD=)\nC=$BASH_VERSION\n',
+    'A="$(printf \'a\\nb\')"\nB=2\n',
+)
+
+
+def evaluate_ext(source, pool=None):
+    with warnings.catch_warnings(record=True) as wns:
+        warnings.simplefilter('always')
+        result = bashvar.eval_bashvar_ext(source, pool=pool)
+    return result, [str(w.message) for w in wns]
+
+
+class BashPoolTest(unittest.TestCase):
+    def test_errors(self):
+        with bashvar.BashPool(2) as pool:
+            for source in ERROR_SCRIPTS:
+                expected = evaluate_ext(source)
+                for k in range(2):
+                    self.assertEqual(evaluate_ext(source, pool), expected,
+                                     source)
+        result, wns = evaluate_ext(ERROR_SCRIPTS[0])
+        self.assertEqual(result, {'A': '1', 'B': '2', 'C': '3'})
+        self.assertEqual(wns, ['bash: line 4: A: readonly variable'])
+
+
+class ParseCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = bashvar.ParseCache(
+            os.path.join(self.tmpdir.name, 'cache.db'))
+
+    def tearDown(self):
+        self.cache.close()
+        self.tmpdir.cleanup()
+
+    def evaluate(self, source):
+        with self.assertLogs(level='WARNING') as logs:
+            result = bashvar.eval_bashvar(
+                source, 'spec', msg=True, cache=self.cache)
+        return result, logs.output
+
+    def test_messages(self):
+        for source in ('A=$UNDEFINED\n',
+                       'A=$(echo error >&2; echo x)\nB=$UNDEFINED\n'):
+            expected = self.evaluate(source)
+            hits = self.cache.hits
+            self.assertEqual(self.evaluate(source), expected)
+            self.assertEqual(self.cache.hits, hits + 1)
+        (variables, err), logs = expected
+        self.assertEqual(variables, {'A': 'x', 'B': ''})
+        self.assertEqual(err, 'error')
+        self.assertEqual(logs, ['ERROR:root:spec: error'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+import os
+import sys
+import random
+import unittest
+import collections
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from aoinb.common import depgraph
+from aoinb.scheduler import dag
+
+
+def make_build(packages, machines, seed=0):
+    """
+    Returns ({(machine, package): compile_time}, {package: dependencies})
+    of a random build list, where some packages have no feasible machine
+    and p1, p2 and p3 depend on each other.
+    """
+    rnd = random.Random(seed)
+    names = ['p%d' % k for k in range(packages)]
+    times = {}
+    dependencies = {}
+    for k, package in enumerate(names):
+        dependencies[package] = set(
+            rnd.sample(names[:k], min(k, rnd.randint(0, 4))))
+        if k % 50 == 49:
+            continue
+        for machine in range(machines):
+            if not machine or rnd.random() < 0.7:
+                times['m%d' % machine, package] = rnd.uniform(1, 100)
+    dependencies['p1'].add('p3')
+    return times, dependencies
+
+
+class PlanTest(unittest.TestCase):
+    def check(self, plan, times, dependencies):
+        finish = {job.package: job.finish for job in plan.jobs}
+        self.assertEqual(len(finish), len(plan.jobs))
+        self.assertEqual(sorted(set(finish).union(plan.unassigned)),
+                         sorted(dependencies))
+        for job in plan.jobs:
+            self.assertAlmostEqual(job.finish - job.start,
+                                   times[job.machine, job.package])
+            members = set()
+            for cycle in plan.cycles:
+                if job.package in cycle:
+                    members.update(cycle)
+            for dep in dependencies[job.package]:
+                if dep in finish and dep not in members:
+                    self.assertGreaterEqual(job.start, finish[dep])
+        by_machine = collections.defaultdict(list)
+        for job in plan.jobs:
+            by_machine[job.machine].append((job.start, job.finish))
+        for busy in by_machine.values():
+            busy.sort()
+            for previous, job in zip(busy, busy[1:]):
+                self.assertLessEqual(previous[1], job[0])
+        self.assertAlmostEqual(plan.makespan, max(finish.values()))
+        self.assertLessEqual(plan.critical_path, plan.makespan + 1e-9)
+
+    def test_plan(self):
+        for seed in range(3):
+            times, dependencies = make_build(600, 10, seed)
+            plan = dag.plan(times, dependencies)
+            self.check(plan, times, dependencies)
+            self.assertEqual(plan.cycles, [['p1', 'p2', 'p3']])
+            self.assertEqual(plan.unassigned,
+                             sorted('p%d' % k for k in range(49, 600, 50)))
+
+    def test_unassigned(self):
+        # u can't be built, x doesn't wait for it
+        plan = dag.plan({('m0', 'x'): 2, ('m0', 'y'): 3},
+                        {'u': set(), 'x': {'u'}, 'y': {'x'}})
+        self.assertEqual(plan.unassigned, ['u'])
+        self.assertEqual(plan.jobs, [dag.PlannedJob('x', 'm0', 0, 2),
+                                     dag.PlannedJob('y', 'm0', 2, 5)])
+        self.assertEqual(plan.levels, {'x': 0, 'y': 1})
+
+    def test_empty(self):
+        plan = dag.plan({}, {})
+        self.assertEqual((plan.jobs, plan.makespan, plan.unassigned),
+                         ([], 0, []))
+
+
+class TopologicalOrderTest(unittest.TestCase):
+    def test_cycles(self):
+        dependencies = {'a': set(), 'b': {'a', 'd'}, 'c': {'b'},
+                        'd': {'c'}, 'e': {'d', 'e'}}
+        order, cycles = dag.topological_order(dependencies)
+        self.assertEqual(cycles, [['b', 'c', 'd']])
+        self.assertEqual(sorted(order), ['a', 'b', 'c', 'd', 'e'])
+        self.assertLess(order.index('a'), order.index('b'))
+        self.assertLess(order.index('d'), order.index('e'))
+        # the dependencies inside the cycle are dropped
+        self.assertEqual(dependencies['b'], {'a'})
+        self.assertEqual(dependencies['c'], set())
+
+
+class EarliestSlotTest(unittest.TestCase):
+    def test_gaps(self):
+        busy = [(0, 2), (5, 7), (7, 9)]
+        self.assertEqual(dag._earliest_slot(busy, 0, 3), 2)
+        self.assertEqual(dag._earliest_slot(busy, 1, 4), 9)
+        self.assertEqual(dag._earliest_slot(busy, 3, 2), 3)
+        self.assertEqual(dag._earliest_slot(busy, 6, 1), 9)
+        self.assertEqual(dag._earliest_slot(busy, 10, 1), 10)
+        self.assertEqual(dag._earliest_slot([], 4, 1), 4)
+
+
+class BuildDependenciesTest(unittest.TestCase):
+    def test_through_unlisted(self):
+        graph = depgraph.DependencyGraph()
+        graph.add_edge('a', 'b')
+        graph.add_edge('b', 'c')
+        graph.add_edge('c', 'd')
+        graph.add_edge('d', 'a')
+        self.assertEqual(dag.build_dependencies(graph, ['a', 'c', 'x']),
+                         {'a': {'c'}, 'c': {'a'}, 'x': set()})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,220 @@
+import os
+import sys
+import heapq
+import random
+import unittest
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from aoinb.scheduler import dispatch
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def make_dispatcher(times, dependencies):
+    clock = Clock()
+    return dispatch.Dispatcher(times, dependencies, clock), clock
+
+
+class DispatcherTest(unittest.TestCase):
+    def test_retry_then_fail(self):
+        # a <- b <- c, and d doesn't depend on a
+        dispatcher, clock = make_dispatcher(
+            {('m0', 'a'): 10, ('m0', 'b'): 5, ('m0', 'c'): 5,
+             ('m0', 'd'): 1},
+            {'a': set(), 'b': {'a'}, 'c': {'b'}, 'd': set()})
+        self.assertEqual(dispatcher.machine_idle('m0'), [('m0', 'a')])
+        clock.now = 10
+        # built again
+        self.assertEqual(dispatcher.job_finished('m0', 'a', False),
+                         [('m0', 'a')])
+        self.assertFalse(dispatcher.finished())
+        clock.now = 20
+        self.assertEqual(dispatcher.job_finished('m0', 'a', False),
+                         [('m0', 'd')])
+        self.assertEqual(dispatcher.failed, {'a'})
+        self.assertEqual(dispatcher.blocked, {'b', 'c'})
+        self.assertEqual(dispatcher.attempts['a'], 2)
+        self.assertEqual(dispatcher.job_finished('m0', 'd'), [])
+        self.assertEqual(dispatcher.done, {'d'})
+        self.assertTrue(dispatcher.finished())
+
+    def test_machine_lost(self):
+        dispatcher, clock = make_dispatcher(
+            {('m0', 'a'): 10, ('m1', 'a'): 10}, {'a': set()})
+        self.assertEqual(dispatcher.machine_idle('m0'), [('m0', 'a')])
+        clock.now = 5
+        # no other machine yet
+        self.assertEqual(dispatcher.machine_lost('m0'), [])
+        self.assertEqual(dispatcher.running, {})
+        self.assertEqual(dispatcher.attempts['a'], 0)
+        self.assertFalse(dispatcher.finished())
+        self.assertEqual(dispatcher.machine_idle('m1'), [('m1', 'a')])
+        self.assertEqual(dispatcher.running['m1'],
+                         dispatch.RunningJob('a', 5, 15))
+        # m0 comes back and gets nothing
+        self.assertEqual(dispatcher.machine_idle('m0'), [])
+        clock.now = 15
+        self.assertEqual(dispatcher.job_finished('m1', 'a'), [])
+        self.assertEqual(dispatcher.attempts['a'], 1)
+        self.assertTrue(dispatcher.finished())
+
+    def test_duplicate_finish(self):
+        dispatcher, clock = make_dispatcher(
+            {('m0', 'a'): 1, ('m0', 'b'): 1, ('m1', 'b'): 1,
+             ('m0', 'c'): 1},
+            {'a': set(), 'b': {'a'}, 'c': {'a', 'b'}})
+        self.assertEqual(dispatcher.machine_idle('m0'), [('m0', 'a')])
+        self.assertEqual(dispatcher.job_finished('m0', 'a'), [('m0', 'b')])
+        # reported twice, b isn't queued again
+        self.assertEqual(dispatcher.job_finished('m1', 'a'), [])
+        self.assertEqual(dispatcher.ready, [])
+        self.assertEqual(dispatcher.waiting, {'c': 1})
+        self.assertEqual(dispatcher.running['m0'].package, 'b')
+        self.assertEqual(dispatcher.job_finished('m0', 'b'), [('m0', 'c')])
+        self.assertEqual(dispatcher.job_finished('m0', 'c'), [])
+        self.assertEqual(dispatcher.done, {'a', 'b', 'c'})
+        self.assertTrue(dispatcher.finished())
+
+    def test_stale_finish(self):
+        dispatcher, clock = make_dispatcher(
+            {('m0', 'a'): 1, ('m1', 'a'): 1, ('m1', 'b'): 1},
+            {'a': set(), 'b': set()})
+        self.assertEqual(dispatcher.machine_idle('m0'), [('m0', 'a')])
+        dispatcher.machine_lost('m0')
+        self.assertEqual(dispatcher.machine_idle('m1'), [('m1', 'a')])
+        # a failure of m0 doesn't count, a is still running on m1
+        self.assertEqual(dispatcher.job_finished('m0', 'a', False), [])
+        self.assertEqual(dispatcher.failed, set())
+        self.assertEqual(dispatcher.attempts['a'], 1)
+        self.assertEqual(dispatcher.ready, [(-1, 1, 'b')])
+        # a success does, and the late report of m1 is ignored
+        self.assertEqual(dispatcher.job_finished('m0', 'a'), [])
+        self.assertEqual(dispatcher.done, {'a'})
+        self.assertEqual(dispatcher.job_finished('m1', 'a'), [('m1', 'b')])
+        self.assertEqual(dispatcher.done, {'a'})
+        self.assertEqual(dispatcher.job_finished('m1', 'b'), [])
+        self.assertTrue(dispatcher.finished())
+
+    def test_update_speed(self):
+        dispatcher, clock = make_dispatcher(
+            {('m0', 'a'): 10, ('m0', 'b'): 6, ('m1', 'b'): 6, ('m0', 'c'): 8},
+            {'a': set(), 'b': set(), 'c': set()})
+        self.assertEqual(dispatcher.rank, {'a': 10, 'b': 6, 'c': 8})
+        self.assertEqual(dispatcher.machine_idle('m0'), [('m0', 'a')])
+        # below the threshold
+        dispatcher.update_speed('m0', 1.05)
+        self.assertEqual(dispatcher.drift, {'m0': 1.05})
+        self.assertEqual(dispatcher.rank, {'a': 10, 'b': 6, 'c': 8})
+        self.assertAlmostEqual(dispatcher.running['m0'].finish, 10 / 1.05)
+        dispatcher.update_speed('m0', 4 / 1.05)
+        self.assertEqual(dispatcher.drift, {})
+        self.assertAlmostEqual(dispatcher.running['m0'].finish, 2.5)
+        self.assertAlmostEqual(dispatcher.rank['b'], 3.75)
+        self.assertAlmostEqual(dispatcher.rank['c'], 2)
+        # b is now before c
+        clock.now = 2.5
+        self.assertEqual(dispatcher.job_finished('m0', 'a'), [('m0', 'b')])
+        self.assertAlmostEqual(dispatcher.running['m0'].finish, 4)
+
+    def test_simulation(self):
+        """
+        Build 200 packages on 5 machines whose real speeds differ from the
+        estimates, with flaky and broken packages and a machine lost.
+        """
+        rnd = random.Random(0)
+        machines = ['m%d' % k for k in range(5)]
+        packages = ['p%d' % k for k in range(200)]
+        real_speed = {machine: rnd.uniform(0.5, 2) for machine in machines}
+        times = {}
+        dependencies = {}
+        for k, package in enumerate(packages):
+            dependencies[package] = set(
+                rnd.sample(packages[:k], min(k, rnd.randint(0, 3))))
+            if k % 40 == 39:
+                continue
+            for machine in machines:
+                if machine == 'm0' or rnd.random() < 0.6:
+                    times[machine, package] = rnd.uniform(1, 20)
+        unassigned = {package for package in packages
+                      if not any(key[1] == package for key in times)}
+        broken = {'p10', 'p120'}
+        flaky = set(rnd.sample(packages, 20)) - broken
+        dispatcher, clock = make_dispatcher(times, dependencies)
+        events = []
+        # machine -> (package, start) of the job it's really running
+        jobs = {}
+        built = {}
+
+        def start(new_jobs):
+            for machine, package in new_jobs:
+                self.assertNotIn(machine, jobs)
+                self.assertNotIn(package, built)
+                jobs[machine] = (package, clock.now)
+                heapq.heappush(events, (
+                    clock.now + times[machine, package] /
+                    real_speed[machine], machine, package, clock.now))
+
+        for machine in machines:
+            start(dispatcher.machine_idle(machine))
+        lost = False
+        while events:
+            clock.now, machine, package, job_start = heapq.heappop(events)
+            if jobs.get(machine) != (package, job_start):
+                # it was lost
+                continue
+            if not lost and clock.now > 50:
+                lost = True
+                del jobs[machine]
+                start(dispatcher.machine_lost(machine))
+                start(dispatcher.machine_idle(machine))
+                continue
+            del jobs[machine]
+            success = package not in broken
+            if package in flaky:
+                flaky.discard(package)
+                success = False
+            if success:
+                for dep in dependencies[package]:
+                    if dep not in unassigned:
+                        self.assertLessEqual(built[dep], job_start)
+                built[package] = clock.now
+            expected = dispatcher.running[machine]
+            factor = ((expected.finish - expected.start) /
+                      (clock.now - job_start))
+            self.assertFalse(dispatcher.finished())
+            start(dispatcher.job_finished(machine, package, success, factor))
+        self.assertTrue(lost)
+        self.assertTrue(dispatcher.finished())
+        # a broken package may be blocked by the other one
+        self.assertLessEqual(dispatcher.failed, broken)
+        self.assertLessEqual(broken, dispatcher.failed | dispatcher.blocked)
+        self.assertEqual(set(dispatcher.unassigned), unassigned)
+        self.assertEqual(dispatcher.done, set(built))
+        self.assertEqual(dispatcher.done | dispatcher.failed |
+                         dispatcher.blocked | unassigned, set(packages))
+        for package in dispatcher.blocked:
+            self.assertTrue(
+                dependencies[package] & (dispatcher.failed |
+                                         dispatcher.blocked))
+        for package in dispatcher.done:
+            self.assertLessEqual(dependencies[package],
+                                 dispatcher.done | unassigned)
+        # the compile times follow the real speeds
+        for (machine, package), compile_time in times.items():
+            if package in dispatcher.by_package:
+                self.assertAlmostEqual(
+                    dispatcher.by_package[package][machine] /
+                    dispatcher.drift.get(machine, 1),
+                    compile_time / real_speed[machine])
+
+
+if __name__ == '__main__':
+    unittest.main()
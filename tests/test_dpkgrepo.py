@@ -0,0 +1,201 @@
+import os
+import sys
+import lzma
+import random
+import hashlib
+import sqlite3
+import tempfile
+import threading
+import functools
+import unittest
+import http.server
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', 'aoinb', 'common'))
+
+import vercomp
+import dpkgrepo
+
+SUITES = ('stable', 'testing')
+ARCHS = ('amd64', 'arm64', 'all')
+
+
+def make_mirror(path, npkgs=60):
+    for suite in SUITES:
+        items = []
+        for arch in ARCHS:
+            paras = []
+            for i in range(npkgs):
+                paras.append(
+                    'Package: pkg%d\nVersion: 1.%d-%d\nArchitecture: %s\n'
+                    'Depends: pkg%d (>= 1.0)\nFilename: pool/pkg%d_%s.deb\n'
+                    'Size: %d\nSHA256: %s\n' % (
+                        i, i, len(suite), arch, (i + 1) % npkgs, i, arch,
+                        1000 + i, hashlib.sha256(b'%d' % i).hexdigest()))
+            data = lzma.compress('\n'.join(paras).encode('utf-8'))
+            name = 'main/binary-%s/Packages.xz' % arch
+            filename = os.path.join(path, 'dists', suite, name)
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            with open(filename, 'wb') as f:
+                f.write(data)
+            items.append(' %s %d %s\n' % (
+                hashlib.sha256(data).hexdigest(), len(data), name))
+        with open(os.path.join(path, 'dists', suite, 'InRelease'), 'w') as f:
+            f.write('-----BEGIN PGP SIGNED MESSAGE-----\nHash: SHA256\n\n'
+                    'Origin: AOSC\nSuite: %s\n'
+                    'Date: Tue, 14 Nov 2023 22:13:20 UTC\nSHA256:\n%s'
+                    '-----BEGIN PGP SIGNATURE-----\n\nabcdef\n'
+                    '-----END PGP SIGNATURE-----\n' % (suite, ''.join(items)))
+
+
+class Jitter:
+    """
+    Random delays, so that the download threads start in any order.
+    """
+    def __init__(self, seed=0):
+        self.rnd = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            delay = self.rnd.uniform(0, 0.05)
+        threading.Event().wait(delay)
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class WriterError(Exception):
+    pass
+
+
+class PackagesUpdateTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        make_mirror(self.tmpdir.name)
+        self.server = http.server.ThreadingHTTPServer(
+            ('127.0.0.1', 0), functools.partial(
+                QuietHandler, directory=self.tmpdir.name))
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        self.host = '127.0.0.1:%d' % self.server.server_address[1]
+        # small batches, so that the download threads wait for the writer
+        self.batch_size = dpkgrepo._PackagesStream.batch_size
+        dpkgrepo._PackagesStream.batch_size = 5
+        self.jitter = Jitter()
+        self.fetch_packages = fetch_packages = dpkgrepo.fetch_packages
+
+        def jittered(*args):
+            self.jitter.wait()
+            return fetch_packages(*args)
+
+        dpkgrepo.fetch_packages = jittered
+
+    def tearDown(self):
+        dpkgrepo.fetch_packages = self.fetch_packages
+        dpkgrepo._PackagesStream.batch_size = self.batch_size
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmpdir.cleanup()
+
+    def update(self, jobs, host_limits, db=None):
+        if db is None:
+            db = sqlite3.connect(':memory:', check_same_thread=False)
+            vercomp.register(db)
+            dpkgrepo.init_db(db, False)
+        errors = []
+
+        def run():
+            try:
+                with dpkgrepo.CatalogClient(jobs, host_limits) as client:
+                    dpkgrepo.update(db, 'http://%s/' % self.host, SUITES,
+                                    client=client, jobs=jobs)
+            except Exception as ex:
+                errors.append(ex)
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        thread.join(60)
+        self.assertFalse(thread.is_alive(), 'update is stuck')
+        if errors:
+            raise errors[0]
+        return db.execute('SELECT count(*) FROM dpkg_packages').fetchone()[0]
+
+    def test_host_limit(self):
+        expected = len(SUITES) * len(ARCHS) * 60
+        self.assertEqual(self.update(4, {}), expected)
+        for seed in range(4):
+            self.jitter.rnd.seed(seed)
+            self.assertEqual(self.update(4, {self.host: 1}), expected)
+
+    def test_writer_error(self):
+        write_packages = dpkgrepo.write_packages
+
+        def failing(db, repo, packages, *args):
+            if repo.suite == suite:
+                # leave the stream with batches still to come
+                for k, item in zip(range(20), packages):
+                    pass
+                raise WriterError(repo.name)
+            return write_packages(db, repo, packages, *args)
+
+        dpkgrepo.write_packages = failing
+        try:
+            for suite in SUITES:
+                db = sqlite3.connect(':memory:', check_same_thread=False)
+                vercomp.register(db)
+                dpkgrepo.init_db(db, False)
+                with self.assertRaises(WriterError):
+                    self.update(4, {self.host: 1}, db)
+                # the failed suite is rolled back, the ones before are kept
+                self.assertEqual(db.execute(
+                    'SELECT DISTINCT suite FROM dpkg_repos').fetchall(),
+                    [(name,) for name in SUITES[:SUITES.index(suite)]])
+                self.assertEqual(db.execute(
+                    'SELECT count(*) FROM dpkg_packages').fetchone()[0],
+                    SUITES.index(suite) * len(ARCHS) * 60)
+        finally:
+            dpkgrepo.write_packages = write_packages
+
+
+class WritePackagesTest(unittest.TestCase):
+    def setUp(self):
+        self.db = sqlite3.connect(':memory:')
+        vercomp.register(self.db)
+        dpkgrepo.init_db(self.db, False)
+        self.repo = dpkgrepo.Repo('amd64/stable', 'amd64', None, 'base', 0,
+                                  'stable', 'main', 'amd64')
+
+    def packages(self):
+        for name, filename in (('a', 'pool/a_1.deb'), ('b', 'pool/b_1.deb'),
+                               ('a', 'pool/a_2.deb'), ('c', 'pool/c_1.deb')):
+            yield (name, '1.0', 'amd64', self.repo.name, 'Dev', 1, filename,
+                   100, '0' * 64), {'depends': 'libc'}
+
+    def write(self):
+        with self.assertLogs(level='INFO') as logs:
+            dpkgrepo.write_packages(self.db, self.repo, self.packages())
+        self.db.execute('DELETE FROM package_changes')
+        return logs.output[-1].rsplit(': ', 1)[1]
+
+    def test_duplicate(self):
+        self.assertEqual(
+            self.write(), '3 new, 0 changed, 0 removed, 0 unchanged')
+        self.assertEqual(self.db.execute(
+            "SELECT filename FROM dpkg_packages WHERE package='a'"
+        ).fetchall(), [('pool/a_2.deb',)])
+        self.assertEqual(self.db.execute(
+            'SELECT count(*) FROM dpkg_package_duplicate').fetchone()[0], 2)
+        changes = self.db.total_changes
+        self.assertEqual(
+            self.write(), '0 new, 0 changed, 0 removed, 3 unchanged')
+        self.assertEqual(self.db.execute(
+            'SELECT count(*) FROM dpkg_package_duplicate').fetchone()[0], 2)
+        # only the rows of dpkg_package_duplicate are written again
+        self.assertEqual(self.db.total_changes - changes, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+import os
+import sys
+import random
+import unittest
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from aoinb.scheduler import solvers
+
+
+def make_times(packages, machines, seed=0):
+    rnd = random.Random(seed)
+    speeds = [rnd.uniform(0.5, 2) for machine in range(machines)]
+    times = {}
+    for package in range(packages):
+        work = rnd.uniform(1, 100)
+        for machine, speed in enumerate(speeds):
+            # some pairs are not feasible
+            if machine == 0 or rnd.random() < 0.8:
+                times['m%d' % machine, 'p%d' % package] = work / speed
+    return times
+
+
+class ScheduleTest(unittest.TestCase):
+    def test_empty(self):
+        for solver in ('auto', 'heuristic', 'lpt', 'min-min', 'max-min'):
+            result = solvers.schedule({}, ['a', 'b'], solver, 1)
+            self.assertEqual(result.assignment, {})
+            self.assertEqual(result.unassigned, ['a', 'b'])
+
+    def test_heuristics(self):
+        times = make_times(60, 5)
+        packages = sorted(set(package for machine, package in times))
+        for solver in ('heuristic', 'lpt', 'min-min', 'max-min'):
+            result = solvers.schedule(times, packages + ['x'], solver, 1)
+            assigned = sorted(
+                package for machine_packages in result.assignment.values()
+                for package in machine_packages)
+            self.assertEqual(assigned, packages)
+            for machine, machine_packages in result.assignment.items():
+                for package in machine_packages:
+                    self.assertIn((machine, package), times)
+            self.assertEqual(result.unassigned, ['x'])
+            self.assertGreaterEqual(result.makespan, result.lower_bound)
+
+
+if __name__ == '__main__':
+    unittest.main()
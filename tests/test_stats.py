@@ -0,0 +1,249 @@
+import os
+import sys
+import math
+import random
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from aoinb.scheduler import stats
+
+if stats.NUMPY_AVAILABLE:
+    import numpy as np
+
+
+MACHINES = ('m0', 'm1', 'm2', 'm3')
+PACKAGES = ('glibc', 'bash', 'gcc', 'llvm')
+
+
+def synthetic_log(seed=0, noise=0):
+    """
+    Returns ({machine: speed}, {package: work}, aoinb_build_log rows) of one
+    build of each package on each machine, with cpu times off by a factor
+    of exp(N(0, noise)).
+    """
+    rnd = random.Random(seed)
+    speeds = {machine: rnd.uniform(0.5, 2) for machine in MACHINES}
+    works = {}
+    log = []
+    start = 1
+    for package in PACKAGES:
+        work = works[package] = rnd.uniform(10, 100)
+        for machine in MACHINES:
+            cpu_time = (work / speeds[machine] *
+                        math.exp(rnd.gauss(0, noise)) * 1e9)
+            log.append((package, 'amd64', '1', machine, int(cpu_time),
+                        int(cpu_time / 2), rnd.randint(1, 1 << 30),
+                        rnd.randint(1, 1 << 30), start, start + 1,
+                        'success', None, None))
+            start += 1
+    return speeds, works, log
+
+
+def make_stats(seed=0, noise=0):
+    bstats = stats.BuildStatistics(':memory:')
+    bstats.init_db()
+    bstats.db.executemany(
+        "INSERT INTO aoinb_machines VALUES (?,?,?,?,?,?,?,?,?,?,?,?)",
+        ((machine, 'amd64', 2 ** (k + 1), 1 << 34, 1 << 40, 0.5,
+          None, None, None, 0, 0, 0) for k, machine in enumerate(MACHINES)))
+    bstats.db.executemany(
+        "INSERT INTO aoinb_build_log VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)",
+        synthetic_log(seed, noise)[2])
+    bstats.db.commit()
+    return bstats
+
+
+def load_params(bstats):
+    return (
+        bstats.db.execute(
+            "SELECT id, speed FROM aoinb_machines ORDER BY id").fetchall(),
+        bstats.db.execute(
+            "SELECT package, work, prate_intercept, disk_usage "
+            "FROM aoinb_package_params ORDER BY package").fetchall())
+
+
+@unittest.skipUnless(stats.SCIPY_AVAILABLE, 'needs NumPy and SciPy')
+class CalcParamsTest(unittest.TestCase):
+    def assertParams(self, bstats, speeds, works, places=7):
+        got_speeds, got_works = load_params(bstats)
+        self.assertEqual([row[0] for row in got_speeds], sorted(speeds))
+        self.assertEqual([row[0] for row in got_works], sorted(works))
+        for machine, speed in got_speeds:
+            self.assertAlmostEqual(math.log(speed),
+                                   math.log(speeds[machine]), places)
+        for package, work, prate, disk in got_works:
+            self.assertAlmostEqual(math.log(work),
+                                   math.log(works[package]), places)
+
+    def test_exact(self):
+        # the builds fit exactly, with the work of glibc as the unit
+        speeds, works, log = synthetic_log()
+        unit = works['glibc']
+        bstats = make_stats()
+        bstats.calc_params()
+        self.assertParams(
+            bstats,
+            {machine: speed / unit for machine, speed in speeds.items()},
+            {package: work / unit for package, work in works.items()})
+
+    def test_least_squares(self):
+        # log(time) = log(work) - log(speed), log(work of glibc) = 0
+        log = synthetic_log(1, 0.2)[2]
+        columns = MACHINES + PACKAGES
+        matrix = []
+        times = []
+        for row in log:
+            line = [0] * len(columns)
+            line[columns.index(row[3])] = -1
+            line[columns.index(row[0])] = 1
+            matrix.append(line)
+            times.append(math.log(row[4] / 1e9))
+        line = [0] * len(columns)
+        line[columns.index('glibc')] = 1
+        matrix.append(line)
+        times.append(0)
+        result = np.linalg.lstsq(
+            np.array(matrix, dtype=float), np.array(times), rcond=None)[0]
+        bstats = make_stats(1, 0.2)
+        bstats.calc_params()
+        self.assertParams(
+            bstats, dict(zip(MACHINES, np.exp(result[:4]).tolist())),
+            dict(zip(PACKAGES, np.exp(result[4:]).tolist())), 5)
+
+
+class CalcParamsFallbackTest(unittest.TestCase):
+    def calc_params(self, numpy):
+        with mock.patch.object(stats, 'NUMPY_AVAILABLE',
+                               numpy and stats.NUMPY_AVAILABLE), \
+                mock.patch.object(stats, 'SCIPY_AVAILABLE', False):
+            bstats = make_stats()
+            bstats.calc_params()
+        return load_params(bstats)
+
+    @unittest.skipUnless(stats.NUMPY_AVAILABLE, 'needs NumPy')
+    def test_without_scipy(self):
+        speeds, works = self.calc_params(True)
+        # the speeds and works stay at their defaults
+        self.assertEqual(speeds, [(machine, 0.5) for machine in MACHINES])
+        self.assertEqual([row[:2] for row in works],
+                         [(package, 1) for package in sorted(PACKAGES)])
+        # all builds run at prate 1
+        for row in works:
+            self.assertAlmostEqual(row[2], 1)
+
+    def test_without_numpy(self):
+        speeds, works = self.calc_params(False)
+        self.assertEqual(speeds, [(machine, 0.5) for machine in MACHINES])
+        self.assertEqual([row[:2] for row in works],
+                         [(package, 1) for package in sorted(PACKAGES)])
+        disk_usage = {}
+        for row in synthetic_log()[2]:
+            disk_usage[row[0]] = max(disk_usage.get(row[0], 0), row[7])
+        for package, work, prate, disk in works:
+            self.assertAlmostEqual(prate, 1)
+            self.assertEqual(disk, disk_usage[package])
+
+
+class CompileTimesTest(unittest.TestCase):
+    def test_latest_version(self):
+        bstats = make_stats()
+        for version, work, updated in (('1.9', 5, 100), ('1.10', 50, 100),
+                                       ('1.2', 500, 90), ('1.0', 30, 100)):
+            bstats.db.execute(
+                'INSERT INTO aoinb_package_params VALUES '
+                '(?,?,?,?,0,0,0,0,0,?)',
+                ('foo', 'amd64', version, work, updated))
+        times = bstats.compile_times(['m0', 'm1'], ['foo'])
+        self.assertEqual(times, {('m0', 'foo'): 100, ('m1', 'foo'): 100})
+
+
+class OnlineEstimatorTest(unittest.TestCase):
+    def setUp(self):
+        self.rnd = random.Random(0)
+        self.machines = ['m%d' % k for k in range(6)]
+        self.packages = ['glibc'] + ['p%d' % k for k in range(19)]
+        self.speeds = {machine: self.rnd.uniform(0.5, 2)
+                       for machine in self.machines}
+        self.works = {package: self.rnd.uniform(10, 100)
+                      for package in self.packages}
+        # machines without a speed, and no package parameters
+        self.bstats = stats.BuildStatistics(':memory:')
+        self.bstats.init_db()
+        self.bstats.db.executemany(
+            "INSERT INTO aoinb_machines (id, arch, cpu_count) VALUES (?,?,?)",
+            ((machine, 'amd64', 4) for machine in self.machines))
+        self.estimator = stats.OnlineEstimator(self.bstats)
+
+    def build(self, count):
+        for k in range(count):
+            machine = self.rnd.choice(self.machines)
+            package = self.rnd.choice(self.packages)
+            cpu_time = (self.works[package] / self.speeds[machine] *
+                        math.exp(self.rnd.gauss(0, 0.1)) * 1e9)
+            self.estimator.job_finished(
+                package, 'amd64', '1', machine, cpu_time, False)
+
+    def assertEstimates(self, delta):
+        # in units of the work of glibc
+        unit = self.works['glibc']
+        db = self.bstats.db
+        for machine in self.machines:
+            speed = db.execute('SELECT speed FROM aoinb_machines WHERE id=?',
+                               (machine,)).fetchone()[0]
+            self.assertAlmostEqual(speed, self.estimator.speed(machine))
+            self.assertAlmostEqual(
+                math.log(speed), math.log(self.speeds[machine] / unit),
+                delta=delta)
+        for package in self.packages:
+            work = db.execute(
+                'SELECT work FROM aoinb_package_params WHERE package=?',
+                (package,)).fetchone()[0]
+            self.assertAlmostEqual(
+                math.log(work), math.log(self.works[package] / unit),
+                delta=delta)
+
+    def test_converge(self):
+        self.build(2000)
+        self.assertEstimates(0.15)
+        self.assertEqual(self.bstats.db.execute(
+            "SELECT work FROM aoinb_package_params WHERE package='glibc'"
+        ).fetchall(), [(1,)])
+
+    def test_slowed_machine(self):
+        self.build(2000)
+        self.speeds['m0'] /= 2
+        self.build(1000)
+        self.assertEstimates(0.15)
+
+    def test_new_package(self):
+        self.build(500)
+        speed = self.estimator.speed('m0')
+        for k in range(3):
+            work, = self.estimator.job_finished(
+                'new', 'amd64', '1', 'm0', 2e10)[1:]
+            if not k:
+                # it only sets the work
+                self.assertEqual(self.estimator.speed('m0'), speed)
+                self.assertAlmostEqual(work, 20 * speed)
+        self.assertEqual(self.bstats.db.execute(
+            "SELECT count(*) FROM aoinb_package_params WHERE package='new'"
+        ).fetchone()[0], 1)
+
+    def test_unknown_version(self):
+        bstats = make_stats()
+        estimator = stats.OnlineEstimator(bstats)
+        for k in range(3):
+            self.assertIsNone(
+                estimator.job_finished('bash', 'amd64', None, 'm0', 1e10))
+        self.assertEqual(bstats.db.execute(
+            'SELECT count(*) FROM aoinb_package_params').fetchone()[0], 0)
+        self.assertEqual(bstats.db.execute(
+            'SELECT speed FROM aoinb_machines WHERE id=?',
+            ('m0',)).fetchone()[0], 0.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
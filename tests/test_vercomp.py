@@ -0,0 +1,55 @@
+import os
+import sys
+import sqlite3
+import unittest
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', 'aoinb', 'common'))
+
+import vercomp
+
+
+def sign(value):
+    return (value > 0) - (value < 0)
+
+
+class ConformanceTest(unittest.TestCase):
+    def test_compare(self):
+        for a, b, expected in vercomp.CONFORMANCE_CASES:
+            with self.subTest(a=a, b=b):
+                self.assertEqual(sign(vercomp.compare(a, b)), expected)
+                self.assertEqual(sign(vercomp.compare(b, a)), -expected)
+
+    def test_sort_key(self):
+        for a, b, expected in vercomp.CONFORMANCE_CASES:
+            with self.subTest(a=a, b=b):
+                key_a = vercomp.sort_key(a)
+                key_b = vercomp.sort_key(b)
+                self.assertEqual((key_a > key_b) - (key_a < key_b), expected)
+
+    def test_self_test(self):
+        self.assertEqual(vercomp.self_test(), [])
+
+    def test_sql(self):
+        db = sqlite3.connect(':memory:')
+        vercomp.register(db)
+        db.execute('CREATE TABLE t (version TEXT)')
+        versions = sorted(set(
+            version for case in vercomp.CONFORMANCE_CASES
+            for version in case[:2]))
+        db.executemany('INSERT INTO t VALUES (?)',
+                       ((version,) for version in versions))
+        by_key = [row[0] for row in db.execute(
+            'SELECT version FROM t ORDER BY vercomp_key(version), version')]
+        by_collation = [row[0] for row in db.execute(
+            'SELECT version FROM t ORDER BY version COLLATE vercomp, version')]
+        self.assertEqual(
+            [vercomp.sort_key(version) for version in by_key],
+            sorted(vercomp.sort_key(version) for version in versions))
+        self.assertEqual(
+            [vercomp.sort_key(version) for version in by_collation],
+            [vercomp.sort_key(version) for version in by_key])
+
+
+if __name__ == '__main__':
+    unittest.main()